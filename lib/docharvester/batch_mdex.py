@@ -0,0 +1,165 @@
+'''
+Extracts metadata for batches of documents concurrently, while staying polite to each publisher.
+
+Each document is run through DocumentMDEx in a pool of worker threads (as the extractors use blocking HTTP calls),
+driven by an asyncio event loop that enforces a per-host limit on concurrent extractions and a minimum interval
+between starting extractions for the same host. When the gov.uk API lookup fails, the document is retried after an
+exponentially increasing delay, without holding up any other documents while it waits. So, one slow or failing
+host only delays the documents from that host.
+'''
+
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from lib.docharvester.document_mdex import DocumentMDEx
+from lib.docharvester.fetch_cache import get_fetch_cache
+
+logger = logging.getLogger('luigi-interface')
+
+# Defaults for batch extraction:
+DEFAULT_MDEX_WORKERS = int(os.environ.get('MDEX_WORKERS', 20))
+DEFAULT_MDEX_PER_HOST = int(os.environ.get('MDEX_PER_HOST', 2))
+DEFAULT_MDEX_HOST_INTERVAL = float(os.environ.get('MDEX_HOST_INTERVAL', 1.0))
+DEFAULT_MDEX_TRIES = 5
+DEFAULT_MDEX_RETRY_WAIT = 10
+
+
+def document_host(doc):
+    '''
+    The host that extracting metadata for this document will mostly be talking to.
+    '''
+    return urlparse(doc.get('landing_page_url', None) or doc['document_url']).hostname
+
+
+class HostStats(object):
+    '''
+    Records how long each attempt to extract metadata for documents from one host took.
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.retries = 0
+        self.failures = 0
+
+    def summary(self):
+        if len(self.latencies) == 0:
+            return { 'attempts': 0, 'retries': self.retries, 'failures': self.failures }
+        latencies = sorted(self.latencies)
+        return {
+            'attempts': len(latencies),
+            'retries': self.retries,
+            'failures': self.failures,
+            'mean_seconds': round(sum(latencies) / len(latencies), 3),
+            'p95_seconds': round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 3),
+            'max_seconds': round(latencies[-1], 3),
+        }
+
+
+class BatchMDEx(object):
+    '''
+    Runs DocumentMDEx over a batch of documents concurrently, with per-host concurrency and rate limits.
+    '''
+
+    def __init__(self, targets, workers=DEFAULT_MDEX_WORKERS, per_host=DEFAULT_MDEX_PER_HOST,
+                 host_interval=DEFAULT_MDEX_HOST_INTERVAL, tries=DEFAULT_MDEX_TRIES,
+                 retry_wait=DEFAULT_MDEX_RETRY_WAIT, fetch_cache=None):
+        if not targets:
+            raise Exception("The Targets passed to BatchMDEx cannot by empty!")
+        self.targets = targets
+        self.workers = workers
+        self.per_host = per_host
+        self.host_interval = host_interval
+        self.tries = tries
+        self.retry_wait = retry_wait
+        self.fetch_cache = fetch_cache or get_fetch_cache()
+        self.hosts = {}
+        self.elapsed = 0.0
+        self.documents = 0
+
+    def _mdex(self, doc, source):
+        # Retries are handled by the event loop, so only try once in the worker thread:
+        return DocumentMDEx(self.targets, doc, source, fetch_cache=self.fetch_cache, tries=1).mdex()
+
+    async def _wait_for_turn(self, host, state):
+        # Space out the start of extractions for the same host:
+        now = time.time()
+        start_at = max(now, state['next_start'])
+        state['next_start'] = start_at + self.host_interval
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+    async def _extract(self, loop, executor, doc, source, states):
+        host = document_host(doc)
+        state = states.get(host, None)
+        if state is None:
+            state = { 'semaphore': asyncio.Semaphore(self.per_host), 'next_start': 0.0 }
+            states[host] = state
+        stats = self.hosts.setdefault(host, HostStats())
+        attempt = 0
+        while True:
+            attempt += 1
+            async with state['semaphore']:
+                await self._wait_for_turn(host, state)
+                started = time.time()
+                try:
+                    result = await loop.run_in_executor(executor, self._mdex, dict(doc), source)
+                except Exception as e:
+                    logger.error("Extraction failed for document %s" % doc['document_url'])
+                    logger.exception(e)
+                    result = None
+                stats.latencies.append(time.time() - started)
+            if result is not None and 'api_call_failed' not in result:
+                return doc, result
+            if attempt >= self.tries:
+                stats.failures += 1
+                return doc, result
+            # Back off before trying again, without holding a slot for this host:
+            stats.retries += 1
+            delay = self.retry_wait * (2 ** (attempt - 1))
+            logger.info("Retrying %s in %s seconds (attempt %i of %i)" % (doc['document_url'], delay, attempt + 1, self.tries))
+            await asyncio.sleep(delay)
+
+    async def _extract_all(self, docs, callback):
+        loop = asyncio.get_event_loop()
+        states = {}
+        # Callbacks get a thread of their own, so they run one at a time without blocking the event loop:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                ThreadPoolExecutor(max_workers=1) as callback_executor:
+            pending = [self._extract(loop, executor, doc, source, states) for doc, source in docs]
+            for next_done in asyncio.as_completed(pending):
+                doc, result = await next_done
+                self.documents += 1
+                await loop.run_in_executor(callback_executor, callback, doc, result)
+
+    def extract(self, docs, callback):
+        '''
+        Extracts metadata for all the given documents, calling callback(doc, result) as each one completes.
+
+        The result is the enhanced document, as returned by DocumentMDEx.mdex(), or None if extraction raised an
+        exception. Callbacks are called one at a time, in order of completion.
+
+        :param docs: a list of (document, source) pairs
+        '''
+        started = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._extract_all(docs, callback))
+        finally:
+            loop.close()
+            self.elapsed += time.time() - started
+
+    def docs_per_minute(self):
+        if self.elapsed == 0:
+            return 0.0
+        return 60.0 * self.documents / self.elapsed
+
+    def report(self):
+        return {
+            'documents': self.documents,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'docs_per_minute': round(self.docs_per_minute(), 1),
+            'hosts': dict((host, stats.summary()) for host, stats in self.hosts.items()),
+        }
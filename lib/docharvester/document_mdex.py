@@ -11,12 +11,12 @@ Created on 8 Feb 2016
 
 import re
 import time
-import json
 import logging
 import requests
 from urllib.parse import urlparse
-from lxml import html
 from lib.surt import url_to_surt
+from lib.docharvester.surt_trie import watched_targets_trie
+from lib.docharvester.fetch_cache import get_fetch_cache
 
 logger = logging.getLogger('luigi-interface')
 
@@ -26,16 +26,26 @@ class DocumentMDEx(object):
     Given a Landing Page extract additional metadata.
     '''
 
-    def __init__(self, targets, document, source, null_if_no_target_found=True):
+    def __init__(self, targets, document, source, null_if_no_target_found=True, fetch_cache=None, tries=5, retry_wait=10):
         '''
         The connection to W3ACT and the Document to be enhanced.
+
+        Landing pages are fetched via the given FetchCache, or the shared one if none is given.
+
+        The gov.uk API lookup is tried up to 'tries' times, 'retry_wait' seconds apart. Callers that want to manage
+        retries themselves can set tries=1, and check for 'api_call_failed' in the result.
         '''
         if not targets:
             raise Exception("The Targets passed to DocumentMDEx cannot by empty!")
         self.targets = targets
+        # Index the Watched Target seeds (this is only built once for the same list of targets):
+        self.watched = watched_targets_trie(targets)
         self.doc = document
         self.source = source
         self.null_if_no_target_found = null_if_no_target_found
+        self.fetch_cache = fetch_cache or get_fetch_cache()
+        self.tries = tries
+        self.retry_wait = retry_wait
 
     def lp_wb_url(self):
         # FIXME Redirect due to timestamp goes through W3ACT! Going direct to live web for now:
@@ -54,15 +64,7 @@ class DocumentMDEx(object):
         '''
         # Find the list of Targets where a seed matches the given URL
         tsurt = url_to_surt(url)
-        matches = []
-        for t in self.targets:
-            if t['watched']:
-                a_match = False
-                for seed in t['seeds']:
-                    if tsurt.startswith(url_to_surt(seed, host_only=True)):
-                        a_match = True
-                if a_match:
-                    matches.append(t)
+        matches = [self.targets[i] for i in sorted(set(self.watched.matches(tsurt)))]
 
         # No matches:
         if len(matches) == 0:
@@ -158,8 +160,8 @@ class DocumentMDEx(object):
         ''' Default extractor uses landing page for title etc.'''
         # Grab the landing page URL as HTML
         logger.info("Getting %s" % self.lp_wb_url())
-        r = requests.get(self.lp_wb_url(), stream=True, verify=False)
-        h = html.fromstring(r.content)
+        r = self.fetch_cache.get(self.lp_wb_url(), verify=False)
+        h = self.fetch_cache.parse_html(r)
         h.make_links_absolute(self.doc["landing_page_url"])
         logger.info("Looking for links...")
         # Attempt to find the nearest prior header:
@@ -192,7 +194,7 @@ class DocumentMDEx(object):
         # Start by grabbing the Link-rel-up header to refine the landing page url:
         # e.g. https://www.gov.uk/government/uploads/system/uploads/attachment_data/file/497662/accidents-involving-illegal-alcohol-levels-2014.pdf
         # Link: <https://www.gov.uk/government/statistics/reported-road-casualties-in-great-britain-estimates-involving-illegal-alcohol-levels-2014>; rel="up"
-        tries = 5
+        tries = self.tries
         success = False
         while tries > 0:
             r = requests.head(url=self.doc_wb_url(), allow_redirects=True)
@@ -204,7 +206,8 @@ class DocumentMDEx(object):
             else:
                 logger.info("Could not find 'up' relationship!")
                 tries -= 1
-                time.sleep(10)
+                if tries > 0:
+                    time.sleep(self.retry_wait)
         # Fail if we could not contact the API:
         if not success:
             self.doc['api_call_failed'] = "Could not find rel['up'] relationship."
@@ -217,12 +220,12 @@ class DocumentMDEx(object):
                 api_json_url = lp_url._replace( path="/api/content%s" % lp_url.path)
                 api_json_url = api_json_url.geturl()
                 logger.debug("Downloading and parsing from API: %s" % api_json_url)
-                r = requests.get(api_json_url)
+                r = self.fetch_cache.get(api_json_url)
                 if r.status_code != 200:
                     logger.warning("Got status code %s for URL %s" % (r.status_code, api_json_url))
                     logger.warning("Response: %s" % r.content)
                     raise Exception("Could not download the URL from the Content API!")
-                md = json.loads(r.content)
+                md = self.fetch_cache.parse_json(r)
                 self.doc['title'] = md['title']
                 self.doc['publication_date'] = md['first_published_at']
                 # Pick up the 'public updated' date instead, if present:
@@ -235,12 +238,12 @@ class DocumentMDEx(object):
             # Grab the landing page URL as HTML:
             # TODO This could all be pulled out of the Content API, if it's stable enough.
             logger.debug("Downloading and parsing: %s" % self.doc['landing_page_url'])
-            r = requests.get(self.lp_wb_url())
+            r = self.fetch_cache.get(self.lp_wb_url())
             if r.status_code != 200:
                 logger.warning("Got status code %s for URL %s" % (r.status_code, self.lp_wb_url()))
                 logger.warning("Response: %s" % r.content)
                 raise Exception("Could not download the landing page!")
-            h = html.fromstring(r.content)
+            h = self.fetch_cache.parse_html(r)
             # Attempt to extract resourse-level metadata (overriding publication-level metadata):
             # Look through landing page for links, find metadata section corresponding to the document:
             matches = 0
@@ -278,8 +281,8 @@ class DocumentMDEx(object):
                 self.mdex_default()
                 return
         # Grab the landing page URL as HTML
-        r = requests.get(self.lp_wb_url())
-        h = html.fromstring(r.content)
+        r = self.fetch_cache.get(self.lp_wb_url())
+        h = self.fetch_cache.parse_html(r)
         # Extract the metadata:
         self.doc['title'] = self._get0(h.xpath("//*[contains(@itemtype, 'http://schema.org/CreativeWork')]//*[contains(@itemprop,'name')]/text()")).strip()
         self.doc['publication_date'] = self._get0(h.xpath("//*[contains(@itemtype, 'http://schema.org/CreativeWork')]//*[contains(@itemprop,'datePublished')]/@content"))
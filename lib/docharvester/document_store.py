@@ -0,0 +1,295 @@
+'''
+An embedded, indexed store for the state of harvested documents.
+
+This replaces the one-file-per-document records that were kept under the 'documents' task-state folder. Each
+document is stored as a JSON record in an SQLite table, keyed on the document URL and indexed by host and status.
+An in-memory Bloom filter of all the stored URLs sits in front of the table, so most "have we seen this one?"
+checks for new documents never need to touch the database at all. The store may be written to by other processes
+(e.g. other luigi workers), so before the filter is trusted to say a URL is new, any rows added since it was loaded
+are added to it. Each process opens its own connection to the database, as SQLite connections must not be carried
+across a fork.
+'''
+
+import os
+import json
+import math
+import sqlite3
+import hashlib
+import logging
+import datetime
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger('luigi-interface')
+
+# Defaults for the Bloom filter:
+DEFAULT_BLOOM_CAPACITY = 1000000
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+
+# Number of URLs to look up in each query:
+QUERY_BATCH_SIZE = 500
+
+
+class BloomFilter(object):
+    '''
+    A simple Bloom filter over strings, using double hashing of an MD5 digest to derive the bit positions.
+    '''
+
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Standard sizing for the given capacity and false positive rate:
+        ln2 = math.log(2)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (ln2 * ln2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * ln2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+
+class DocumentStore(object):
+    '''
+    Stores the harvest state of documents, keyed on the document URL.
+
+    Safe to share between threads.
+    '''
+
+    def __init__(self, path, bloom_capacity=DEFAULT_BLOOM_CAPACITY):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._pid = None
+        self._conn = None
+        self._imported = False
+        conn = self.conn
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS documents (
+            url TEXT PRIMARY KEY,
+            host TEXT,
+            status TEXT,
+            updated TEXT,
+            record TEXT)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS documents_host ON documents (host)')
+        conn.execute('CREATE INDEX IF NOT EXISTS documents_status ON documents (status)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.commit()
+        self._build_bloom(bloom_capacity)
+
+    @property
+    def conn(self):
+        '''
+        The connection to the database for this process, which is opened when first used in each process.
+        '''
+        if self._pid != os.getpid():
+            # Anything inherited from the parent process can't be used, including a lock it might have held:
+            self._lock = threading.RLock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._data_version = None
+            self._pid = os.getpid()
+        return self._conn
+
+    def _build_bloom(self, capacity):
+        conn = self.conn
+        with self._lock:
+            size = len(self)
+            self.bloom = BloomFilter(max(capacity, 2 * size))
+            self._data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            self._max_rowid = 0
+            for (rowid, url) in conn.execute('SELECT rowid, url FROM documents'):
+                self.bloom.add(url)
+                self._max_rowid = max(self._max_rowid, rowid)
+        logger.info("Loaded Bloom filter for %i documents from %s" % (size, self.path))
+
+    def _refresh_bloom(self):
+        '''
+        Adds any URLs that have been stored by other connections since the Bloom filter was loaded.
+
+        Rows are never deleted (only replaced, by the same URL), and new rows always get a higher rowid, so only the
+        rows after the last one loaded need to be read.
+        '''
+        conn = self.conn
+        with self._lock:
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            for (rowid, url) in conn.execute('SELECT rowid, url FROM documents WHERE rowid > ?', (self._max_rowid,)):
+                self.bloom.add(url)
+                self._max_rowid = max(self._max_rowid, rowid)
+            if self.bloom.is_full():
+                self._build_bloom(2 * self.bloom.capacity)
+
+    def __len__(self):
+        conn = self.conn
+        with self._lock:
+            return conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def __contains__(self, url):
+        if url not in self.bloom:
+            # Only trust the Bloom filter once it's up to date:
+            self._refresh_bloom()
+            if url not in self.bloom:
+                return False
+        conn = self.conn
+        with self._lock:
+            return conn.execute('SELECT 1 FROM documents WHERE url = ?', (url,)).fetchone() is not None
+
+    def _row(self, doc):
+        url = doc['document_url']
+        updated = datetime.datetime.utcnow().isoformat() + 'Z'
+        return (url, urlparse(url).hostname, doc.get('status', None), updated, json.dumps(doc))
+
+    def put(self, doc):
+        '''
+        Adds or replaces the record for a document.
+        '''
+        self.put_all([doc])
+
+    def put_all(self, docs):
+        '''
+        Adds or replaces the records for many documents, in a single transaction.
+        '''
+        rows = [self._row(doc) for doc in docs]
+        conn = self.conn
+        with self._lock:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)', rows)
+            for row in rows:
+                self.bloom.add(row[0])
+            if self.bloom.is_full():
+                self._build_bloom(2 * self.bloom.capacity)
+
+    def get(self, url):
+        conn = self.conn
+        with self._lock:
+            row = conn.execute('SELECT record FROM documents WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def new_urls(self, urls):
+        '''
+        Returns the URLs that are not yet in the store, in the order given.
+
+        URLs that the (up to date) Bloom filter has definitely not seen are not looked up in the database.
+        '''
+        self._refresh_bloom()
+        maybe_seen = [url for url in set(urls) if url in self.bloom]
+        seen = set()
+        conn = self.conn
+        with self._lock:
+            for i in range(0, len(maybe_seen), QUERY_BATCH_SIZE):
+                batch = maybe_seen[i:i + QUERY_BATCH_SIZE]
+                query = 'SELECT url FROM documents WHERE url IN (%s)' % ','.join('?' * len(batch))
+                seen.update(url for (url,) in conn.execute(query, batch))
+        return [url for url in urls if url not in seen]
+
+    def records(self, host=None, status=None):
+        '''
+        Yields all the document records, optionally filtered by host and/or status.
+        '''
+        query = 'SELECT record FROM documents'
+        clauses = []
+        params = []
+        if host:
+            clauses.append('host = ?')
+            params.append(host)
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if clauses:
+            query = '%s WHERE %s' % (query, ' AND '.join(clauses))
+        # Use a separate connection, so writes can carry on while this is being read:
+        conn = sqlite3.connect(self.path)
+        try:
+            for (record,) in conn.execute(query, params):
+                yield json.loads(record)
+        finally:
+            conn.close()
+
+    def trackdb_items(self, **kwargs):
+        '''
+        Yields the records in the form used for 'documents' in TrackDB (see lib/trackdb/solr.py).
+        '''
+        for doc in self.records(**kwargs):
+            doc['id'] = 'document:document_url:%s' % doc['document_url']
+            doc['kind_s'] = 'documents'
+            yield doc
+
+    def import_state_files(self, folder, batch_size=1000):
+        '''
+        Imports the old one-file-per-document records, stored in 'documents-<host>' folders under the given folder.
+
+        :return: the number of records imported
+        '''
+        count = 0
+        batch = []
+        for de in os.scandir(folder):
+            if de.name.startswith('documents-') and de.is_dir():
+                for dee in os.scandir(de):
+                    if dee.is_file():
+                        with open(dee.path, 'rb') as f:
+                            batch.append(json.load(f))
+                        if len(batch) >= batch_size:
+                            self.put_all(batch)
+                            count += len(batch)
+                            batch = []
+        self.put_all(batch)
+        count += len(batch)
+        conn = self.conn
+        with self._lock:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('imported_state_files', folder))
+        return count
+
+    def state_files_imported(self):
+        '''
+        Whether the old one-file-per-document records have been imported (see import_state_files).
+        '''
+        if not self._imported:
+            conn = self.conn
+            with self._lock:
+                self._imported = conn.execute(
+                    "SELECT 1 FROM meta WHERE key = 'imported_state_files'").fetchone() is not None
+        return self._imported
+
+    def close(self):
+        if self._pid == os.getpid():
+            with self._lock:
+                self._conn.close()
+            self._pid = None
+
+
+# The stores opened by this process, so the Bloom filter is only built once:
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_document_store(path):
+    with _stores_lock:
+        store = _stores.get(path, None)
+        if store is None:
+            store = DocumentStore(path)
+            _stores[path] = store
+        return store
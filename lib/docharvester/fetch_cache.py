@@ -0,0 +1,275 @@
+'''
+A shared cache of fetched landing pages (and API responses) for document metadata extraction.
+
+Many documents share the same landing page, so pages are kept in a bounded in-memory LRU cache, along with
+the parsed HTML or JSON, and on disk so they can be re-used by later runs. Cached pages are re-used without
+checking for max_age seconds, after which they are re-validated using any ETag or Last-Modified headers, so
+unchanged pages are not downloaded again.
+
+Each page is stored on disk as a single file, holding a line of JSON metadata followed by the body, which is written
+to a temporary file and moved into place, so readers never see a partly-written page. When the files take up more
+than max_disk_bytes, the least recently used ones are removed.
+'''
+
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import requests
+from lxml import html
+
+logger = logging.getLogger('luigi-interface')
+
+# Defaults for the cache:
+DEFAULT_FETCH_CACHE_DIR = os.environ.get('MDEX_FETCH_CACHE_DIR', None)
+DEFAULT_FETCH_CACHE_SIZE = int(os.environ.get('MDEX_FETCH_CACHE_SIZE', 1000))
+DEFAULT_FETCH_CACHE_MAX_AGE = int(os.environ.get('MDEX_FETCH_CACHE_MAX_AGE', 3600))
+DEFAULT_FETCH_CACHE_DISK_SIZE = int(os.environ.get('MDEX_FETCH_CACHE_DISK_SIZE', 1024 * 1024 * 1024))
+
+# When the disk cache is over its size limit, remove the oldest pages until it's below this fraction of it:
+DISK_PRUNE_TARGET = 0.9
+
+
+class CachedResponse(object):
+    '''
+    The parts of a requests Response that are kept in the cache.
+    '''
+
+    def __init__(self, url, status_code, content, headers, fetched_at):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.fetched_at = fetched_at
+        # Parsed versions of the content, filled in when first needed:
+        self.tree = None
+        self.json = None
+
+    def validators(self):
+        headers = {}
+        if self.headers.get('etag', None):
+            headers['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified', None):
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+
+class FetchCache(object):
+    '''
+    A bounded LRU cache of fetched pages, backed by an optional on-disk cache, with hit/miss counters.
+    '''
+
+    def __init__(self, cache_dir=DEFAULT_FETCH_CACHE_DIR, max_entries=DEFAULT_FETCH_CACHE_SIZE,
+                 max_age=DEFAULT_FETCH_CACHE_MAX_AGE, session=None, max_disk_bytes=DEFAULT_FETCH_CACHE_DISK_SIZE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_disk_bytes = max_disk_bytes
+        self.session = session or requests.Session()
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_bytes = sum(size for path, mtime, size in self._disk_files())
+        self.stats = {
+            'hits': 0,
+            'disk_hits': 0,
+            'revalidated': 0,
+            'misses': 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _disk_path(self, url):
+        return os.path.join(self.cache_dir, "%s.page" % hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _disk_files(self):
+        '''
+        Lists the cached pages on disk, as (path, mtime, size) tuples.
+        '''
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.page'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry.path, stat.st_mtime, stat.st_size))
+        return files
+
+    def _prune_disk(self):
+        '''
+        Removes the least recently used pages until the disk cache is back under its size limit.
+        '''
+        with self._disk_lock:
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            # Re-scan, as other processes may be sharing the cache:
+            files = sorted(self._disk_files(), key=lambda f: f[1])
+            total = sum(size for path, mtime, size in files)
+            target = self.max_disk_bytes * DISK_PRUNE_TARGET
+            removed = 0
+            for path, mtime, size in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+                total -= size
+            self._disk_bytes = total
+            logger.info("Removed %i pages from the fetch cache, leaving %i bytes." % (removed, total))
+
+    def _from_memory(self, url):
+        with self._lock:
+            entry = self.entries.get(url, None)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def _from_disk(self, url):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(url)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                content = f.read()
+            # Mark it as recently used:
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return CachedResponse(url, meta['status_code'], content, meta['headers'], meta['fetched_at'])
+
+    def _remember(self, entry):
+        with self._lock:
+            self.entries[entry.url] = entry
+            self.entries.move_to_end(entry.url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _store(self, entry):
+        self._remember(entry)
+        if self.cache_dir:
+            path = self._disk_path(entry.url)
+            meta = json.dumps({
+                'url': entry.url,
+                'status_code': entry.status_code,
+                'headers': entry.headers,
+                'fetched_at': entry.fetched_at
+            })
+            # Write to a temporary file unique to this thread, and swap it in:
+            temp_path = "%s.%i.%i.temp" % (path, os.getpid(), threading.get_ident())
+            with open(temp_path, 'wb') as f:
+                f.write(meta.encode('utf-8'))
+                f.write(b'\n')
+                f.write(entry.content)
+                size = f.tell()
+            os.replace(temp_path, path)
+            with self._disk_lock:
+                self._disk_bytes += size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune_disk()
+
+    def get(self, url, **kwargs):
+        '''
+        Gets a URL, using the cached copy if it is still fresh or has not changed.
+
+        Only successful (200) responses are cached. Any other response is returned as-is.
+        '''
+        entry = self._from_memory(url)
+        from_disk = False
+        if entry is None:
+            entry = self._from_disk(url)
+            from_disk = entry is not None
+        if entry is not None and time.time() - entry.fetched_at < self.max_age:
+            if from_disk:
+                self._count('disk_hits')
+                self._remember(entry)
+            else:
+                self._count('hits')
+            return entry
+
+        # Fetch (or re-validate) the page:
+        headers = dict(kwargs.pop('headers', {}))
+        if entry is not None:
+            headers.update(entry.validators())
+        r = self.session.get(url, headers=headers, **kwargs)
+        if entry is not None and r.status_code == 304:
+            logger.debug("Cached copy of %s is still valid." % url)
+            self._count('revalidated')
+            entry.fetched_at = time.time()
+            self._store(entry)
+            return entry
+        self._count('misses')
+        if r.status_code != 200:
+            return r
+        entry = CachedResponse(url, r.status_code, r.content, {
+            'etag': r.headers.get('ETag', None),
+            'last-modified': r.headers.get('Last-Modified', None),
+            'content-type': r.headers.get('Content-Type', None),
+        }, time.time())
+        self._store(entry)
+        return entry
+
+    def parse_html(self, r):
+        '''
+        Parses a response as HTML, re-using the parsed tree for cached responses.
+
+        :return: a copy of the parsed tree, so callers are free to modify it
+        '''
+        if not isinstance(r, CachedResponse):
+            return html.fromstring(r.content)
+        if r.tree is None:
+            r.tree = html.fromstring(r.content)
+        return copy.deepcopy(r.tree)
+
+    def parse_json(self, r):
+        '''
+        Parses a response as JSON, re-using the parsed data for cached responses.
+        '''
+        if not isinstance(r, CachedResponse):
+            return json.loads(r.content)
+        if r.json is None:
+            r.json = json.loads(r.content)
+        return copy.deepcopy(r.json)
+
+    def hit_rate(self):
+        '''
+        The proportion of requests served without downloading the page again.
+        '''
+        with self._lock:
+            stats = dict(self.stats)
+        return self._hit_rate(stats)
+
+    def _hit_rate(self, stats):
+        total = sum(stats.values())
+        if total == 0:
+            return 0.0
+        return (total - stats['misses']) / total
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['hit_rate'] = round(self._hit_rate(stats), 3)
+        return stats
+
+
+# The cache shared by all document metadata extractors in this process:
+_shared_cache = None
+
+
+def get_fetch_cache():
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = FetchCache()
+    return _shared_cache
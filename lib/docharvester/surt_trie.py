@@ -0,0 +1,109 @@
+'''
+A prefix trie of SURTs, for quickly finding which watched prefixes (e.g. the seeds of Watched Targets) match a URL.
+
+Matching gives exactly the same results as checking surt.startswith(prefix) against every prefix, but the time
+taken depends on the length of the SURT being looked up, rather than on the number of prefixes.
+'''
+
+import re
+import logging
+from lib.surt import url_to_surt
+
+logger = logging.getLogger('luigi-interface')
+
+# SURTs are split into tokens, each ending with one of these delimiters (except perhaps the last one):
+SURT_TOKEN = re.compile(r'[^,)/]*[,)/]|[^,)/]+$')
+
+
+class _Node(object):
+    __slots__ = ['children', 'values', 'partials']
+
+    def __init__(self):
+        self.children = {}
+        # Values for prefixes that end exactly here:
+        self.values = []
+        # Values for prefixes that end part-way through the next token, keyed on that part of the token, and kept
+        # in order of length, shortest first:
+        self.partials = {}
+
+
+class SurtPrefixTrie(object):
+    '''
+    Maps SURT prefixes to values, and finds all the values whose prefixes match a given SURT.
+    '''
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, prefix, value):
+        '''
+        Adds a SURT prefix, and the value to return when it matches.
+        '''
+        tokens = SURT_TOKEN.findall(prefix)
+        partial = None
+        if tokens and tokens[-1][-1] not in ',)/':
+            partial = tokens.pop()
+        node = self.root
+        for token in tokens:
+            child = node.children.get(token, None)
+            if child is None:
+                child = _Node()
+                node.children[token] = child
+            node = child
+        if partial is None:
+            node.values.append(value)
+        elif partial in node.partials:
+            node.partials[partial].append(value)
+        else:
+            node.partials[partial] = [value]
+            node.partials = dict(sorted(node.partials.items(), key=lambda item: len(item[0])))
+        self.size += 1
+
+    def matches(self, surt):
+        '''
+        Returns the values for all the prefixes of the given SURT, shortest prefix first.
+        '''
+        results = []
+        node = self.root
+        for token in SURT_TOKEN.findall(surt):
+            results.extend(node.values)
+            for partial, values in node.partials.items():
+                if token.startswith(partial):
+                    results.extend(values)
+            node = node.children.get(token, None)
+            if node is None:
+                return results
+        results.extend(node.values)
+        return results
+
+    def matches_url(self, url, host_only=False):
+        return self.matches(url_to_surt(url, host_only=host_only))
+
+
+# The last target list and trie built, so the trie is only built once when the same list is passed in repeatedly:
+_watched_cache = (None, None)
+
+
+def watched_targets_trie(targets):
+    '''
+    Builds a trie that maps the host-level SURTs of the seeds of all Watched Targets to the index of the Target
+    in the given list.
+
+    The trie is cached, and re-used if the same list (i.e. the same object) is passed in again.
+    '''
+    global _watched_cache
+    cached_targets, cached_trie = _watched_cache
+    if cached_targets is targets:
+        return cached_trie
+    trie = SurtPrefixTrie()
+    for i, t in enumerate(targets):
+        if t['watched']:
+            for seed in t['seeds']:
+                trie.add(url_to_surt(seed, host_only=True), i)
+    logger.info("Built SURT prefix trie for %i watched seeds." % len(trie))
+    _watched_cache = (targets, trie)
+    return trie
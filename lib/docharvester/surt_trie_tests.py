@@ -0,0 +1,28 @@
+from lib.docharvester.surt_trie import SurtPrefixTrie
+
+
+def test_matches_shortest_first():
+    trie = SurtPrefixTrie()
+    # Prefixes ending part-way through a token, added longest first:
+    trie.add('http://(uk,gov,abc', 'LONG')
+    trie.add('http://(uk,gov,ab', 'SHORT')
+    trie.add('http://(uk,gov,', 'HOST')
+    trie.add('http://(uk,gov,abcdef,)/', 'LONGEST')
+    trie.add('http://(uk,', 'UK')
+    assert trie.matches('http://(uk,gov,abcdef,)/page') == ['UK', 'HOST', 'SHORT', 'LONG', 'LONGEST']
+    assert trie.matches('http://(uk,gov,abd,)/') == ['UK', 'HOST', 'SHORT']
+    assert trie.matches('http://(uk,org,)/') == ['UK']
+    assert len(trie) == 5
+
+
+def test_matches_same_as_startswith():
+    prefixes = ['http://(uk,', 'http://(uk,gov,', 'http://(uk,gov,a', 'http://(uk,gov,abc,)/', 'http://(uk,gov,abc,)/x',
+                'http://(uk,gov,abc,)/xy/', 'http://(uk,gov,ab', 'http://(uk,co,', 'http://(uk,gov,abc,)/x']
+    trie = SurtPrefixTrie()
+    for i, prefix in enumerate(prefixes):
+        trie.add(prefix, i)
+    for surt in ['http://(uk,gov,abc,)/xy/z', 'http://(uk,gov,abd,)/', 'http://(uk,co,bbc,)/', 'http://(com,a,)/',
+                 'http://(uk,gov,abc,)/x', 'http://(uk,gov,a']:
+        expected = sorted((i for i, prefix in enumerate(prefixes) if surt.startswith(prefix)),
+                          key=lambda i: (len(prefixes[i]), i))
+        assert trie.matches(surt) == expected
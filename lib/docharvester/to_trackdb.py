@@ -27,10 +27,15 @@ and the kind just `document`.
 
 The implementation can be moved to TrackDB, which can then use the `status` flag to track processing.
 
+The document harvester now keeps these records in a single DocumentStore (see document_store.py), so the old files
+can be imported into a store using `to_store`, and a whole store can be streamed into TrackDB using `store_to_trackdb`.
+
 '''
 
 import json
 import os
+from lib.docharvester.document_store import DocumentStore
+from lib.trackdb.solr import SolrTrackDB
 
 def to_json():
     for de in os.scandir('/mnt/gluster/ingest/task-state/documents/'):
@@ -41,3 +46,16 @@ def to_json():
                         item = json.load(f)
                         print(json.dumps(item))
 
+
+def to_store(store_path, folder='/mnt/gluster/ingest/task-state/documents/'):
+    store = DocumentStore(store_path)
+    count = store.import_state_files(folder)
+    print("Imported %i document records into %s" % (count, store_path))
+    store.close()
+
+
+def store_to_trackdb(store_path, trackdb_url):
+    store = DocumentStore(store_path)
+    # Stream the records straight out of the store and into TrackDB, in batches:
+    SolrTrackDB(trackdb_url, kind='documents').import_jsonl(store.trackdb_items())
+    store.close()
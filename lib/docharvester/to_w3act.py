@@ -64,13 +64,20 @@ import time
 from urlparse import urlparse
 import requests
 from requests.utils import quote
-import xml.dom.minidom
+from xml.etree import ElementTree
+from multiprocessing.pool import ThreadPool
 
 from crawl.dex.document_mdex import DocumentMDEx
 
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
+# How many Wayback lookups to run at once, and how long to remember the results (in seconds):
+AVAILABILITY_WORKERS = 8
+AVAILABILITY_TTL = 300
+
+_availability_cache = {}
+
 
 
 def document_available(wayback_url, url, ts):
@@ -113,23 +120,65 @@ def document_available(wayback_url, url, ts):
 </wayback>
 
     """
+    return documents_available(wayback_url, [(url, ts)])[(url, ts)]
+
+
+def _capture_dates(args):
+    wayback_url, url = args
     try:
         wburl = '%s/xmlquery.jsp?type=urlquery&url=%s' % (wayback_url, quote(url))
         logger.debug("Checking %s" % wburl);
-        r = requests.get(wburl)
+        r = requests.get(wburl, stream=True)
         logger.debug("Response: %d" % r.status_code)
-        # Is it known, with a matching timestamp?
         if r.status_code == 200:
-            dom = xml.dom.minidom.parseString(r.text)
-            for de in dom.getElementsByTagName('capturedate'):
-                if de.firstChild.nodeValue == ts:
-                    # Excellent, it's been found:
-                    return True
+            r.raw.decode_content = True
+            dates = set()
+            for event, elem in ElementTree.iterparse(r.raw):
+                if elem.tag == 'capturedate':
+                    dates.add((elem.text or '').strip())
+                elif elem.tag == 'result':
+                    elem.clear()
+            return url, dates
     except Exception as e:
-        logger.error( "%s [%s %s]" % ( str( e ), url, ts ) )
+        logger.error( "%s [%s]" % ( str( e ), url ) )
         logger.exception(e)
-    # Otherwise:
-    return False
+    # Lookup failed, so don't cache the result:
+    return url, None
+
+
+def documents_available(wayback_url, captures, workers=AVAILABILITY_WORKERS):
+    """
+    Checks a batch of (url, ts) captures at once, looking up each distinct URL only once, a few at a time.
+
+    Results are cached for AVAILABILITY_TTL seconds, so retried messages do not query Wayback again.
+
+    Returns a dict mapping each (url, ts) pair to True if it's in Wayback.
+    """
+    now = time.time()
+    results = {}
+    to_lookup = set()
+    for url, ts in captures:
+        entry = _availability_cache.get((wayback_url, url, ts), None)
+        if entry is not None and now - entry[1] < AVAILABILITY_TTL:
+            results[(url, ts)] = entry[0]
+        else:
+            to_lookup.add(url)
+    if to_lookup:
+        pool = ThreadPool(min(workers, len(to_lookup)))
+        try:
+            found = dict(pool.map(_capture_dates, [(wayback_url, url) for url in to_lookup]))
+        finally:
+            pool.close()
+        for url, ts in captures:
+            if url in found:
+                available = found[url] is not None and ts in found[url]
+                results[(url, ts)] = available
+                if found[url] is not None:
+                    _availability_cache[(wayback_url, url, ts)] = (available, now)
+    # Drop old entries:
+    for key in [key for key, entry in _availability_cache.items() if now - entry[1] >= AVAILABILITY_TTL]:
+        del _availability_cache[key]
+    return results
 
 
 def send_document_to_w3act(cl, wayback_url, act):
@@ -1,15 +1,20 @@
 import os
 import re
+import argparse
 import math
 import json
 import time
 import socket
+import threading
 import requests
-from prometheus_client import start_http_server
+from collections import deque
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from prometheus_client.exposition import MetricsHandler
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
 import logging
 from hapy import hapy
-from multiprocessing import Pool, Process
 
 # Avoid warnings about certs.
 import urllib3
@@ -26,14 +31,253 @@ socket.setdefaulttimeout(TIMEOUT)
 # Config file:
 CRAWL_JOBS_FILE = os.environ.get("CRAWL_JOBS_FILE", '../../dash/crawl-jobs-localhost-test.json')
 
+# How long to cache the results of DNS service discovery (seconds), and how many lookups to run at once:
+DISCOVERY_TTL = int(os.environ.get("DISCOVERY_TTL", 60))
+DNS_WORKERS = int(os.environ.get("DNS_WORKERS", 10))
+
+# Number of crawlers to talk to at once, and how often to refresh the metrics in the background (seconds):
+COLLECTOR_WORKERS = int(os.environ.get("COLLECTOR_WORKERS", 20))
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 15))
+
+# Crawler actions (e.g. checkpoint) are run using a separate pool, by default on this many crawlers at once:
+ACTION_WORKERS = int(os.environ.get("ACTION_WORKERS", 50))
+ACTION_CONCURRENCY = int(os.environ.get("ACTION_CONCURRENCY", 10))
+
+# How long each crawler has to respond during a refresh (seconds), before its last-known values are used instead:
+SCRAPE_DEADLINE = int(os.environ.get("SCRAPE_DEADLINE", 12))
+
+# How long to wait for crawler actions (seconds). Actions like checkpointing can take a long time, so by default
+# there is no limit:
+ACTION_DEADLINE = int(os.environ["ACTION_DEADLINE"]) if os.environ.get("ACTION_DEADLINE") else None
+
+# How many failures in a row before a crawler is no longer polled, and how long to wait before probing it again:
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 3))
+BREAKER_RESET_TIMEOUT = int(os.environ.get("BREAKER_RESET_TIMEOUT", 60))
+
+# How many recent samples to keep for each job, for working out rates:
+RATE_WINDOW = int(os.environ.get("RATE_WINDOW", 20))
+
+# Port to serve the metrics (and the recent series, as JSON) on:
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9118))
+
+
+class CircuitBreaker(object):
+    '''
+    Tracks whether a crawler is responding, so crawlers that keep failing are not polled on every refresh.
+
+    The breaker starts 'closed'. After max_failures failures in a row it 'opens', and the crawler is left alone.
+    Once reset_timeout seconds have passed, the breaker goes 'half-open' and allows a single probe. If the probe
+    succeeds the breaker closes again, otherwise it re-opens.
+    '''
+
+    def __init__(self, max_failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+
+    def allow_request(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+            self.state = 'half-open'
+            return True
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.max_failures:
+            if self.state != 'open':
+                logger.warning("Opening circuit breaker after %i failures." % self.failures)
+            self.state = 'open'
+            self.opened_at = time.time()
+
+
+class SessionHapy(hapy.Hapy):
+    '''
+    A Hapy client that re-uses a single requests Session, so connections to the crawler are kept alive between
+    calls rather than being set up afresh (including the digest authentication handshake) for every request.
+    '''
+
+    def __init__(self, base_url, username=None, password=None, insecure=True, timeout=None):
+        super(SessionHapy, self).__init__(base_url, username=username, password=password, insecure=insecure,
+                                          timeout=timeout)
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.verify = not self.insecure
+
+    def _check(self, r, code):
+        self.lastresponse = r
+        if r.status_code != code:
+            raise hapy.HapyException(r)
+        return r
+
+    def _http_post(self, url, data, code=200):
+        r = self.session.post(url=url, data=data, headers=hapy.HEADERS, allow_redirects=False, timeout=self.timeout)
+        return self._check(r, code)
+
+    def _http_get(self, url, code=200):
+        r = self.session.get(url=url, headers=hapy.HEADERS, timeout=self.timeout)
+        return self._check(r, code)
+
+    def _http_put(self, url, data, code=200):
+        r = self.session.put(url=url, data=data, headers=hapy.HEADERS, timeout=self.timeout)
+        return self._check(r, code)
+
+    def get_kafka_report(self, job_name):
+        url = '%s/job/%s/report/KafkaUrlReceiverReport' % (self.base_url, job_name)
+        r = self.session.get(url=url, timeout=self.timeout)
+        # Don't parse an error page as a report:
+        return self._check(r, 200).text
+
+
+def job_sample(job, timestamp):
+    '''
+    Picks out the cumulative counters that rates are derived from.
+    '''
+    ji = job['state'].get('details', {}).get('job', {})
+    utr = ji.get('uriTotalsReport', {}) or {}
+    stl = ji.get('sizeTotalsReport', {}) or {}
+    downloaded = utr.get('downloadedUriCount', 0.0)
+    queued = utr.get('queuedUriCount', None)
+    if queued is None:
+        queued = utr.get('totalUriCount', 0.0) - downloaded
+    return {
+        'timestamp': timestamp,
+        'downloaded': float(downloaded),
+        'novel_bytes': float(stl.get('novel', 0.0)),
+        'queued': float(queued),
+        'kafka_partitions': dict(job.get('kafka_partitions', {})),
+    }
+
+
+class JobHistory(object):
+    '''
+    A ring buffer of the recent samples for one crawl job.
+
+    Rates are worked out between the last two samples ('instant') and across the whole buffer ('smoothed').
+    Counters that go backwards (e.g. because the crawler was restarted) are treated as resets, and no rate is given.
+    '''
+
+    def __init__(self, size=RATE_WINDOW):
+        self.samples = deque(maxlen=size)
+
+    def add(self, sample):
+        # Ignore repeats of the same sample (e.g. last-known values):
+        if len(self.samples) > 0 and self.samples[-1]['timestamp'] >= sample['timestamp']:
+            return
+        self.samples.append(sample)
+
+    def _rate(self, first, last, value, monotonic=True):
+        elapsed = last['timestamp'] - first['timestamp']
+        if elapsed <= 0:
+            return None
+        delta = value(last) - value(first)
+        if monotonic and delta < 0:
+            return None
+        return delta / elapsed
+
+    def _rates(self, first, last):
+        rates = {
+            'uris-downloaded': self._rate(first, last, lambda s: s['downloaded']),
+            'bytes-novel': self._rate(first, last, lambda s: s['novel_bytes']),
+            # Positive when the queues are going down:
+            'queue-drain': self._rate(first, last, lambda s: -s['queued'], monotonic=False),
+        }
+        rates['kafka-partitions'] = {}
+        for p in last['kafka_partitions']:
+            if p in first['kafka_partitions']:
+                rates['kafka-partitions'][p] = self._rate(first, last, lambda s: s['kafka_partitions'][p])
+        return rates
+
+    def rates(self):
+        '''
+        :return: a dict of the rates for each window, empty until there are enough samples.
+        '''
+        if len(self.samples) < 2:
+            return {}
+        return {
+            'instant': self._rates(self.samples[-2], self.samples[-1]),
+            'smoothed': self._rates(self.samples[0], self.samples[-1]),
+        }
+
 
 class Heritrix3Collector(object):
+    '''
+    Collects metrics from a set of Heritrix3 crawlers.
+
+    Uses a long-lived pool of threads and one keep-alive client per crawler. If the background refresher is
+    started, the crawlers are polled every refresh_interval seconds and collect() serves the cached metrics,
+    so Prometheus scrapes do not wait on the crawlers.
+
+    Each crawler has to respond within the deadline, timed from when its requests get a thread rather than from
+    when they were queued. Crawlers that do not are reported using their last-known values, labelled as stale, and
+    crawlers that keep failing are only probed occasionally (see CircuitBreaker).
+    '''
+
+    def __init__(self, workers=COLLECTOR_WORKERS, refresh_interval=REFRESH_INTERVAL, deadline=SCRAPE_DEADLINE,
+                 discovery_ttl=DISCOVERY_TTL):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.action_executor = ThreadPoolExecutor(max_workers=ACTION_WORKERS)
+        # Service discovery, with the config and DNS results cached:
+        self.dns_executor = ThreadPoolExecutor(max_workers=DNS_WORKERS)
+        self.discovery_ttl = discovery_ttl
+        self.discovery_duration = None
+        self._discovery_lock = threading.Lock()
+        self._config = None
+        self._config_mtime = None
+        self._dns_cache = {}
+        self.refresh_interval = refresh_interval
+        self.deadline = deadline
+        # Per-crawler circuit breakers, requests still outstanding from earlier refreshes, and last-known results:
+        self.breakers = {}
+        self.in_flight = {}
+        self.last_known = {}
+        # Recent samples for each job:
+        self.history = {}
+        # Keep-alive clients, keyed on server URL:
+        self.clients = {}
+        self._clients_lock = threading.Lock()
+        # The cached results of the last refresh:
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.services = None
+        self.metrics = None
+        self.last_refresh = None
+        self.last_refresh_duration = None
+        self.last_discovery_duration = None
+        # The background refresher:
+        self._refresher = None
+        self._stop = threading.Event()
 
-    def __init__(self):
-        self.pool = Pool(20)
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.pool.close()
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._refresher:
+            self._refresher.join()
+        self.executor.shutdown(wait=True)
+        self.action_executor.shutdown(wait=True)
+        self.dns_executor.shutdown(wait=True)
+
+    def get_client(self, server_url):
+        with self._clients_lock:
+            if server_url not in self.clients:
+                server_user = os.getenv('HERITRIX_USERNAME', "admin")
+                server_pass = os.getenv('HERITRIX_PASSWORD', "heritrix")
+                self.clients[server_url] = SessionHapy(server_url, username=server_user, password=server_pass,
+                                                       timeout=TIMEOUT)
+            return self.clients[server_url]
 
     def load_as_json(self, filename):
         script_dir = os.path.dirname(__file__)
@@ -41,82 +285,169 @@ class Heritrix3Collector(object):
         with open(file_path, 'r') as fi:
             return json.load(fi)
 
+    def load_config(self):
+        '''
+        Loads the crawl jobs config file, but only re-reads it if it has been modified since it was last read.
+        '''
+        file_path = os.path.join(os.path.dirname(__file__), CRAWL_JOBS_FILE)
+        mtime = os.path.getmtime(file_path)
+        with self._discovery_lock:
+            if self._config is None or mtime != self._config_mtime:
+                logger.info("Loading crawl jobs config from %s" % file_path)
+                self._config = self.load_as_json(file_path)
+                self._config_mtime = mtime
+                # The discovered services may have changed too:
+                self._dns_cache = {}
+            return self._config
+
+    def _reverse_lookup(self, job, ip):
+        # Make a copy of the dict to put the values in:
+        dns_job = dict(job)
+        # Default to using the IP address:
+        dns_host = ip
+        dns_job['id'] = '%s:%s' % (dns_job['id'], ip)
+        # Find the IP-level hostname via reverse lookup:
+        try:
+            (r_hostname, r_aliaslist, r_ipaddrlist) = socket.gethostbyaddr(ip)
+            # look for a domain alias that matches the expected form:
+            for r_alias in r_aliaslist:
+                if r_alias.startswith(job['dns_sd_name']):
+                    # Use this instead of the raw IP:
+                    dns_host = r_alias
+                    dns_job['id'] = r_alias
+                    break
+        except (socket.herror, socket.gaierror) as e:
+            logger.warning("Reverse lookup failed for %s: %s" % (ip, e))
+        # Set the URL:
+        dns_job['url'] = 'https://%s:8443/' % dns_host
+        return dns_job
+
+    def discover(self, job):
+        '''
+        Uses DNS to discover the services for a DNS Service Discovery entry, caching the results for discovery_ttl seconds.
+        '''
+        # DNS SD under Docker uses this form of naming to discover services:
+        dns_name = 'tasks.%s' % job['dns_sd_name']
+        with self._discovery_lock:
+            cached = self._dns_cache.get(dns_name, None)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        #
+        # WARNING Under 'alpine' builds this only ever returned 12 or less entries!
+        #
+        try:
+            # Look up service IP addresses via DNS:
+            (hostname, alias, ipaddrlist) = socket.gethostbyname_ex(dns_name)
+            logger.debug("For %s got (%s,%s,%s)" % (dns_name, hostname, alias, ipaddrlist))
+        except socket.gaierror as e:
+            logger.warning("Lookup failed for %s: %s" % (dns_name, e))
+            return []
+        # Do the reverse lookups in parallel:
+        dns_jobs = list(self.dns_executor.map(lambda ip: self._reverse_lookup(job, ip), ipaddrlist))
+        with self._discovery_lock:
+            self._dns_cache[dns_name] = (time.time() + self.discovery_ttl, dns_jobs)
+        return dns_jobs
+
     def lookup_services(self):
+        started_at = time.time()
         # Load the config file:
-        service_list = self.load_as_json(os.path.join(os.path.dirname(__file__), CRAWL_JOBS_FILE))
+        service_list = self.load_config()
 
         # Find the services. If there are any DNS Service Discovery entries, filter them out.
+        # (copies are used, as the job dicts get modified later on)
         services = []
         dns_sd = []
         for job in service_list:
             if 'dns_sd_name' in job:
                 dns_sd.append(job)
             else:
-                services.append(job)
+                services.append(dict(job))
 
         # For each DNS SD entry, use DNS to discover the service:
         for job in dns_sd:
-            # DNS SD under Docker uses this form of naming to discover services:
-            dns_name = 'tasks.%s' % job['dns_sd_name']
-            #
-            # WARNING Under 'alpine' builds this only ever returned 12 or less entries!
-            #
-            try:
-                # Look up service IP addresses via DNS:
-                (hostname, alias, ipaddrlist) = socket.gethostbyname_ex(dns_name)
-                for ip in ipaddrlist:
-                    logger.debug("For %s got (%s,%s,%s)" % (dns_name, hostname, alias, ipaddrlist))
-                    # Make a copy of the dict to put the values in:
-                    dns_job = dict(job)
-                    # Default to using the IP address:
-                    dns_host = ip
-                    dns_job['id'] = '%s:%s' % (dns_job['id'], ip)
-                    # Find the IP-level hostname via reverse lookup:
-                    (r_hostname, r_aliaslist, r_ipaddrlist) = socket.gethostbyaddr(ip)
-                    # look for a domain alias that matches the expected form:
-                    for r_alias in r_aliaslist:
-                        if r_alias.startswith(job['dns_sd_name']):
-                            # Use this instead of the raw IP:
-                            dns_host = r_alias
-                            dns_job['id'] = r_alias
-                            break
-                    # Set the URL:
-                    dns_job['url'] = 'https://%s:8443/' % dns_host
-                    # Remember:
-                    services.append(dns_job)
-            except socket.gaierror as e:
-                print(e)
-                pass
+            for dns_job in self.discover(job):
+                services.append(dict(dns_job))
 
+        self.discovery_duration = time.time() - started_at
         return services
 
-    def do(self, action):
+    def _job_args(self, job):
+        logger.debug("Looking up %s" % job)
+        server_url = job['url']
+        server_user = os.getenv('HERITRIX_USERNAME', "admin")
+        server_pass = os.getenv('HERITRIX_PASSWORD', "heritrix")
+        return (job['id'], job['job_name'], server_url, server_user, server_pass)
+
+    def run_action(self, action, max_concurrent=ACTION_CONCURRENCY, stagger=0.0, deadline=None, ids=None):
+        '''
+        Runs an action on all the crawlers, and yields the result for each crawler as soon as it completes.
+
+        e.g. to checkpoint ten crawlers at a time, starting one every two seconds:
+
+            for job in collector.run_action('checkpoint', max_concurrent=10, stagger=2.0):
+                print(job['id'], job['state'])
+
+        :param action: the action to run (see do_h3_action)
+        :param max_concurrent: the maximum number of crawlers to run the action on at once
+        :param stagger: the minimum time between starting the action on one crawler and the next (seconds)
+        :param deadline: if set, stop waiting after this many seconds, and report the crawlers that have not finished
+        :param ids: if set, only run the action on the crawlers with these IDs
+        :return: yields each job, with the outcome in job['state']
+        '''
         # Find the list of Heritrixen to talk to
         services = self.lookup_services()
+        if ids is not None:
+            services = [job for job in services if job['id'] in ids]
+        services = sorted(services, key=lambda k: k['id'])
 
-        # Parallel check for H3 job status:
-        argsv = []
-        for job in services:
-            logger.debug("Looking up %s" % job)
-            server_url = job['url']
-            server_user = os.getenv('HERITRIX_USERNAME', "admin")
-            server_pass = os.getenv('HERITRIX_PASSWORD', "heritrix")
-            # app.logger.info(json.dumps(server, indent=4))
-            argsv.append((job['id'], job['job_name'], server_url, server_user, server_pass, action))
-        # Wait for all...
-        result_list = self.pool.map(do_h3_action, argsv)
-        self.pool.terminate()
-        self.pool.join()
-        # Collect:
-        results = {}
-        for job, status in result_list:
-            results[job] = status
-
-        # Merge the results in:
-        for job in services:
-            job['state'] = results[job['id']]
-            if not job['url']:
-                job['state']['status'] = "LOOKUP FAILED"
+        started_at = time.time()
+        next_start = started_at
+        to_start = list(services)
+        running = {}
+        while to_start or running:
+            # Start as many as we are allowed to:
+            now = time.time()
+            while to_start and len(running) < max_concurrent and now >= next_start:
+                job = to_start.pop(0)
+                logger.info("Requesting %s on %s" % (action, job['id']))
+                args = self._job_args(job) + (action,)
+                running[self.action_executor.submit(do_h3_action, args, self.get_client(job['url']))] = job
+                next_start = now + stagger
+
+            # Work out how long to wait for:
+            timeout = None
+            if to_start and len(running) < max_concurrent:
+                timeout = max(next_start - now, 0)
+            if deadline is not None:
+                remaining = max(started_at + deadline - now, 0)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            # Yield whatever has finished, or if nothing is running, wait until the next one can be started:
+            if running:
+                done, not_done = wait(list(running.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+                done = []
+            for future in done:
+                job = running.pop(future)
+                job_id, job['state'] = future.result()
+                if not job['url']:
+                    job['state']['status'] = "LOOKUP FAILED"
+                yield job
+
+            # Give up on the rest if we have run out of time:
+            if deadline is not None and time.time() >= started_at + deadline:
+                for job in running.values():
+                    job['state'] = { 'error': "No response within %s seconds, the action may still complete." % deadline }
+                    yield job
+                for job in to_start:
+                    job['state'] = { 'error': "Action not started within %s seconds." % deadline }
+                    yield job
+                return
+
+    def do(self, action):
+        # Run on all crawlers at once, waiting for them to finish (the scrape deadline does not apply to actions):
+        services = list(self.run_action(action, max_concurrent=ACTION_WORKERS, deadline=ACTION_DEADLINE))
 
         # Sort services by ID:
         services = sorted(services, key=lambda k: k['id'])
@@ -131,22 +462,12 @@ class Heritrix3Collector(object):
         partitions = {}
         consumed = 0
         for h in services:
-            kr = h['state'].get('message','')
-            h_partitions = {}
-            h_consumed = 0
-            for line in kr.split('\n'):
-                if "partition: " in line:
-                    line = line.replace("  partition: ", "")
-                    line = line.replace(" offset: ", "")
-                    p, o = line.split(',')
-                    p = int(p)
-                    o = int(o)
-                    if p in partitions and partitions[p] < o:
-                        logger.warning("Same partition appears in multiple reports! partition:%i" % p)
-                    h_partitions[p] = o
-                    h_consumed += o
-                    partitions[p] = o
-                    consumed += o
+            h_partitions, h_consumed = parse_kafka_report(h['state'].get('message',''))
+            for p, o in h_partitions.items():
+                if p in partitions and partitions[p] < o:
+                    logger.warning("Same partition appears in multiple reports! partition:%i" % p)
+                partitions[p] = o
+            consumed += h_consumed
             # Add to this service:
             h['kafka_consumed'] = h_consumed
             h['kafka_partitions'] = h_partitions
@@ -161,99 +482,249 @@ class Heritrix3Collector(object):
         # Find the list of Heritrixen to talk to
         services = self.lookup_services()
 
-        # Parallel check for H3 job status:
-        argsv = []
-        for job in services:
-            logger.debug("Looking up %s" % job)
-            server_url = job['url']
-            server_user = os.getenv('HERITRIX_USERNAME', "admin")
-            server_pass = os.getenv('HERITRIX_PASSWORD', "heritrix")
-            # app.logger.info(json.dumps(server, indent=4))
-            argsv.append((job['id'], job['job_name'], server_url, server_user, server_pass))
-        # Wait for all...
-        result_list = self.pool.map(get_h3_status, argsv)
-        self.pool.terminate()
-        self.pool.join()
-        # Collect:
-        results = {}
-        for job, status in result_list:
-            results[job] = status
-
-        # Merge the results in:
+        # Fetch the job status and the KafkaReport from every crawler in one parallel fan-out, noting when each
+        # request actually starts:
+        polled = {}
+        started = {}
         for job in services:
-            job['state'] = results[job['id']]
-            if not job['url']:
-                job['state']['status'] = "LOOKUP FAILED"
+            breaker = self.breakers.setdefault(job['id'], CircuitBreaker())
+            if job['id'] in self.in_flight:
+                # Do not pile up requests on a crawler that still has not answered an earlier refresh:
+                if not all(f.done() for f in self.in_flight[job['id']]):
+                    continue
+                del self.in_flight[job['id']]
+            if not breaker.allow_request():
+                continue
+            args = self._job_args(job)
+            h = self.get_client(job['url'])
+            polled[job['id']] = (
+                self.executor.submit(_timed, started, (job['id'], 0), get_h3_status, args, h),
+                self.executor.submit(_timed, started, (job['id'], 1), do_h3_action, args + ('kafka-report',), h)
+            )
 
-        # Also get the KafkaReport:
-        kafka_results = Heritrix3Collector().do('kafka-report')
-        for h in services:
-            for k in kafka_results['services']:
-                if h['url'] == k['url']:
-                    h['kafka_consumed'] = k['kafka_consumed']
-                    h['kafka_partitions'] = k['kafka_partitions']
+        self._wait_for_requests(polled, started)
+
+        # Merge the results in, falling back on the last-known values where necessary:
+        results = []
+        for job in services:
+            breaker = self.breakers[job['id']]
+            if job['id'] not in polled:
+                if job['id'] in self.in_flight:
+                    breaker.record_failure()
+                    job = self._stale(job, "Still waiting on an earlier request.")
+                else:
+                    job = self._stale(job, "Circuit breaker is open.")
+            elif not all(f.done() for f in polled[job['id']]):
+                self.in_flight[job['id']] = polled[job['id']]
+                now = time.time()
+                if any(not f.done() and now - started.get((job['id'], i), now) >= self.deadline
+                       for i, f in enumerate(polled[job['id']])):
+                    breaker.record_failure()
+                    job = self._stale(job, "No response within %i seconds." % self.deadline)
+                else:
+                    # Not the crawler's fault, so don't count it against the circuit breaker:
+                    job = self._stale(job, "Request not started, as too many crawlers are being polled at once.")
+            else:
+                status_future, kafka_future = polled[job['id']]
+                job_id, job['state'] = status_future.result()
+                if not job['url']:
+                    job['state']['status'] = "LOOKUP FAILED"
+                job_id, kafka_state = kafka_future.result()
+                job['kafka_partitions'], job['kafka_consumed'] = parse_kafka_report(kafka_state.get('message', ''))
+                if job['state'].get('status', None) in ["DOWN", "LOOKUP FAILED"]:
+                    breaker.record_failure()
+                    # Keep the last-known values, but remember the crawler was down:
+                    if job['id'] in self.last_known:
+                        last = self.last_known[job['id']]
+                        self.last_known[job['id']] = dict(last, state=dict(last['state'], status=job['state']['status']))
+                else:
+                    breaker.record_success()
+                    self.last_known[job['id']] = dict(job)
+                    with self._lock:
+                        history = self.history.setdefault(job['id'], JobHistory())
+                        history.add(job_sample(job, time.time()))
+                job['stale'] = False
+            job['circuit'] = breaker.state
+            if job['id'] in self.history:
+                job['rates'] = self.history[job['id']].rates()
+            results.append(job)
+        services = results
 
         # Sort services by ID:
         services = sorted(services, key=lambda k: k['id'])
 
         return services
 
+    def _wait_for_requests(self, polled, started):
+        '''
+        Waits until each request has finished, or has been running for the deadline. Requests that are still
+        queued for a thread are waited for until twice the deadline has passed.
+        '''
+        given_up_at = time.time() + 2 * self.deadline
+        pending = dict(((job_id, i), f) for job_id, fs in polled.items() for i, f in enumerate(fs))
+        while True:
+            pending = dict((key, f) for key, f in pending.items() if not f.done())
+            now = time.time()
+            timeouts = []
+            for key in pending:
+                if key in started:
+                    timeouts.append(started[key] + self.deadline - now)
+                else:
+                    timeouts.append(given_up_at - now)
+            timeouts = [timeout for timeout in timeouts if timeout > 0]
+            if not timeouts:
+                return
+            wait(list(pending.values()), timeout=min(timeouts), return_when=FIRST_COMPLETED)
+
+    def _stale(self, job, reason):
+        if job['id'] in self.last_known:
+            job = dict(self.last_known[job['id']])
+        else:
+            job['state'] = { 'status': "DOWN" }
+        job['stale'] = True
+        job['state'] = dict(job['state'], error=reason)
+        return job
+
+    def refresh(self):
+        '''
+        Polls all the crawlers, and updates the cached services and metrics.
+        '''
+        with self._refresh_lock:
+            started_at = time.time()
+            services = self.run_api_requests()
+            metrics = list(self._filter(self._collect(services)))
+            with self._lock:
+                self.services = services
+                self.metrics = metrics
+                self.last_refresh = time.time()
+                self.last_refresh_duration = self.last_refresh - started_at
+                self.last_discovery_duration = self.discovery_duration
+        logger.info("Refreshed metrics for %i crawlers in %.2f seconds." % (len(services), self.last_refresh_duration))
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception("Exception while refreshing metrics! %s" % e)
+
+    def start(self):
+        '''
+        Does an initial refresh, then starts refreshing in the background every refresh_interval seconds.
+        '''
+        self.refresh()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="heritrix3-collector-refresh", daemon=True)
+        self._refresher.start()
+
     def collect(self):
-        for m in self._collect():
+        # Without the background refresher, poll the crawlers now:
+        if self._refresher is None:
+            self.refresh()
+        with self._lock:
+            metrics = self.metrics
+            last_refresh = self.last_refresh
+            last_refresh_duration = self.last_refresh_duration
+            discovery_duration = self.last_discovery_duration
+
+        yield from metrics
+
+        m_refresh = GaugeMetricFamily(
+            'heritrix3_collector_refresh_seconds',
+            'Time taken to poll all the Heritrix3 crawlers, and when it last happened',
+            labels=["kind"]) # No hyphens in label names please!
+        m_refresh.add_metric(['duration'], float(last_refresh_duration))
+        m_refresh.add_metric(['last-refresh-timestamp'], float(last_refresh))
+        yield m_refresh
+
+        m_discovery = GaugeMetricFamily(
+            'heritrix3_collector_discovery_seconds',
+            'Time taken to find the Heritrix3 crawlers (config and DNS service discovery) during the last refresh')
+        m_discovery.add_metric([], float(discovery_duration))
+        yield m_discovery
+
+    def series(self):
+        '''
+        Returns the recent samples and the current rates for every job, e.g. for dashboards.
+        '''
+        with self._lock:
+            return {
+                job_id: {
+                    'samples': list(history.samples),
+                    'rates': history.rates(),
+                } for job_id, history in self.history.items()
+            }
+
+    def _filter(self, metrics):
+        for m in metrics:
             filtered = []
             for s in m.samples:
-                name, labels, value = s
-                if not isinstance(value, float):
-                    logger.warning("This sample is not a float! %s, %s, %s" % (name, labels, value))
+                if not isinstance(s.value, float):
+                    logger.warning("This sample is not a float! %s, %s, %s" % (s.name, s.labels, s.value))
                 else:
                     filtered.append(s)
-                m.samples = filtered
+            m.samples = filtered
             yield m
 
-    def _collect(self):
-        # type: () -> Generator[GaugeMetricFamily]
+    def _collect(self, result=None):
+        # type: (list) -> Generator[GaugeMetricFamily]
 
         m_uri_down = GaugeMetricFamily(
             'heritrix3_crawl_job_uris_downloaded_total',
             'Total URIs downloaded by a Heritrix3 crawl job',
-            labels=["jobname", "deployment", "status", "id"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "status", "id", "stale"]) # No hyphens in label names please!
 
         m_uri_known = GaugeMetricFamily(
             'heritrix3_crawl_job_uris_known_total',
             'Total URIs discovered by a Heritrix3 crawl job',
-            labels=["jobname", "deployment", "status", "id"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "status", "id", "stale"]) # No hyphens in label names please!
 
         m_uris = GaugeMetricFamily(
             'heritrix3_crawl_job_uris_total',
             'URI counters from a Heritrix3 crawl job, labeled by kind',
-            labels=["jobname", "deployment", "id", "kind"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "kind", "stale"]) # No hyphens in label names please!
 
         m_bytes = GaugeMetricFamily(
             'heritrix3_crawl_job_bytes_total',
             'Byte counters from a Heritrix3 crawl job, labeled by kind',
-            labels=["jobname", "deployment", "id", "kind"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "kind", "stale"]) # No hyphens in label names please!
 
         m_qs = GaugeMetricFamily(
             'heritrix3_crawl_job_queues_total',
             'Queue counters from a Heritrix3 crawl job, labeled by kind',
-            labels=["jobname", "deployment", "id", "kind"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "kind", "stale"]) # No hyphens in label names please!
 
         m_ts = GaugeMetricFamily(
             'heritrix3_crawl_job_threads_total',
             'Thread counters from a Heritrix3 crawl job, labeled by kind',
-            labels=["jobname", "deployment", "id", "kind"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "kind", "stale"]) # No hyphens in label names please!
 
         m_kc = GaugeMetricFamily(
             'kafka_consumer_offset',
             'Kafka partition offsets, indicating messages consumed by client.',
-            labels=["jobname", "deployment", "id", "partition"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "partition", "stale"]) # No hyphens in label names please!
 
         m_kt = GaugeMetricFamily(
             'kafka_consumer_offset_total',
             'Kafka total offset, indicating messages consumed by client.',
-            labels=["jobname", "deployment", "id"]) # No hyphens in label names please!
+            labels=["jobname", "deployment", "id", "stale"]) # No hyphens in label names please!
+
+        m_rate = GaugeMetricFamily(
+            'heritrix3_crawl_job_rate',
+            'Rates derived from the recent samples of a Heritrix3 crawl job (per second), labeled by kind and window',
+            labels=["jobname", "deployment", "id", "kind", "window", "stale"]) # No hyphens in label names please!
+
+        m_kr = GaugeMetricFamily(
+            'kafka_consumer_rate',
+            'Kafka partition consumption rate (messages per second), by window',
+            labels=["jobname", "deployment", "id", "partition", "window", "stale"]) # No hyphens in label names please!
 
-        result = self.run_api_requests()
+        m_cb = GaugeMetricFamily(
+            'heritrix3_crawler_circuit_state',
+            'State of the circuit breaker for each Heritrix3 crawler (closed, open or half-open)',
+            labels=["jobname", "deployment", "id", "state"]) # No hyphens in label names please!
+
+        if result is None:
+            result = self.run_api_requests()
 
         for job in result:
             #print(json.dumps(job))
@@ -263,6 +734,9 @@ class Heritrix3Collector(object):
             deployment = job['deployment']
             state = job['state'] or {}
             status = state['status'] or None
+            stale = 'true' if job.get('stale', False) else 'false'
+            if 'circuit' in job:
+                m_cb.add_metric([name, deployment, id, job['circuit']], 1.0)
 
             # Get the URI metrics
             try:
@@ -273,96 +747,105 @@ class Heritrix3Collector(object):
                     utr = {}
                 docs_total = utr.get('downloadedUriCount', 0.0)
                 known_total = utr.get('totalUriCount', 0.0)
-                m_uri_down.add_metric([name, deployment, status, id], float(docs_total))
-                m_uri_known.add_metric([name, deployment, status, id], float(known_total))
+                m_uri_down.add_metric([name, deployment, status, id, stale], float(docs_total))
+                m_uri_known.add_metric([name, deployment, status, id, stale], float(known_total))
                 # New-style metrics:
-                m_uris.add_metric([name, deployment, id, 'downloaded'], float(docs_total))
-                m_uris.add_metric([name, deployment, id, 'queued'], float(known_total))
-                m_uris.add_metric([name, deployment, id, 'novel'],
+                m_uris.add_metric([name, deployment, id, 'downloaded', stale], float(docs_total))
+                m_uris.add_metric([name, deployment, id, 'queued', stale], float(known_total))
+                m_uris.add_metric([name, deployment, id, 'novel', stale],
                           float(ji.get('sizeTotalsReport', {}).get('novelCount', 0.0)))
-                m_uris.add_metric([name, deployment, id, 'deduplicated'],
+                m_uris.add_metric([name, deployment, id, 'deduplicated', stale],
                           float(ji.get('sizeTotalsReport', {}).get('dupByHashCount', 0.0)))
                 if ji.get('loadReport', {}) is not None:
-                    m_uris.add_metric([name, deployment, id, 'deepest-queue-depth'],
+                    m_uris.add_metric([name, deployment, id, 'deepest-queue-depth', stale],
                               ji.get('loadReport', {}).get('deepestQueueDepth', 0.0))
-                    m_uris.add_metric([name, deployment, id, 'average-queue-depth'],
+                    m_uris.add_metric([name, deployment, id, 'average-queue-depth', stale],
                               ji.get('loadReport', {}).get('averageQueueDepth', 0.0))
 
                 # Bytes:
-                m_bytes.add_metric([name, deployment, id, 'novel'],
+                m_bytes.add_metric([name, deployment, id, 'novel', stale],
                           float(ji.get('sizeTotalsReport', {}).get('novel', 0.0)))
-                m_bytes.add_metric([name, deployment, id, 'deduplicated'],
+                m_bytes.add_metric([name, deployment, id, 'deduplicated', stale],
                           float(ji.get('sizeTotalsReport', {}).get('dupByHash', 0.0)))
-                m_bytes.add_metric([name, deployment, id, 'warc-novel-content'],
+                m_bytes.add_metric([name, deployment, id, 'warc-novel-content', stale],
                           float(ji.get('sizeTotalsReport', {}).get('warcNovelContentBytes', 0.0)))
 
                 # Queues:
                 if ji.get('frontierReport', {}) is not None:
-                    m_qs.add_metric([name, deployment, id, 'total'],
+                    m_qs.add_metric([name, deployment, id, 'total', stale],
                               ji.get('frontierReport', {}).get('totalQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'in-process'],
+                    m_qs.add_metric([name, deployment, id, 'in-process', stale],
                               ji.get('frontierReport', {}).get('inProcessQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'ready'],
+                    m_qs.add_metric([name, deployment, id, 'ready', stale],
                               ji.get('frontierReport', {}).get('readyQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'snoozed'],
+                    m_qs.add_metric([name, deployment, id, 'snoozed', stale],
                               ji.get('frontierReport', {}).get('snoozedQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'active'],
+                    m_qs.add_metric([name, deployment, id, 'active', stale],
                               ji.get('frontierReport', {}).get('activeQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'inactive'],
+                    m_qs.add_metric([name, deployment, id, 'inactive', stale],
                               ji.get('frontierReport', {}).get('inactiveQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'ineligible'],
+                    m_qs.add_metric([name, deployment, id, 'ineligible', stale],
                               ji.get('frontierReport', {}).get('ineligibleQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'retired'],
+                    m_qs.add_metric([name, deployment, id, 'retired', stale],
                               ji.get('frontierReport', {}).get('retiredQueues', 0.0))
-                    m_qs.add_metric([name, deployment, id, 'exhausted'],
+                    m_qs.add_metric([name, deployment, id, 'exhausted', stale],
                               ji.get('frontierReport', {}).get('exhaustedQueues', 0.0))
 
                 # Threads:
                 if ji.get('loadReport', {}) is not None:
-                    m_ts.add_metric([name, deployment, id, 'total'],
+                    m_ts.add_metric([name, deployment, id, 'total', stale],
                               ji.get('loadReport', {}).get('totalThreads', 0.0))
-                    m_ts.add_metric([name, deployment, id, 'busy'],
+                    m_ts.add_metric([name, deployment, id, 'busy', stale],
                               ji.get('loadReport', {}).get('busyThreads', 0.0))
                     # Congestion ratio can be literal 'null':
                     congestion = ji.get('loadReport', {}).get('congestionRatio', 0.0)
                     if congestion is not None:
-                        m_ts.add_metric([name, deployment, id, 'congestion-ratio'], congestion)
+                        m_ts.add_metric([name, deployment, id, 'congestion-ratio', stale], congestion)
                 if ji.get('threadReport', {}) is not None:
-                    m_ts.add_metric([name, deployment, id, 'toe-count'],
+                    m_ts.add_metric([name, deployment, id, 'toe-count', stale],
                               ji.get('threadReport', {}).get('toeCount', 0.0))
                     # Thread Steps (could be an array or just one entry):
                     steps = ji.get('threadReport', {}).get('steps', {})
                     if steps is not None:
                         steps = steps.get('value',[])
-                        if isinstance(steps, basestring):
+                        if isinstance(steps, str):
                             steps = [steps]
                         for step_value in steps:
                             splut = re.split(' ', step_value, maxsplit=1)
                             if len(splut) == 2:
                                 count, step = splut
                                 step = "step-%s" % step.lower()
-                                m_ts.add_metric([name, deployment, id, step], float(int(count)))
+                                m_ts.add_metric([name, deployment, id, step, stale], float(int(count)))
                             else:
                                 logger.warning("Could not handle step value: %s" % step_value)
                     # Thread Processors (could be an array or just one entry):
                     procs = ji.get('threadReport', {}).get('processors', {})
                     if procs is not None:
                         procs = procs.get('value',[])
-                        if isinstance(procs, basestring):
+                        if isinstance(procs, str):
                             procs = [procs]
                         for proc_value in procs:
                             splut = re.split(' ', proc_value, maxsplit=1)
                             if len(splut) == 2:
                                 count, proc = splut
                                 proc = "processor-%s" % proc.lower()
-                                m_ts.add_metric([name, deployment, id, proc], float(count))
+                                m_ts.add_metric([name, deployment, id, proc, stale], float(count))
                             else:
                                 logger.warning("Could not handle processor value: '%s'" % proc_value)
 
                 # Store Kafka offsets
                 for p in job.get('kafka_partitions', {}):
-                    m_kc.add_metric([name, deployment, id, str(p)], float(job['kafka_partitions'][p]))
-                m_kt.add_metric([name, deployment, id], float(job.get('kafka_consumed', 0)))
+                    m_kc.add_metric([name, deployment, id, str(p), stale], float(job['kafka_partitions'][p]))
+                m_kt.add_metric([name, deployment, id, stale], float(job.get('kafka_consumed', 0)))
+
+                # Derived rates:
+                for window, rates in job.get('rates', {}).items():
+                    for kind in ['uris-downloaded', 'bytes-novel', 'queue-drain']:
+                        if rates[kind] is not None:
+                            m_rate.add_metric([name, deployment, id, kind, window, stale], float(rates[kind]))
+                    for p, rate in rates['kafka-partitions'].items():
+                        if rate is not None:
+                            m_kr.add_metric([name, deployment, id, str(p), window, stale], float(rate))
 
             except Exception as e:
                 logger.exception("Exception while parsing metrics!")
@@ -377,6 +860,9 @@ class Heritrix3Collector(object):
         yield m_ts
         yield m_kc
         yield m_kt
+        yield m_rate
+        yield m_kr
+        yield m_cb
 
 
 def dict_values_to_floats(d, k, excluding=list()):
@@ -388,10 +874,35 @@ def dict_values_to_floats(d, k, excluding=list()):
                     d[k][sk] = None
 
 
-def get_h3_status(args):
+def parse_kafka_report(report):
+    '''
+    Extracts the partition offsets from a KafkaUrlReceiverReport.
+
+    :return: a dict of partition to offset, and the total offset
+    '''
+    partitions = {}
+    consumed = 0
+    for line in report.split('\n'):
+        if "partition: " in line:
+            line = line.replace("  partition: ", "")
+            line = line.replace(" offset: ", "")
+            p, o = line.split(',')
+            partitions[int(p)] = int(o)
+            consumed += int(o)
+    return partitions, consumed
+
+
+def _timed(started, key, fn, *args):
+    # Records when a request is taken off the queue and started:
+    started[key] = time.time()
+    return fn(*args)
+
+
+def get_h3_status(args, h=None):
     job_id, job_name, server_url, server_user, server_pass = args
-    # Set up connection to H3:
-    h = hapy.Hapy(server_url, username=server_user, password=server_pass, timeout=TIMEOUT)
+    # Set up connection to H3, unless a client is supplied:
+    if h is None:
+        h = SessionHapy(server_url, username=server_user, password=server_pass, timeout=TIMEOUT)
     state = {}
     try:
         logger.info("Getting status for job %s on %s" % (job_name, server_url))
@@ -419,10 +930,11 @@ def get_h3_status(args):
     return job_id, state
 
 
-def do_h3_action(args):
+def do_h3_action(args, h=None):
     job_id, job_name, server_url, server_user, server_pass, action = args
-    # Set up connection to H3:
-    h = hapy.Hapy(server_url, username=server_user, password=server_pass, timeout=TIMEOUT)
+    # Set up connection to H3, unless a client is supplied:
+    if h is None:
+        h = SessionHapy(server_url, username=server_user, password=server_pass, timeout=TIMEOUT)
     state = {}
     try:
         if action == 'pause':
@@ -453,14 +965,8 @@ def do_h3_action(args):
             state['message'] = "Requested termination of job %s on server %s." % (job_name, server_url)
         elif action == 'kafka-report':
             logger.info("Requesting KafkaReport from job %s on server %s." % (job_name, server_url))
-            url = '%s/job/%s/report/KafkaUrlReceiverReport' % (h.base_url, job_name)
-            r = requests.get(
-                url=url,
-                auth=h.auth,
-                verify=not h.insecure,
-                timeout=h.timeout
-            )
-            state['message'] = "Requested Kafka Report of job %s on server %s:\n%s" % (job_name, server_url, r.content)
+            report = h.get_kafka_report(job_name)
+            state['message'] = "Requested Kafka Report of job %s on server %s:\n%s" % (job_name, server_url, report)
         else:
             logger.warning("Unrecognised crawler action! '%s'" % action)
             state['error'] = "Unrecognised crawler action! '%s'" % action
@@ -473,10 +979,54 @@ def do_h3_action(args):
     return job_id, state
 
 
+class CollectorHandler(MetricsHandler):
+    '''
+    Serves the Prometheus metrics as usual, plus the recent series for each job as JSON, at /series
+    '''
+    collector = None
+
+    def do_GET(self):
+        if urlparse(self.path).path.rstrip('/') == '/series':
+            output = json.dumps(self.collector.series(), indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+        else:
+            super(CollectorHandler, self).do_GET()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='collector',
+                                     description='Serve Heritrix3 metrics, or run an action on all the crawlers.')
+    parser.add_argument('action', nargs='?',
+                        choices=['pause', 'unpause', 'launch', 'resume', 'checkpoint', 'terminate', 'kafka-report'],
+                        help='Action to run on all the crawlers. If not set, the metrics are served instead.')
+    parser.add_argument('-c', '--max-concurrent', type=int, default=ACTION_CONCURRENCY,
+                        help='Maximum number of crawlers to run the action on at once [default: %(default)s]')
+    parser.add_argument('-s', '--stagger', type=float, default=0.0,
+                        help='Seconds to wait between starting the action on each crawler [default: %(default)s]')
+    parser.add_argument('-i', '--id', action='append', dest='ids',
+                        help='Only run the action on the crawler with this ID (can be repeated).')
+    args = parser.parse_args()
+
+    collector = Heritrix3Collector()
+    if args.action:
+        # Print each result as soon as it comes in:
+        for job in collector.run_action(args.action, max_concurrent=args.max_concurrent, stagger=args.stagger,
+                                        ids=args.ids):
+            print(json.dumps({ 'id': job['id'], 'url': job['url'], 'state': job['state'] }), flush=True)
+        collector.close()
+    else:
+        collector.start()
+        REGISTRY.register(collector)
+        CollectorHandler.collector = collector
+        ThreadingHTTPServer(('', METRICS_PORT), CollectorHandler).serve_forever()
+
+
 if __name__ == "__main__":
-    REGISTRY.register(Heritrix3Collector())
-    start_http_server(9118)
-    while True: time.sleep(1)
+    main()
 
 
 # https://localhost:8443/engine/job/frequent/report/KafkaUrlReceiverReport
\ No newline at end of file
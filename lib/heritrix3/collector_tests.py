@@ -0,0 +1,131 @@
+import time
+import threading
+from lib.heritrix3 import collector
+from lib.heritrix3.collector import Heritrix3Collector, CircuitBreaker
+
+
+class FakeCrawler(object):
+    '''
+    Stands in for the Heritrix3 client of one crawler, answering after an optional delay, or failing.
+    '''
+
+    def __init__(self, downloaded=100):
+        self.downloaded = downloaded
+        self.delay = 0
+        self.fail = False
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append((name, time.time()))
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail:
+            raise Exception("Connection refused")
+
+    def get_job_info(self, job_name):
+        self._call('get_job_info')
+        return { 'job': {
+            'crawlControllerState': 'RUNNING',
+            'uriTotalsReport': { 'downloadedUriCount': self.downloaded, 'totalUriCount': 2 * self.downloaded },
+        } }
+
+    def get_kafka_report(self, job_name):
+        self._call('get_kafka_report')
+        return "  partition: 0, offset: %i\n" % self.downloaded
+
+    def checkpoint_job(self, job_name):
+        self._call('checkpoint_job')
+
+
+def _collector(crawlers, **kwargs):
+    c = Heritrix3Collector(**kwargs)
+    services = []
+    for i, crawler in enumerate(crawlers):
+        url = 'https://crawler-%i:8443/' % i
+        c.clients[url] = crawler
+        services.append({ 'id': 'crawler-%i' % i, 'job_name': 'frequent', 'deployment': 'test', 'url': url })
+    c.lookup_services = lambda: [dict(job) for job in services]
+    return c
+
+
+def _by_id(services):
+    return dict((job['id'], job) for job in services)
+
+
+def test_breaker_trips_and_resets():
+    crawler = FakeCrawler()
+    with _collector([crawler], deadline=2) as c:
+        c.breakers['crawler-0'] = CircuitBreaker(max_failures=2, reset_timeout=0.5)
+        crawler.fail = True
+        for i in range(2):
+            job = _by_id(c.run_api_requests())['crawler-0']
+            assert job['state']['status'] == 'DOWN'
+        assert job['circuit'] == 'open'
+
+        # Left alone while the breaker is open:
+        calls = len(crawler.calls)
+        job = _by_id(c.run_api_requests())['crawler-0']
+        assert job['stale']
+        assert job['state']['error'] == "Circuit breaker is open."
+        assert len(crawler.calls) == calls
+
+        # Probed again once the reset timeout has passed, closing the breaker if it answers:
+        crawler.fail = False
+        time.sleep(0.5)
+        job = _by_id(c.run_api_requests())['crawler-0']
+        assert len(crawler.calls) > calls
+        assert not job['stale']
+        assert job['state']['status'] == 'RUNNING'
+        assert job['circuit'] == 'closed'
+
+
+def test_missed_deadline_gives_stale_values():
+    slow, fast = FakeCrawler(downloaded=100), FakeCrawler(downloaded=200)
+    with _collector([slow, fast], deadline=1) as c:
+        c.refresh()
+        slow.delay = 2
+        slow.downloaded = 150
+        started_at = time.time()
+        c.refresh()
+        assert time.time() - started_at < 2
+        services = _by_id(c.services)
+        assert services['crawler-0']['stale']
+        assert services['crawler-0']['state']['error'] == "No response within 1 seconds."
+        assert c.breakers['crawler-0'].failures == 1
+        assert not services['crawler-1']['stale']
+
+        # The metrics carry the last-known values, labelled as stale:
+        samples = [s for m in c.metrics for s in m.samples if s.name == 'heritrix3_crawl_job_uris_total'
+                   and s.labels['kind'] == 'downloaded']
+        values = dict((s.labels['id'], (s.value, s.labels['stale'])) for s in samples)
+        assert values == { 'crawler-0': (100.0, 'true'), 'crawler-1': (200.0, 'false') }
+
+
+def test_queued_requests_are_not_misses():
+    # More crawlers than threads, all answering within the deadline once they get a thread:
+    crawlers = [FakeCrawler() for i in range(4)]
+    for crawler in crawlers:
+        crawler.delay = 0.4
+    with _collector(crawlers, workers=2, deadline=1) as c:
+        services = c.run_api_requests()
+        assert [job['stale'] for job in services] == [False] * 4
+        assert [c.breakers[job['id']].failures for job in services] == [0] * 4
+
+
+def test_action_stagger(monkeypatch):
+    crawlers = [FakeCrawler() for i in range(4)]
+    # Count the waits, so a loop that spins while waiting for the next start time would show up:
+    waits = []
+    wait = collector.wait
+    monkeypatch.setattr(collector, 'wait', lambda *args, **kwargs: waits.append(1) or wait(*args, **kwargs))
+    with _collector(crawlers) as c:
+        started_at = time.time()
+        results = list(c.run_action('checkpoint', max_concurrent=2, stagger=0.3))
+        assert sorted(job['id'] for job in results) == ['crawler-%i' % i for i in range(4)]
+        assert time.time() - started_at >= 0.9
+        starts = sorted(t for crawler in crawlers for name, t in crawler.calls)
+        for previous, start in zip(starts, starts[1:]):
+            assert start - previous >= 0.29
+        assert len(waits) < 20
@@ -7,7 +7,7 @@ import sys
 import json
 import logging
 import argparse
-from lib.store.webhdfs import WebHDFSStore
+from lib.store.webhdfs import WebHDFSStore, DEFAULT_WEBHDFS, DEFAULT_WEBHDFS_USER
 from lib.store.nominet import ingest_from_nominet
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s: %(levelname)s - %(name)s - %(message)s')
@@ -17,8 +17,6 @@ logger = logging.getLogger(__name__)
 # Defaults to using the production HDFS (via 'safe' gateway):
 # TODO Switch to a variable store URI for different backends.
 DEFAULT_STORE = os.environ.get("STORE_URI", "webhdfs://access@hdfs.api.wa.bl.uk/")
-DEFAULT_WEBHDFS = os.environ.get("WEBHDFS_URL", "http://hdfs.api.wa.bl.uk/")
-DEFAULT_WEBHDFS_USER = os.environ.get("WEBHDFS_USERNAME", "access")
 
 # Fields to output in the CSV version:
 CSV_FIELDNAMES =  ['permissions_s', 'hdfs_replicas_i', 'hdfs_user_s', 'hdfs_group_s', 'file_size_l', 'modified_at_dt', 'file_path_s']
@@ -15,6 +15,30 @@ file_list_headers = ['permissions', 'number_of_replicas', 'userid', 'groupid', '
 def ts_to_iso_date(t):
     return datetime.datetime.utcfromtimestamp(t).isoformat(timespec='milliseconds')
 
+def warc_path_for_log(log_path, warc_filename, kind='warcs'):
+    """
+    Given the HDFS path of a crawl log, and the name of a WARC file written during the same crawl,
+    work out where that WARC file should be stored, following the HDFS layout conventions below.
+
+    :param log_path: the full HDFS path of the crawl log
+    :param warc_filename: the WARC file name, as recorded in the crawl log
+    :param kind: the kind of output folder the WARC is stored in, i.e. 'warcs' or 'viral'
+    :return: the full HDFS path of the WARC, or None if the log path is not recognised
+    """
+    # npld-2018 layout, /heritrix/output/<job>/<launch>/logs/...
+    m = re.search('^(/heritrix/output/[a-z\-0-9]+/[0-9]{12,14}[^/]*)/logs/[^/]+$', log_path)
+    if m:
+        return '%s/%s/%s' % (m.group(1), kind, warc_filename)
+    # npld-2013 layout, /heritrix/output/logs/<job>-<launch>/...
+    m = re.search('^/heritrix/output/logs/([^/]+)/[^/]+$', log_path)
+    if m:
+        return '/heritrix/output/%s/%s/%s' % (kind, m.group(1), warc_filename)
+    # npld-2018-project layout, /1_data/npld/<stream>/<job>/logs/...
+    m = re.search('^(/1_data/npld/[a-z\-_0-9]+/[a-z\-_0-9]+)/logs/[^/]+$', log_path)
+    if m:
+        return '%s/%s/%s' % (m.group(1), kind, warc_filename)
+    return None
+
 class HdfsPathParser(object):
     """
     This class takes a HDFS file path and determines what, if any, crawl it belongs to, etc.
@@ -14,8 +14,8 @@ import posixpath as psp
 from hdfs import InsecureClient
 from lib.store.hdfs_layout import HdfsPathParser
 
-DEFAULT_WEBHDFS = "http://hdfs.api.wa.bl.uk/"
-DEFAULT_WEBHDFS_USER = "access"
+DEFAULT_WEBHDFS = os.environ.get("WEBHDFS_URL", "http://hdfs.api.wa.bl.uk/")
+DEFAULT_WEBHDFS_USER = os.environ.get("WEBHDFS_USERNAME", "access")
 
 HDFS_ID_PREFIX = "hdfs://hdfs:54310"
 
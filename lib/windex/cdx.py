@@ -1,37 +1,182 @@
 import logging
+import datetime
+from array import array
 import requests
+from surt import surt
 
 logger = logging.getLogger(__name__)
 
-class CDX11():    
+# The fields of a CDX11 line, in order:
+CDX11_FIELDS = ('urlkey', 'timestamp', 'original', 'mimetype', 'statuscode',
+    'digest', 'redirecturl', 'robotflags', 'length', 'offset', 'filename')
+
+# Fields that hold integers (n.b. these can be '-' if unknown):
+CDX11_INT_FIELDS = ('statuscode', 'length', 'offset')
+
+
+def _to_int(value):
+    if value == '-' or value == '':
+        return None
+    return int(value)
+
+
+class CDX11(object):
+    '''
+    A single CDX11 record.
+
+    Only the raw line is kept, and it is only split into fields when one of them is asked for, so records are
+    small and fast to create. Numeric and date values are only parsed when asked for too.
+    '''
+    __slots__ = ('line', '_fields')
+
     def __init__(self, line):
-        self.urlkey, self.timestamp, self.original, self.mimetype, self.statuscode, \
-        self.digest, self.redirecturl, self.robotflags, self.length, self.offset, self.filename = line.split(' ')
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if line.count(' ') != 10:
+            raise ValueError("Expected 11 fields in CDX line, got %i: %s" % (line.count(' ') + 1, line))
+        self.line = line
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.line.split(' ')
+        return self._fields
+
+    urlkey = property(lambda self: self.fields[0])
+    timestamp = property(lambda self: self.fields[1])
+    original = property(lambda self: self.fields[2])
+    mimetype = property(lambda self: self.fields[3])
+    statuscode = property(lambda self: self.fields[4])
+    digest = property(lambda self: self.fields[5])
+    redirecturl = property(lambda self: self.fields[6])
+    robotflags = property(lambda self: self.fields[7])
+    length = property(lambda self: self.fields[8])
+    offset = property(lambda self: self.fields[9])
+    filename = property(lambda self: self.fields[10])
 
     def __str__(self):
-        return ' '.join([self.urlkey, self.timestamp, self.original, self.mimetype, self.statuscode, \
-        self.digest, self.redirecturl, self.robotflags, self.length, self.offset, self.filename])
-    
+        return self.line
+
+    def __repr__(self):
+        return 'CDX11(%r)' % str(self)
+
     @property
     def crawl_date(self):
-        return datetime.strptime(self.timestamp, '%Y%m%d%H%M%S')
-    
+        ts = self.timestamp
+        return datetime.datetime(int(ts[0:4]), int(ts[4:6]), int(ts[6:8]), int(ts[8:10]), int(ts[10:12]), int(ts[12:14]))
+
+    @property
+    def status_int(self):
+        return _to_int(self.statuscode)
+
+    @property
+    def length_int(self):
+        return _to_int(self.length)
+
+    @property
+    def offset_int(self):
+        return _to_int(self.offset)
+
     def to_dict(self):
+        urlkey, timestamp, original, mimetype, statuscode, digest, redirecturl, robotflags, length, offset, \
+            filename = self.fields
         return {
-            'urlkey': self.urlkey,
-            'timestamp': self.timestamp, 
+            'urlkey': urlkey,
+            'timestamp': timestamp,
             'crawl_date': self.crawl_date,
-            'original': self.original,
-            'mimetype': self.mimetype,
-            'statuscode': self.statuscode,
-            'digest': self.digest, 
-            'redirecturl': self.redirecturl, 
-            'robotflags': self.robotflags, 
-            'length': int(self.length), 
-            'offset': int(self.offset), 
-            'filename': self.filename
+            'original': original,
+            'mimetype': mimetype,
+            'statuscode': statuscode,
+            'digest': digest,
+            'redirecturl': redirecturl,
+            'robotflags': robotflags,
+            'length': _to_int(length),
+            'offset': _to_int(offset),
+            'filename': filename
         }
 
+
+def to_cdx11_line(url, timestamp, mimetype, statuscode, digest, redirecturl, length, offset, filename, urlkey=None):
+    '''
+    Formats a CDX11 line, generating the SURT-form URL key if needed.
+    '''
+    if urlkey is None:
+        try:
+            urlkey = surt(url)
+        except Exception as e:
+            logger.warning("Could not generate SURT for %s: %s" % (url, e))
+            urlkey = url
+    fields = [urlkey, timestamp, url, mimetype, statuscode, digest, redirecturl, '-', length, offset, filename]
+    # Spaces would break the CDX line format:
+    return ' '.join(str(f).replace(' ', '%20') for f in fields)
+
+
+def _cdx_lines(reader):
+    # Skip blank lines and any ' CDX ...' header line:
+    for line in reader:
+        if line and not line.startswith(b' CDX') and not line.isspace():
+            yield line
+
+
+def iter_cdx11(reader):
+    '''
+    Parses a stream of CDX11 lines.
+
+    :param reader: a binary file-like object, or any iterable of lines as bytes
+    :return: yields CDX11 records
+    '''
+    for line in _cdx_lines(reader):
+        yield CDX11(line)
+
+
+def iter_cdx11_columns(reader, fields=CDX11_FIELDS, batch_size=100000):
+    '''
+    Parses a stream of CDX11 lines into column-oriented batches, which is much more compact than one
+    object per line when only a few fields are needed.
+
+    Integer fields are returned as arrays of signed 64-bit integers, using -1 for unknown ('-') values.
+    All other fields are returned as lists of strings.
+
+    :param reader: a binary file-like object, or any iterable of lines as bytes
+    :param fields: the names of the fields to return
+    :param batch_size: the number of lines per batch
+    :return: yields dicts mapping each field name to a column of values
+    '''
+    indexes = [CDX11_FIELDS.index(f) for f in fields]
+    def new_batch():
+        batch = {}
+        for f in fields:
+            if f in CDX11_INT_FIELDS:
+                batch[f] = array('q')
+            else:
+                batch[f] = []
+        return batch
+    batch = new_batch()
+    appenders = [(batch[f].append, i, f in CDX11_INT_FIELDS) for f, i in zip(fields, indexes)]
+    count = 0
+    for line in _cdx_lines(reader):
+        parts = line.rstrip(b'\r\n').split(b' ')
+        if len(parts) != 11:
+            logger.warning("Skipping malformed CDX line: %s" % line)
+            continue
+        for append, i, is_int in appenders:
+            value = parts[i]
+            if is_int:
+                append(-1 if value == b'-' else int(value))
+            else:
+                append(value.decode('utf-8'))
+        count += 1
+        if count >= batch_size:
+            yield batch
+            batch = new_batch()
+            appenders = [(batch[f].append, i, f in CDX11_INT_FIELDS) for f, i in zip(fields, indexes)]
+            count = 0
+    if count > 0:
+        yield batch
+
+
 class CdxIndex():
     '''
     This class is used to query our CDX server.
@@ -40,20 +185,23 @@ class CdxIndex():
 
     def __init__(self, cdx_server='http://cdx.api.wa.bl.uk/data-heritrix'):
         self.cdx_server = cdx_server
-
+        # Share a session, so connections get re-used:
+        self.session = requests.Session()
 
     def query(self, url, limit=25, sort='reverse'):
         '''
         See https://nla.github.io/outbackcdx/api.html#operation/query 
         '''
-        r = requests.get(self.cdx_server, 
-            params = { 'url' : url, 'limit': limit, 'sort': sort } )
-        if r.status_code == 200:
-            for line in r.iter_lines(decode_unicode=True):
-                cdx = CDX11(line)
-                yield cdx
-        elif r.status_code != 404:
-            print("ERROR! %s" % r)
+        r = self.session.get(self.cdx_server, 
+            params = { 'url' : url, 'limit': limit, 'sort': sort }, stream=True )
+        try:
+            if r.status_code == 200:
+                # Stream the results, so large result sets don't get loaded into memory:
+                yield from iter_cdx11(r.iter_lines())
+            elif r.status_code != 404:
+                print("ERROR! %s" % r)
+        finally:
+            r.close()
 
 
     def _capture_dates_generator(self, url, sort="reverse"):
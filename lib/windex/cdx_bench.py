@@ -0,0 +1,87 @@
+'''
+Benchmarks the CDX11 parsing code, comparing the compact record type and column parser with the
+original one-attribute-per-field class.
+
+Run as:
+
+    python -m lib.windex.cdx_bench [-n LINES] [cdx_file]
+
+If no CDX file is given, synthetic CDX lines are used.
+'''
+import time
+import tracemalloc
+import argparse
+from lib.windex.cdx import iter_cdx11, iter_cdx11_columns
+
+
+class LegacyCDX11():
+    '''
+    The original CDX11 class, kept here for comparison.
+    '''
+    def __init__(self, line):
+        self.urlkey, self.timestamp, self.original, self.mimetype, self.statuscode, \
+        self.digest, self.redirecturl, self.robotflags, self.length, self.offset, self.filename = line.split(' ')
+
+
+def synthetic_lines(n):
+    for i in range(n):
+        yield ("uk,co,example%i)/path/to/page-%i.html %s http://www.example%i.co.uk/path/to/page-%i.html text/html 200 "
+               "FH7MXPURQT7S75IVEUUFWPA2XPOTY3VW - - %i %i /heritrix/output/frequent/20200101000000/warcs/"
+               "BL-20200101000000000-%05i.warc.gz\n" % (i % 1000, i, 20200101000000 + (i % 60), i % 1000, i, 1000 + i, 10000 * i, i % 100)).encode('utf-8')
+
+
+def _run(label, fn, lines):
+    # Time it first, then run again to measure the memory, as tracing slows everything down:
+    start = time.perf_counter()
+    kept = fn(lines)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(lines)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-34s %8.3f s %12.0f lines/s %10.1f MB peak (%i)" % (
+        label, elapsed, len(lines) / elapsed if elapsed > 0 else 0, peak / 1e6, kept))
+
+
+def legacy_records(lines):
+    records = [LegacyCDX11(line.decode('utf-8').rstrip('\n')) for line in lines]
+    return len(records)
+
+
+def compact_records(lines):
+    records = list(iter_cdx11(lines))
+    return len(records)
+
+
+def compact_to_dict(lines):
+    return sum(1 for r in iter_cdx11(lines) if r.to_dict())
+
+
+def columns(lines):
+    total = 0
+    for batch in iter_cdx11_columns(lines, fields=('timestamp', 'length', 'offset', 'filename')):
+        total += len(batch['timestamp'])
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='cdx_bench')
+    parser.add_argument('-n', '--lines', type=int, default=500000, help='Number of synthetic lines to use.')
+    parser.add_argument('cdx_file', nargs='?', help='A CDX file to read, instead of synthetic lines.')
+    args = parser.parse_args()
+
+    if args.cdx_file:
+        with open(args.cdx_file, 'rb') as f:
+            lines = [line for line in f if not line.startswith(b' CDX')]
+    else:
+        lines = list(synthetic_lines(args.lines))
+    print("Parsing %i CDX lines..." % len(lines))
+
+    _run("LegacyCDX11 (all records)", legacy_records, lines)
+    _run("CDX11 (all records)", compact_records, lines)
+    _run("CDX11.to_dict (streamed)", compact_to_dict, lines)
+    _run("iter_cdx11_columns (4 fields)", columns, lines)
+
+
+if __name__ == "__main__":
+    main()
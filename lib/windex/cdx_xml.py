@@ -1,11 +1,52 @@
+import time
 import logging
-import xml.dom.minidom
-from xml.parsers.expat import ExpatError
+import threading
+import xml.etree.ElementTree as ET
 import urllib.request
 from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# How much of the response to read and parse at a time:
+READ_CHUNK_SIZE = 64 * 1024
+
+# Defaults for batched capture checks:
+DEFAULT_CHECK_WORKERS = 8
+DEFAULT_CHECK_TTL = 300
+
+
+def iter_capture_dates_xml(reader, chunk_size=READ_CHUNK_SIZE):
+    '''
+    Incrementally parses a Wayback-style XML query response, yielding each capture date as it streams in.
+
+    Only one result is held in memory at a time, and if the caller stops iterating, no more of the response
+    is read.
+
+    :param reader: a binary file-like object, e.g. an HTTP response
+    :return: yields each capturedate in turn
+    '''
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    results = None
+    while True:
+        chunk = reader.read(chunk_size)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if elem.tag == 'results':
+                    results = elem
+            elif elem.tag == 'capturedate':
+                yield (elem.text or '').strip()
+            elif elem.tag == 'result' and results is not None:
+                # Drop the results we've finished with:
+                results.clear()
+        if not chunk:
+            break
+
+
 class CdxIndex():
     '''
     This class is used to query our CDX server.
@@ -15,46 +56,54 @@ class CdxIndex():
     def __init__(self, cdx_server='http://bigcdx:8080/data-heritrix'):
         self.cdx_server = cdx_server
 
-    def _capture_dates_generator(self, url):
+    def iter_capture_dates(self, url):
         '''
         A generator that pages through the CDX results.
 
+        Unlike the other lookups, any error (e.g. a timeout or a server error) is raised, so the caller can tell a
+        failed lookup from one that found nothing.
+
         :param url:
-        :return: yeilds each capturedate in turn
+        :return: yields each capturedate in turn
         '''
         # Paging, as we have a LOT of copies of some URLs:
         batch = 25000
         offset = 0
         next_batch = True
         while next_batch:
-            try:
-                # Get a batch:
-                q = "type:urlquery url:" + quote_plus(url) + (" limit:%i offset:%i" % (batch, offset))
-                cdx_query_url = "%s?q=%s" % (self.cdx_server, quote_plus(q))
-                logger.info("Getting %s" % cdx_query_url)
-                f = urllib.request.urlopen(cdx_query_url)
-                content = f.read()
-                f.close()
-                # Grab the capture dates:
-                dom = xml.dom.minidom.parseString(content)
-                new_records = 0
-                for de in dom.getElementsByTagName('capturedate'):
-                    yield de.firstChild.nodeValue
+            # Get a batch:
+            q = "type:urlquery url:" + quote_plus(url) + (" limit:%i offset:%i" % (batch, offset))
+            cdx_query_url = "%s?q=%s" % (self.cdx_server, quote_plus(q))
+            logger.info("Getting %s" % cdx_query_url)
+            # Grab the capture dates as they stream in:
+            new_records = 0
+            with urllib.request.urlopen(cdx_query_url) as f:
+                for capture_date in iter_capture_dates_xml(f):
+                    yield capture_date
                     new_records += 1
-                # Done?
-                if new_records == 0:
-                    next_batch = False
-                else:
-                    # Next batch:
-                    offset += batch
-            except ExpatError as e:
-                logger.warning("ExpatError on lookup: %s" % str(e))
-                logger.warning("ExpatError: URL was %s" % url)
-                next_batch = False
-            except Exception as e:
-                logger.warning("Exception on lookup: %s" % str(e))
-                logger.warning("Exception: URL was %s" % url)
+            # Done?
+            if new_records == 0:
                 next_batch = False
+            else:
+                # Next batch:
+                offset += batch
+
+    def _capture_dates_generator(self, url):
+        '''
+        As iter_capture_dates, but stops at the first error, after logging it.
+
+        :param url:
+        :return: yeilds each capturedate in turn
+        '''
+        try:
+            for capture_date in self.iter_capture_dates(url):
+                yield capture_date
+        except ET.ParseError as e:
+            logger.warning("ParseError on lookup: %s" % str(e))
+            logger.warning("ParseError: URL was %s" % url)
+        except Exception as e:
+            logger.warning("Exception on lookup: %s" % str(e))
+            logger.warning("Exception: URL was %s" % url)
 
     def get_first_capture_date(self, url):
         '''
@@ -64,6 +113,21 @@ class CdxIndex():
         '''
         return next(self._capture_dates_generator(url), None)
 
+    def has_capture_date(self, url, timestamp):
+        '''
+        Checks if there is a capture of the URL with the given timestamp.
+
+        Stops reading and paging through the results as soon as a match is found.
+
+        :param url:
+        :param timestamp: the 14-digit capture date to look for
+        :return: True if found
+        '''
+        for capture_date in self._capture_dates_generator(url):
+            if capture_date == timestamp:
+                return True
+        return False
+
     def get_capture_dates(self, url):
         '''
         Returns and array of all the hits for a url.
@@ -76,3 +140,99 @@ class CdxIndex():
             capture_dates.append(capture_date)
 
         return capture_dates
+
+
+class CaptureChecker():
+    '''
+    Checks whether batches of (url, timestamp) captures are in the CDX index.
+
+    Each distinct URL is only looked up once per batch, however many timestamps are wanted for it, a bounded
+    number of lookups run at once, and the results are cached for a short time so repeated checks (e.g. from
+    retried tasks) do not hit the CDX server again. Lookups that fail are reported as not found, but are not
+    cached, so they are tried again next time.
+    '''
+
+    def __init__(self, cdx_server, max_workers=DEFAULT_CHECK_WORKERS, ttl=DEFAULT_CHECK_TTL):
+        self.index = CdxIndex(cdx_server)
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.cache = {}
+        self._lock = threading.Lock()
+        self.stats = { 'checks': 0, 'cached': 0, 'lookups': 0, 'failed': 0 }
+
+    def _cached(self, url, timestamp, now):
+        entry = self.cache.get((url, timestamp), None)
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def _lookup(self, url, timestamps):
+        # Stop reading as soon as all the wanted timestamps have been seen:
+        wanted = set(timestamps)
+        found = set()
+        try:
+            for capture_date in self.index.iter_capture_dates(url):
+                if capture_date in wanted:
+                    found.add(capture_date)
+                    if found == wanted:
+                        break
+        except Exception as e:
+            logger.warning("Lookup of %s failed: %s" % (url, e))
+            return url, None
+        return url, found
+
+    def check(self, captures):
+        '''
+        Checks a batch of captures.
+
+        :param captures: a list of (url, timestamp) pairs
+        :return: a dict mapping each (url, timestamp) pair to True if it is in the index
+        '''
+        now = time.time()
+        results = {}
+        to_lookup = {}
+        with self._lock:
+            for url, timestamp in captures:
+                self.stats['checks'] += 1
+                known = self._cached(url, timestamp, now)
+                if known is None:
+                    to_lookup.setdefault(url, set()).add(timestamp)
+                else:
+                    self.stats['cached'] += 1
+                    results[(url, timestamp)] = known
+        if to_lookup:
+            logger.info("Looking up %i URLs in the CDX index..." % len(to_lookup))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for url, found in executor.map(lambda item: self._lookup(*item), to_lookup.items()):
+                    with self._lock:
+                        self.stats['lookups'] += 1
+                        if found is None:
+                            self.stats['failed'] += 1
+                            for timestamp in to_lookup[url]:
+                                results[(url, timestamp)] = False
+                            continue
+                        for timestamp in to_lookup[url]:
+                            results[(url, timestamp)] = timestamp in found
+                            self.cache[(url, timestamp)] = (timestamp in found, now)
+            self._expire(now)
+        return results
+
+    def _expire(self, now):
+        with self._lock:
+            for key in [key for key, entry in self.cache.items() if now - entry[1] >= self.ttl]:
+                del self.cache[key]
+
+    def has_capture_date(self, url, timestamp):
+        return self.check([(url, timestamp)])[(url, timestamp)]
+
+
+# The checkers in use in this process, one per CDX server, so they can share their caches:
+_checkers = {}
+
+
+def get_capture_checker(cdx_server):
+    checker = _checkers.get(cdx_server, None)
+    if checker is None:
+        checker = CaptureChecker(cdx_server)
+        _checkers[cdx_server] = checker
+    return checker
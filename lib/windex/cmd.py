@@ -14,10 +14,14 @@ import urllib.parse
 from lib.trackdb.solr import SolrTrackDB
 from lib.trackdb.tasks import Task
 
+# Default store, used when indexing locally:
+from lib.store.webhdfs import DEFAULT_WEBHDFS, DEFAULT_WEBHDFS_USER
+
 # Specific code relating to index work
 from lib.windex.cdx import CdxIndex
-from lib.windex.trace import follow_redirects
+from lib.windex.trace import RedirectTracer, DEFAULT_TRACE_WORKERS, DEFAULT_TRACE_MAX_DEPTH
 from lib.windex.mr_cdx_job import run_cdx_index_job, run_cdx_index_job_with_file
+from lib.windex.local_cdx_job import run_local_cdx_index_job, run_local_cdx_index_job_with_file, DEFAULT_LOCAL_PROCESSES
 from lib.windex.mr_solr_job import run_solr_index_job
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s: %(levelname)s - %(name)s - %(message)s')
@@ -64,6 +68,20 @@ def main():
         help='The CDX Collection to work with.', 
         default=DEFAULT_CDX_COLLECTION)
 
+    # Local CDX indexing args:
+    local_parser = argparse.ArgumentParser(add_help=False)
+    local_parser.add_argument('-L', '--local', action='store_true', 
+        help='Index the WARCs using local processes rather than a Hadoop job.')
+    local_parser.add_argument('-P', '--processes', type=int, 
+        help='Number of WARCs to index in parallel when indexing locally.', 
+        default=DEFAULT_LOCAL_PROCESSES)
+    local_parser.add_argument('-w', '--webhdfs-url', type=str, 
+        help='The WebHDFS URL to read WARCs from when indexing locally.', 
+        default=DEFAULT_WEBHDFS)
+    local_parser.add_argument('-u', '--webhdfs-user', type=str, 
+        help='The WebHDFS user to act as when indexing locally.', 
+        default=DEFAULT_WEBHDFS_USER)
+
     # Use sub-parsers for different operations:
     subparsers = root_parser.add_subparsers(dest="op")
 
@@ -77,23 +95,25 @@ def main():
 
     # Add a parser for the 'trace' subcommand:
     parser_trace = subparsers.add_parser('trace', 
-        help='Look up a URL, and follow redirects.', 
+        help='Look up a list of URLs, and follow redirects.', 
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         parents=[common_parser, cdx_parser])
+    parser_trace.add_argument('-w', '--workers', type=int, help='Number of concurrent lookups to run.', default=DEFAULT_TRACE_WORKERS)
+    parser_trace.add_argument('-D', '--max-depth', type=int, help='Maximum number of redirects to follow from each URL.', default=DEFAULT_TRACE_MAX_DEPTH)
     parser_trace.add_argument('input_file', type=str, help='File containing the list of URLs to look up.')
 
     # Add a parser for the 'cdx-index' subcommand:
     parser_index_cdx = subparsers.add_parser('cdx-index', 
         help="Use TrackDB to index WARCs into a CDX service.", 
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[common_parser, trackdb_parser, cdx_parser])
+        parents=[common_parser, trackdb_parser, cdx_parser, local_parser])
     parser_index_cdx.add_argument('-B', '--batch-size', type=int, help='Number files to process in each run.', default=DEFAULT_BATCH_SIZE)
 
     # Add a parser for the 'cdx-index-job' subcommand:
     parser_index_cdxjob = subparsers.add_parser('cdx-index-job', 
         help="Index WARCs listed in a file into a CDX service.", 
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[common_parser, cdx_parser])
+        parents=[common_parser, cdx_parser, local_parser])
     parser_index_cdxjob.add_argument('input_file', help="A file containing a list of WARCs to index.")
 
     # Add a parser for the 'solr-index' subcommand:
@@ -133,11 +153,14 @@ def main():
     elif args.op == 'trace':
         # Set up CDX client:
         cdxs = CdxIndex(cdx_url)
+        tracer = RedirectTracer(cdxs, workers=args.workers, max_depth=args.max_depth)
         with open(args.input_file) as fin:
-            for line in fin:
-                url = line.strip()
-                for result in follow_redirects(cdxs, url):
+            urls = (line.strip() for line in fin if line.strip())
+            for url, chain in tracer.trace(urls):
+                for result in chain:
                     print("%s\t%s" % (result,url))
+        # Report how it went:
+        logger.info("Trace summary: %s" % json.dumps(tracer.summary()))
 
     elif args.op == 'cdx-index' or args.op == 'solr-index':
         # TODO Add option to just index from a list of file (no TrackDB at all)
@@ -156,7 +179,10 @@ def main():
             items = tdb.list(args.stream, args.year, field_value, limit=args.batch_size)
             if len(items) > 0:
                 # Run a job to index those items:
-                stats = run_cdx_index_job(items, cdx_url)
+                if args.local:
+                    stats = run_local_cdx_index_job(items, cdx_url, args.processes, args.webhdfs_url, args.webhdfs_user)
+                else:
+                    stats = run_cdx_index_job(items, cdx_url)
                 # If that worked (no exception thrown), update the tracking database accordingly:
                 ids = []
                 for item in items:
@@ -204,7 +230,10 @@ def main():
         tdb.import_items([t.as_dict()])
     elif args.op == 'cdx-index-job':
         # Run a one-off job to index some WARCs based on a list from a file:
-        stats = run_cdx_index_job_with_file(args.input_file, cdx_url)
+        if args.local:
+            stats = run_local_cdx_index_job_with_file(args.input_file, cdx_url, args.processes, args.webhdfs_url, args.webhdfs_user)
+        else:
+            stats = run_cdx_index_job_with_file(args.input_file, cdx_url)
         print(stats)
 
     else:
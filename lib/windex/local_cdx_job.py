@@ -0,0 +1,154 @@
+'''
+A pure-Python alternative to the Hadoop CDX indexing job, for small or urgent batches of WARCs.
+
+Each WARC is streamed from the store and indexed by a separate worker process, and the resulting CDX11
+lines are POSTed to the CDX service (e.g. OutbackCDX) in large batches. The stats returned match those of
+the Hadoop job (see mr_cdx_job.py), so the results can be recorded in TrackDB in the same way.
+'''
+import re
+import json
+import logging
+import urllib.parse
+from multiprocessing import Pool
+import requests
+from warcio.archiveiterator import ArchiveIterator
+from lib.windex.cdx import to_cdx11_line
+from lib.store.webhdfs import WebHDFSStore, DEFAULT_WEBHDFS, DEFAULT_WEBHDFS_USER
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the local indexer:
+DEFAULT_LOCAL_PROCESSES = 4
+DEFAULT_POST_BATCH_SIZE = 10000
+
+# The kinds of WARC records that get indexed:
+INDEXED_RECORD_TYPES = ['response', 'revisit', 'resource']
+
+
+def _mimetype(content_type):
+    if not content_type:
+        return 'unk'
+    return content_type.split(';')[0].strip().lower() or 'unk'
+
+
+def record_to_cdx11(record, offset, length, path):
+    '''
+    Generates a CDX11 line for a WARC record, or returns None if the record should not be indexed.
+
+    Uses the same "CDX N b a m s k r M S V g" layout as the Hadoop indexer.
+    '''
+    if record.rec_type not in INDEXED_RECORD_TYPES:
+        return None
+    url = record.rec_headers.get_header('WARC-Target-URI')
+    if not url or url.startswith('dns:'):
+        return None
+    timestamp = re.sub('[^0-9]', '', record.rec_headers.get_header('WARC-Date', ''))[:14]
+    digest = record.rec_headers.get_header('WARC-Payload-Digest') or '-'
+    if ':' in digest:
+        digest = digest.split(':', 1)[1]
+    redirect = '-'
+    if record.rec_type == 'revisit':
+        mimetype = 'warc/revisit'
+        status = '-'
+    elif record.http_headers:
+        mimetype = _mimetype(record.http_headers.get_header('Content-Type'))
+        status = record.http_headers.get_statuscode() or '-'
+        if status.startswith('3'):
+            location = record.http_headers.get_header('Location')
+            if location:
+                redirect = urllib.parse.urljoin(url, location)
+    else:
+        mimetype = _mimetype(record.content_type)
+        status = '200'
+    return to_cdx11_line(url, timestamp, mimetype, status, digest, redirect, length, offset, path)
+
+
+class CdxPoster():
+    '''
+    Accumulates CDX lines and POSTs them to the CDX service in batches.
+    '''
+
+    def __init__(self, cdx_endpoint, batch_size=DEFAULT_POST_BATCH_SIZE):
+        self.cdx_endpoint = cdx_endpoint
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.batch = []
+        self.sent = 0
+
+    def add(self, line):
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        data = ('\n'.join(self.batch) + '\n').encode('utf-8')
+        r = self.session.post(self.cdx_endpoint, data=data)
+        if r.status_code != 200:
+            raise Exception("CDX service returned an error! HTTP %i\n%s" % (r.status_code, r.text))
+        self.sent += len(self.batch)
+        self.batch = []
+
+
+def index_warc(args):
+    '''
+    Indexes a single WARC from the store and sends the results to the CDX service.
+
+    :return: a dict of counters for this WARC
+    '''
+    path, cdx_endpoint, webhdfs_url, webhdfs_user, batch_size = args
+    store = WebHDFSStore(webhdfs_url, webhdfs_user)
+    poster = CdxPoster(cdx_endpoint, batch_size)
+    stats = { 'total_records': 0, 'total_skipped_records': 0, 'total_sent_records': 0, 'total_warcs': 1 }
+    logger.info("Indexing %s" % path)
+    with store.stream(path) as stream:
+        it = ArchiveIterator(stream)
+        for record in it:
+            stats['total_records'] += 1
+            offset = it.get_record_offset()
+            # Read to the end so the record length is known:
+            it.read_to_end(record)
+            line = record_to_cdx11(record, offset, it.get_record_length(), path)
+            if line:
+                poster.add(line)
+            else:
+                stats['total_skipped_records'] += 1
+    poster.flush()
+    stats['total_sent_records'] = poster.sent
+    logger.info("Indexed %s: %s" % (path, stats))
+    return stats
+
+
+def run_local_cdx_index_job(items, cdx_endpoint, processes=DEFAULT_LOCAL_PROCESSES,
+        webhdfs_url=DEFAULT_WEBHDFS, webhdfs_user=DEFAULT_WEBHDFS_USER, batch_size=DEFAULT_POST_BATCH_SIZE):
+    paths = [item['file_path_s'] for item in items]
+    return run_local_cdx_index_job_with_paths(paths, cdx_endpoint, processes, webhdfs_url, webhdfs_user, batch_size)
+
+
+def run_local_cdx_index_job_with_file(input_file, cdx_endpoint, processes=DEFAULT_LOCAL_PROCESSES,
+        webhdfs_url=DEFAULT_WEBHDFS, webhdfs_user=DEFAULT_WEBHDFS_USER, batch_size=DEFAULT_POST_BATCH_SIZE):
+    with open(input_file) as fin:
+        paths = [line.strip() for line in fin if line.strip()]
+    return run_local_cdx_index_job_with_paths(paths, cdx_endpoint, processes, webhdfs_url, webhdfs_user, batch_size)
+
+
+def run_local_cdx_index_job_with_paths(paths, cdx_endpoint, processes=DEFAULT_LOCAL_PROCESSES,
+        webhdfs_url=DEFAULT_WEBHDFS, webhdfs_user=DEFAULT_WEBHDFS_USER, batch_size=DEFAULT_POST_BATCH_SIZE):
+    argsv = [(path, cdx_endpoint, webhdfs_url, webhdfs_user, batch_size) for path in paths]
+
+    # Run one WARC per worker, and gather the output:
+    stats = {}
+    with Pool(processes) as pool:
+        for warc_stats in pool.imap_unordered(index_warc, argsv):
+            for key, value in warc_stats.items():
+                key = "%s_i" % key
+                stats[key] = stats.get(key, 0) + value
+
+    # Raise an exception if the output looks wrong:
+    if not "total_sent_records_i" in stats:
+        raise Exception("CDX job stats has no total_sent_records_i value! \n%s" % json.dumps(stats))
+    if stats['total_sent_records_i'] == 0:
+        raise Exception("CDX job stats has total_sent_records_i == 0! \n%s" % json.dumps(stats))
+
+    return stats
@@ -0,0 +1,103 @@
+import io
+import os
+from warcio.warcwriter import WARCWriter
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.archiveiterator import ArchiveIterator
+from lib.windex import local_cdx_job
+from lib.windex.cdx import CDX11
+from lib.windex.local_cdx_job import index_warc, run_local_cdx_index_job_with_paths
+
+
+class FakeStore():
+    '''
+    Reads WARCs from the local filesystem rather than WebHDFS.
+    '''
+    def __init__(self, webhdfs_url, webhdfs_user):
+        pass
+
+    def stream(self, path, offset=0, length=None):
+        return open(path, 'rb')
+
+
+class FakeResponse():
+    status_code = 200
+    text = ''
+
+
+class FakeSession():
+    '''
+    Records the CDX lines POSTed to the CDX service.
+    '''
+    posted = []
+
+    def post(self, url, data=None):
+        FakeSession.posted.append((url, data.decode('utf-8').splitlines()))
+        return FakeResponse()
+
+
+def _write_warc(path):
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        writer.write_record(writer.create_warcinfo_record('test.warc.gz', { 'software': 'test' }))
+
+        def response(url, status, headers, body, date):
+            http_headers = StatusAndHeaders(status, headers, protocol='HTTP/1.1')
+            record = writer.create_warc_record(url, 'response', payload=io.BytesIO(body), http_headers=http_headers,
+                                               warc_headers_dict={ 'WARC-Date': date })
+            writer.write_record(record)
+            return record
+
+        page = response('http://example.com/', '200 OK', [('Content-Type', 'text/html; charset=UTF-8')],
+                        b'<html>Hello</html>', '2020-01-01T12:00:00Z')
+        response('http://example.com/old', '301 Moved Permanently', [('Location', '/new')], b'', '2020-01-01T12:00:01Z')
+        response('dns:example.com', '200 OK', [], b'1.2.3.4', '2020-01-01T12:00:02Z')
+        writer.write_record(writer.create_revisit_record(
+            'http://example.com/', page.rec_headers.get_header('WARC-Payload-Digest'), 'http://example.com/',
+            '2020-01-01T12:00:00Z', warc_headers_dict={ 'WARC-Date': '2020-01-02T12:00:00Z' }))
+
+
+def _patch(monkeypatch):
+    monkeypatch.setattr(local_cdx_job, 'WebHDFSStore', FakeStore)
+    monkeypatch.setattr(local_cdx_job.requests, 'Session', FakeSession)
+    FakeSession.posted = []
+
+
+def test_index_warc(tmp_path, monkeypatch):
+    _patch(monkeypatch)
+    path = os.path.join(str(tmp_path), 'test.warc.gz')
+    _write_warc(path)
+
+    stats = index_warc((path, 'http://cdx/collection', None, None, 2))
+    assert stats == { 'total_records': 5, 'total_skipped_records': 2, 'total_sent_records': 3, 'total_warcs': 1 }
+    # Sent in batches:
+    assert [len(lines) for url, lines in FakeSession.posted] == [2, 1]
+    records = [CDX11(line) for url, lines in FakeSession.posted for line in lines]
+
+    assert [(r.original, r.timestamp, r.mimetype, r.statuscode, r.redirecturl) for r in records] == [
+        ('http://example.com/', '20200101120000', 'text/html', '200', '-'),
+        ('http://example.com/old', '20200101120001', 'unk', '301', 'http://example.com/new'),
+        ('http://example.com/', '20200102120000', 'warc/revisit', '-', '-'),
+    ]
+    assert records[0].urlkey == 'com,example)/'
+    assert records[0].digest == records[2].digest
+
+    # The offsets and lengths pick out the right records:
+    with open(path, 'rb') as f:
+        for r in records:
+            f.seek(r.offset_int)
+            data = io.BytesIO(f.read(r.length_int))
+            record = next(iter(ArchiveIterator(data)))
+            assert record.rec_headers.get_header('WARC-Target-URI') == r.original
+            assert r.filename == path
+
+
+def test_run_local_cdx_index_job(tmp_path, monkeypatch):
+    _patch(monkeypatch)
+    paths = []
+    for i in range(3):
+        paths.append(os.path.join(str(tmp_path), 'test-%i.warc.gz' % i))
+        _write_warc(paths[-1])
+
+    stats = run_local_cdx_index_job_with_paths(paths, 'http://cdx/collection', processes=2)
+    assert stats == { 'total_records_i': 15, 'total_skipped_records_i': 6, 'total_sent_records_i': 9,
+                      'total_warcs_i': 3 }
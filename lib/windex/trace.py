@@ -1,32 +1,224 @@
+import time
 import logging
+import threading
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from lib.store.webhdfs import WebHDFSStore
 from warcio.archiveiterator import ArchiveIterator
 
 logger = logging.getLogger(__name__)
 
+# Default store to read WARC records from:
+DEFAULT_TRACE_WEBHDFS = "http://hdfs.bapi.wa.bl.uk/"
+
+# Defaults for the resolver:
+DEFAULT_TRACE_WORKERS = 10
+DEFAULT_TRACE_MAX_DEPTH = 20
+DEFAULT_TRACE_CHUNK_SIZE = 1000
+DEFAULT_TRACE_MEMO_SIZE = 100000
+
+
+class RedirectTracer():
+    '''
+    Resolves redirect chains for lists of URLs, breadth-first.
+
+    Each distinct URL is only looked up once, and the outcome (the resolved Location, or None) is memoised, so
+    URLs that are common to many chains (e.g. a site's home page) are only resolved once. The memo only keeps the
+    most recently used memo_size URLs, and lookups that fail are not memoised, so they are tried again if they
+    come up again. Lookups for each level of the chains are run concurrently using a bounded pool of threads,
+    sharing one CDX client and one store.
+    '''
+
+    def __init__(self, cdxs, store=None, workers=DEFAULT_TRACE_WORKERS, max_depth=DEFAULT_TRACE_MAX_DEPTH,
+                 memo_size=DEFAULT_TRACE_MEMO_SIZE):
+        self.cdxs = cdxs
+        if store is None:
+            store = WebHDFSStore(webhdfs_url=DEFAULT_TRACE_WEBHDFS)
+        self.store = store
+        self.workers = workers
+        self.max_depth = max_depth
+        # URL -> resolved Location (or None if it does not redirect, or is not known), least recently used first:
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        # Counters, for the summary:
+        self._lock = threading.Lock()
+        self.counters = {
+            'urls_traced': 0,
+            'urls_resolved': 0,
+            'cdx_lookups': 0,
+            'records_read': 0,
+            'memo_hits': 0,
+            'cycles': 0,
+            'depth_limited': 0,
+            'errors': 0,
+        }
+        self.started_at = None
+
+    def _count(self, key, increment=1):
+        with self._lock:
+            self.counters[key] += increment
+
+    def _location_from_record(self, url, result):
+        with self.store.stream(result.filename, int(result.offset), int(result.length)) as stream:
+            self._count('records_read')
+            for record in ArchiveIterator(stream):
+                if record.rec_type in ['response', 'revisit']:
+                    if record.http_headers is None:
+                        return None
+                    loc = record.http_headers.get('Location', None)
+                    sc = record.http_headers.get_statuscode()
+                    logger.debug("%s < %s %s" % (loc, sc, url))
+                    return loc
+        return None
+
+    def resolve(self, url):
+        '''
+        Looks up the first redirect hop for a single URL, using the most recent capture that answers the question.
+
+        The CDX redirect field is used where it is set. The WARC record is only read for redirects and revisits
+        where the CDX does not record the Location.
+
+        :param url:
+        :return: the absolute URL redirected to, or None
+        '''
+        loc, failed = self._try_resolve(url)
+        return loc
+
+    def _try_resolve(self, url):
+        # Returns the Location, and whether the lookup failed:
+        try:
+            return self._lookup(url), False
+        except Exception as e:
+            logger.exception("Lookup failed for %s: %s" % (url, e))
+            self._count('errors')
+        return None, True
+
+    def _lookup(self, url):
+        logger.info("Looking up: %s" % url)
+        self._count('cdx_lookups')
+        for result in self.cdxs.query(url):
+            if result.original != url:
+                continue
+            if result.redirecturl and result.redirecturl != '-':
+                loc = result.redirecturl
+            elif result.statuscode.startswith('3') or result.statuscode == '-':
+                loc = self._location_from_record(url, result)
+            else:
+                # A non-redirect status code answers the question without reading the record:
+                loc = None
+            # Resolve server-relative redirects if necessary:
+            if loc:
+                loc = urllib.parse.urljoin(url, loc)
+            return loc
+        return None
+
+    def _remember(self, url, loc):
+        self.memo[url] = loc
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def _resolve_all(self, executor, pending, resolved):
+        # Only look up URLs we've not seen before:
+        to_resolve = []
+        for url in pending:
+            if url in self.memo:
+                self._count('memo_hits')
+                self.memo.move_to_end(url)
+                resolved[url] = self.memo[url]
+            else:
+                to_resolve.append(url)
+        # Run the lookups for this level concurrently:
+        for url, (loc, failed) in zip(to_resolve, executor.map(self._try_resolve, to_resolve)):
+            resolved[url] = loc
+            if not failed:
+                self._remember(url, loc)
+        self._count('urls_resolved', len(to_resolve))
+
+    def _chain(self, url, resolved):
+        # Walk the outcomes for this chunk to build the chain of redirects starting from this URL:
+        urls = []
+        seen = set([url])
+        loc = resolved.get(url, None)
+        while loc:
+            if loc in seen:
+                self._count('cycles')
+                break
+            if len(urls) >= self.max_depth:
+                self._count('depth_limited')
+                break
+            urls.append(loc)
+            seen.add(loc)
+            loc = resolved.get(loc, None)
+        return urls
+
+    def trace_chunk(self, executor, urls):
+        '''
+        Resolves the chains for a list of URLs, one level of redirects at a time.
+
+        The outcomes for the chunk are kept until its chains have been built, however many are dropped from the memo.
+        '''
+        resolved = {}
+        pending = set(urls)
+        depth = 0
+        while pending and depth <= self.max_depth:
+            self._resolve_all(executor, pending, resolved)
+            # Move on to the URLs we were redirected to that still need resolving:
+            next_pending = set()
+            for url in pending:
+                loc = resolved.get(url, None)
+                if loc:
+                    if loc in resolved:
+                        self._count('memo_hits')
+                    else:
+                        next_pending.add(loc)
+            pending = next_pending
+            depth += 1
+        for url in urls:
+            self._count('urls_traced')
+            yield url, self._chain(url, resolved)
+
+    def trace(self, urls, chunk_size=DEFAULT_TRACE_CHUNK_SIZE):
+        '''
+        Traces the redirect chains of the given URLs, processing them in chunks so large lists can be streamed.
+
+        :param urls: an iterable of URLs
+        :return: yields (url, [redirected_url, ...]) tuples, in input order
+        '''
+        self.started_at = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            chunk = []
+            for url in urls:
+                chunk.append(url)
+                if len(chunk) >= chunk_size:
+                    yield from self.trace_chunk(executor, chunk)
+                    chunk = []
+            if len(chunk) > 0:
+                yield from self.trace_chunk(executor, chunk)
+
+    def summary(self):
+        '''
+        Returns the counters, plus the elapsed time and throughput.
+        '''
+        stats = dict(self.counters)
+        if self.started_at:
+            elapsed = time.time() - self.started_at
+            stats['elapsed_secs'] = round(elapsed, 3)
+            if elapsed > 0:
+                stats['urls_per_sec'] = round(stats['urls_traced'] / elapsed, 3)
+                stats['lookups_per_sec'] = round(stats['cdx_lookups'] / elapsed, 3)
+        return stats
+
+
 def follow_redirects(cdxs, url, urls=None):
+    '''
+    Returns the set of URLs that the given URL redirects to.
+
+    Kept for compatibility, see RedirectTracer for tracing lists of URLs.
+    '''
     if urls is None:
         urls = set()
-    logger.info("Looking up: %s" % url)
-    store = WebHDFSStore(webhdfs_url="http://hdfs.bapi.wa.bl.uk/")
-    for result in cdxs.query(url):
-        if result.original == url:
-            with store.stream(result.filename, result.offset, result.length) as stream:
-                for record in ArchiveIterator(stream):
-                    if record.rec_type in ['response', 'revisit']:
-                        #target = record.rec_headers.get_header('WARC-Target-URI')
-                        loc = record.http_headers.get('Location', None)
-                        sc = record.http_headers.get_statuscode()
-                        logger.info("%s < %s %s" %(loc, sc, url))
-                        if loc:
-                            # Resolve server-relative redirects if necessary:
-                            loc = urllib.parse.urljoin(url, loc)
-                            # Add to the list, if we don't already have it:
-                            if not loc in urls:
-                                urls.add(loc)
-                                # See if the URL leads to further redirects...
-                                urls = follow_redirects(cdxs, loc, urls)
-                        break
+    tracer = RedirectTracer(cdxs, workers=1)
+    for _, chain in tracer.trace([url]):
+        urls.update(chain)
     return urls
-    
\ No newline at end of file
@@ -0,0 +1,103 @@
+from lib.windex.cdx import CDX11
+from lib.windex.trace import RedirectTracer
+
+
+class FakeCdxIndex():
+    '''
+    Answers queries from a dict of URL -> (status code, redirect URL), counting the lookups, and failing for any
+    URL in 'failing' until it is removed.
+    '''
+    def __init__(self, captures):
+        self.captures = captures
+        self.queries = []
+        self.failing = set()
+
+    def query(self, url):
+        self.queries.append(url)
+        if url in self.failing:
+            raise Exception("CDX server unavailable!")
+        if url in self.captures:
+            status, redirect = self.captures[url]
+            yield CDX11("%s 20200101000000 %s text/html %s ABCDEF %s - 100 200 a.warc.gz"
+                        % (url, url, status, redirect))
+
+
+def _tracer(captures, **kwargs):
+    cdxs = FakeCdxIndex(captures)
+    # The store is only used to read the Location from WARC records, which these captures never need:
+    return cdxs, RedirectTracer(cdxs, store=object(), workers=2, **kwargs)
+
+
+def test_chains():
+    cdxs, tracer = _tracer({
+        'http://a.com/': ('301', 'http://b.com/'),
+        'http://b.com/': ('302', '/home'),
+        'http://b.com/home': ('200', '-'),
+        'http://c.com/': ('404', '-'),
+    })
+    chains = dict(tracer.trace(['http://a.com/', 'http://c.com/', 'http://unknown.com/']))
+    assert chains == {
+        'http://a.com/': ['http://b.com/', 'http://b.com/home'],
+        'http://c.com/': [],
+        'http://unknown.com/': [],
+    }
+    assert tracer.summary()['urls_traced'] == 3
+
+
+def test_cycles_and_depth():
+    cdxs, tracer = _tracer({
+        'http://a.com/': ('301', 'http://b.com/'),
+        'http://b.com/': ('301', 'http://a.com/'),
+        'http://c.com/0': ('301', 'http://c.com/1'),
+        'http://c.com/1': ('301', 'http://c.com/2'),
+        'http://c.com/2': ('301', 'http://c.com/3'),
+        'http://c.com/3': ('200', '-'),
+    }, max_depth=2)
+    assert list(tracer.trace(['http://a.com/'])) == [('http://a.com/', ['http://b.com/'])]
+    assert tracer.counters['cycles'] == 1
+    assert list(tracer.trace(['http://c.com/0'])) == [('http://c.com/0', ['http://c.com/1', 'http://c.com/2'])]
+    assert tracer.counters['depth_limited'] == 1
+
+
+def test_memo_hits():
+    cdxs, tracer = _tracer({
+        'http://a.com/': ('301', 'http://home.com/'),
+        'http://b.com/': ('301', 'http://home.com/'),
+        'http://home.com/': ('200', '-'),
+    })
+    # Across chunks, the shared URL is only looked up once:
+    chains = list(tracer.trace(['http://a.com/', 'http://b.com/', 'http://a.com/'], chunk_size=1))
+    assert [chain for url, chain in chains] == [['http://home.com/']] * 3
+    assert sorted(cdxs.queries) == ['http://a.com/', 'http://b.com/', 'http://home.com/']
+    assert tracer.counters['memo_hits'] >= 2
+
+
+def test_memo_is_bounded():
+    captures = dict(('http://a.com/%i' % i, ('301', 'http://a.com/%i' % (i + 1))) for i in range(10))
+    cdxs, tracer = _tracer(captures, memo_size=3)
+    # The chain is still complete, though most of it has been dropped from the memo:
+    assert list(tracer.trace(['http://a.com/0'])) == [('http://a.com/0', ['http://a.com/%i' % i for i in range(1, 11)])]
+    assert len(tracer.memo) == 3
+    assert list(tracer.memo.keys()) == ['http://a.com/8', 'http://a.com/9', 'http://a.com/10']
+
+    # What is left is still used:
+    assert list(tracer.trace(['http://a.com/9'])) == [('http://a.com/9', ['http://a.com/10'])]
+    assert len(cdxs.queries) == 11
+    assert list(tracer.memo.keys()) == ['http://a.com/8', 'http://a.com/9', 'http://a.com/10']
+
+
+def test_errors_are_not_memoised():
+    cdxs, tracer = _tracer({
+        'http://a.com/': ('301', 'http://b.com/'),
+        'http://b.com/': ('200', '-'),
+    })
+    cdxs.failing.add('http://b.com/')
+    assert list(tracer.trace(['http://a.com/'])) == [('http://a.com/', ['http://b.com/'])]
+    assert tracer.counters['errors'] == 1
+    assert 'http://b.com/' not in tracer.memo
+
+    # Tried again once the CDX server is back:
+    cdxs.failing.clear()
+    assert list(tracer.trace(['http://a.com/'])) == [('http://a.com/', ['http://b.com/'])]
+    assert cdxs.queries.count('http://b.com/') == 2
+    assert tracer.memo['http://b.com/'] is None
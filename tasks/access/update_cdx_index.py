@@ -4,12 +4,10 @@ import json
 import shutil
 import logging
 import datetime
-import xml.dom.minidom
-from xml.parsers.expat import ExpatError
 import random
 import warcio
-from urllib.request import urlopen
-from urllib.parse import quote_plus, urlparse
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
 import luigi
 import luigi.contrib.hdfs
 import luigi.contrib.hadoop_jar
@@ -17,6 +15,7 @@ from tasks.access.hdfs_list_warcs import ListWarcsForDateRange
 from tasks.common import state_file, CopyToTableInDB
 from lib.webhdfs import WebHdfsPlainFormat, webhdfs
 from lib.targets import AccessTaskDBTarget, TrackingDBStatusField
+from lib.windex.cdx_xml import CdxIndex
 from prometheus_client import CollectorRegistry, Gauge
 
 logger = logging.getLogger('luigi-interface')
@@ -157,8 +156,7 @@ class CheckCdxIndexForWARC(luigi.Task):
                     # Check a random subset of the records, always emitting the first record:
                     if self.count == 0 or random.randint(1, self.sampling_rate) == 1:
                         logger.info("Checking a record: %s @ %s" % (record_url, timestamp))
-                        capture_dates = self.get_capture_dates(record_url)
-                        if timestamp in capture_dates:
+                        if self.has_capture_date(record_url, timestamp):
                             self.hits += 1
                         else:
                             logger.warning("Record not found in index: %s @ %s" % (record_url, timestamp))
@@ -184,39 +182,26 @@ class CheckCdxIndexForWARC(luigi.Task):
         else:
             raise Exception("For %s, only %i of %i records checked are in the CDX index!"%(self.input_file, self.hits, self.tries))
 
+    def cdx_index(self):
+        return CdxIndex(self.cdx_service)
+
+    def capture_dates(self, url):
+        # Stream through the pages of hits for this URL. A failed request is raised, rather than being taken to
+        # mean the URL is not in the index, so the WARC gets checked again later rather than reported as missing:
+        try:
+            yield from self.cdx_index().iter_capture_dates(url)
+        except ET.ParseError as e:
+            logger.warning("ParseError on lookup of %s: %s" % (url, e))
+
+    def has_capture_date(self, url, timestamp):
+        # Stops as soon as it's found:
+        for capture_date in self.capture_dates(url):
+            if capture_date == timestamp:
+                return True
+        return False
+
     def get_capture_dates(self, url):
-        # Get the hits for this URL:
-        capture_dates = []
-        # Paging, as we have a LOT of copies of some URLs:
-        batch = 25000
-        offset = 0
-        next_batch = True
-        while next_batch:
-            try:
-                # Get a batch:
-                q = "type:urlquery url:" + quote_plus(url) + (" limit:%i offset:%i" % (batch, offset))
-                cdx_query_url = "%s?q=%s" % (self.cdx_service, quote_plus(q))
-                logger.info("Getting %s" % cdx_query_url)
-                f = urlopen(cdx_query_url)
-                content = f.read()
-                f.close()
-                # Grab the capture dates:
-                dom = xml.dom.minidom.parseString(content)
-                new_records = 0
-                for de in dom.getElementsByTagName('capturedate'):
-                    capture_dates.append(de.firstChild.nodeValue)
-                    new_records += 1
-                # Done?
-                if new_records == 0:
-                    next_batch = False
-                else:
-                    # Next batch:
-                    offset += batch
-            except ExpatError as e:
-                logger.warning("Exception on lookup: "  + str(e))
-                next_batch = False
-
-        return capture_dates
+        return list(self.capture_dates(url))
 
     def get_metrics(self, registry):
         # type: (CollectorRegistry) -> None
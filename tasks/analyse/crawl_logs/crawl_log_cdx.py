@@ -0,0 +1,211 @@
+import os
+import gzip
+import json
+import heapq
+import logging
+import tempfile
+import luigi
+import luigi.contrib.hdfs
+from luigi.contrib.hdfs.format import Plain
+
+from tasks.analyse.crawl_logs.log_analysis_hadoop import CrawlLogLine, InputFile
+from lib.store.webhdfs import WebHDFSStore
+from lib.store.hdfs_layout import warc_path_for_log
+from lib.windex.cdx import to_cdx11_line
+from lib.windex.local_cdx_job import CdxPoster
+
+logger = logging.getLogger(__name__)
+
+# Number of CDX lines to sort in memory before spilling to a temporary file:
+SORT_CHUNK_SIZE = 1000000
+
+
+class CrawlLogCdxConverter(object):
+    """
+    Generates CDX11 lines directly from Heritrix3 crawl logs, using the WARC filename, offset and record length
+    that Heritrix records in the extra JSON at the end of each line, so the WARCs do not need to be re-read.
+    """
+
+    def __init__(self, job, launch_id, from_hdfs=False, sort_chunk_size=SORT_CHUNK_SIZE):
+        self.job = job
+        self.launch_id = launch_id
+        self.from_hdfs = from_hdfs
+        self.sort_chunk_size = sort_chunk_size
+        self.store = None
+        self.stats = {
+            'log_lines': 0,
+            'cdx_lines': 0,
+            'skipped_lines': 0,
+            'no_warc_lines': 0,
+            'unparseable_lines': 0,
+        }
+
+    def open_log(self, log_path):
+        """
+        Opens a crawl log as a stream of text lines, decompressing gzipped log rotations on the fly.
+        """
+        if self.from_hdfs:
+            if self.store is None:
+                self.store = WebHDFSStore()
+            with self.store.stream(log_path) as reader:
+                if log_path.endswith('.gz'):
+                    reader = gzip.GzipFile(fileobj=reader)
+                for line in reader:
+                    yield line.decode('utf-8', errors='replace')
+        else:
+            if log_path.endswith('.gz'):
+                f = gzip.open(log_path, 'rt', encoding='utf-8', errors='replace')
+            else:
+                f = open(log_path, 'r', encoding='utf-8', errors='replace')
+            with f:
+                for line in f:
+                    yield line
+
+    def warc_path(self, log_path, warc_filename):
+        path = warc_path_for_log(log_path, warc_filename)
+        if path is None:
+            # Fall back on the current layout, based on the job and launch:
+            path = "/heritrix/output/%s/%s/warcs/%s" % (self.job, self.launch_id, warc_filename)
+        return path
+
+    def to_cdx11(self, log, log_path):
+        """
+        Converts a parsed crawl log line into a CDX11 line, or returns None if it should not be indexed.
+
+        Follows the same mapping as the old send_uri_to_tinycdxserver prototype.
+        """
+        # Skip non http(s) records, and negative (failed) status codes:
+        if not log.url.startswith('http'):
+            return None
+        if not log.status_code.isdigit() or int(log.status_code) <= 0:
+            return None
+        extra = json.loads(getattr(log, 'extra_json', None) or '{}')
+        warc_filename = extra.get('warcFilename', None)
+        if warc_filename is None:
+            self.stats['no_warc_lines'] += 1
+            return None
+        # Record de-duplicated resources as revisits:
+        mimetype = log.mime
+        status_code = log.status_code
+        if 'duplicate:digest' in log.annotations:
+            mimetype = 'warc/revisit'
+            status_code = '-'
+        digest = log.hash
+        if ':' in digest:
+            digest = digest.split(':', 1)[1]
+        return to_cdx11_line(
+            log.url,
+            log.start_time_plus_duration[:14],
+            mimetype,
+            status_code,
+            digest,
+            '-',
+            extra.get('warcFileRecordLength', '-'),
+            extra.get('warcFileOffset', '-'),
+            self.warc_path(log_path, warc_filename))
+
+    def cdx_lines(self, log_paths):
+        """
+        Yields the CDX11 lines for all the given logs, in log order.
+        """
+        for log_path in log_paths:
+            logger.info("Generating CDX from %s" % log_path)
+            for line in self.open_log(log_path):
+                self.stats['log_lines'] += 1
+                try:
+                    log = CrawlLogLine(line)
+                except ValueError:
+                    self.stats['unparseable_lines'] += 1
+                    continue
+                cdx = self.to_cdx11(log, log_path)
+                if cdx:
+                    self.stats['cdx_lines'] += 1
+                    yield cdx
+                else:
+                    self.stats['skipped_lines'] += 1
+
+    def sorted_cdx_lines(self, log_paths):
+        """
+        Yields the CDX11 lines for all the given logs, sorted.
+
+        Sorts chunks of lines in memory, spills them to temporary files, and merges them, so the logs for a
+        large crawl can be sorted without holding them all in memory.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            runs = []
+            chunk = []
+            for cdx in self.cdx_lines(log_paths):
+                chunk.append(cdx)
+                if len(chunk) >= self.sort_chunk_size:
+                    runs.append(self._spill(tmp_dir, chunk))
+                    chunk = []
+            chunk.sort()
+            # If everything fitted in memory, no need to merge:
+            if len(runs) == 0:
+                yield from chunk
+                return
+            runs.append(self._spill(tmp_dir, chunk))
+            readers = [open(run, 'r', encoding='utf-8') for run in runs]
+            try:
+                for line in heapq.merge(*readers):
+                    yield line.rstrip('\n')
+            finally:
+                for reader in readers:
+                    reader.close()
+
+    def _spill(self, tmp_dir, chunk):
+        chunk.sort()
+        run_path = os.path.join(tmp_dir, 'run-%05i.cdx' % len(os.listdir(tmp_dir)))
+        with open(run_path, 'w', encoding='utf-8') as f:
+            for cdx in chunk:
+                f.write(cdx)
+                f.write('\n')
+        return run_path
+
+
+class CrawlLogsToCdx(luigi.Task):
+    """
+    Generates a sorted CDX file directly from a set of crawl logs, and optionally POSTs the
+    CDX lines to a CDX service (e.g. OutbackCDX) in batches.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    cdx_endpoint = luigi.Parameter(default=None)
+    from_hdfs = luigi.BoolParameter(default=False)
+
+    def requires(self):
+        reqs = []
+        for log_path in self.log_paths:
+            logger.info("LOG FILE TO PROCESS: %s" % log_path)
+            reqs.append(InputFile(log_path, self.from_hdfs))
+        return reqs
+
+    def output(self):
+        out_name = "task-state/%s/%s/crawl-logs-%i.cdx" % (self.job, self.launch_id, len(self.log_paths))
+        if self.from_hdfs:
+            return luigi.contrib.hdfs.HdfsTarget(path=out_name, format=Plain)
+        else:
+            return luigi.LocalTarget(path=out_name)
+
+    def run(self):
+        converter = CrawlLogCdxConverter(self.job, self.launch_id, self.from_hdfs)
+        poster = None
+        if self.cdx_endpoint:
+            poster = CdxPoster(self.cdx_endpoint)
+        with self.output().open('w') as out_file:
+            for cdx in converter.sorted_cdx_lines(self.log_paths):
+                out_file.write("%s\n" % cdx)
+                if poster:
+                    poster.add(cdx)
+        if poster:
+            poster.flush()
+            converter.stats['sent_records'] = poster.sent
+        logger.info("Crawl log CDX stats: %s" % json.dumps(converter.stats))
+
+
+if __name__ == '__main__':
+    luigi.run(['analyse.CrawlLogsToCdx', '--job', 'frequent', '--launch-id', '20181126142741',
+               '--log-paths', '[ "test/crawl.log" ]',
+               '--local-scheduler'])
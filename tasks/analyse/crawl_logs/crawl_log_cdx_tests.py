@@ -0,0 +1,59 @@
+import os
+import json
+import luigi
+from lib.windex.cdx import CDX11
+from tasks.analyse.crawl_logs.crawl_log_cdx import CrawlLogCdxConverter, CrawlLogsToCdx
+
+CRAWL_LOG = os.path.abspath('../../test/crawl.log')
+
+
+def _expected_captures():
+    """
+    The (URL, status code, WARC filename, offset, length) of each line of the log that should be indexed, found
+    without using the crawl log parser.
+    """
+    captures = []
+    with open(CRAWL_LOG) as f:
+        for line in f:
+            fields = line.split()
+            extra = json.loads(line[line.index(' {') + 1:]) if ' {' in line else {}
+            if fields[3].startswith('http') and int(fields[1]) > 0 and 'warcFilename' in extra:
+                captures.append((fields[3], fields[1], extra['warcFilename'], extra['warcFileOffset'],
+                                 extra['warcFileRecordLength']))
+    return captures
+
+
+def test_sorted_cdx():
+    converter = CrawlLogCdxConverter('dc', '20181126142741')
+    lines = list(converter.sorted_cdx_lines([CRAWL_LOG]))
+    assert lines == sorted(lines)
+    assert converter.stats['cdx_lines'] == len(lines)
+
+    records = [CDX11(line) for line in lines]
+    expected = _expected_captures()
+    assert len(expected) > 10
+    # (There are no de-duplicated captures in the test log, so no revisits.)
+    found = [(r.original, r.statuscode, os.path.basename(r.filename), r.offset_int, r.length_int) for r in records]
+    assert sorted(found) == sorted(expected)
+    for r in records:
+        assert r.timestamp.startswith('20181126')
+        assert r.filename == '/heritrix/output/dc/20181126142741/warcs/%s' % os.path.basename(r.filename)
+
+
+def test_external_merge_sort():
+    in_memory = list(CrawlLogCdxConverter('dc', '20181126142741').sorted_cdx_lines([CRAWL_LOG]))
+    # Spill every few lines, so several sorted runs have to be merged, including one that is only partly full:
+    for chunk_size in [1, 7, len(in_memory) - 1]:
+        converter = CrawlLogCdxConverter('dc', '20181126142741', sort_chunk_size=chunk_size)
+        # Twice over, so there are duplicate lines to merge too:
+        assert list(converter.sorted_cdx_lines([CRAWL_LOG, CRAWL_LOG])) == sorted(in_memory + in_memory)
+
+
+def test_crawl_logs_to_cdx(tmp_path, monkeypatch):
+    # The task output goes under the current folder:
+    monkeypatch.chdir(tmp_path)
+    task = CrawlLogsToCdx('dc', '20181126142741', [CRAWL_LOG])
+    luigi.build([task], local_scheduler=True)
+    with task.output().open() as f:
+        output = f.read().splitlines()
+    assert output == list(CrawlLogCdxConverter('dc', '20181126142741').sorted_cdx_lines([CRAWL_LOG]))
@@ -4,21 +4,28 @@ import hashlib
 import logging
 from urllib.parse import urlparse
 import requests
-from requests.utils import quote
-import xml.dom.minidom
 import luigi.contrib.hdfs
 import luigi.contrib.hadoop
+from prometheus_client import Gauge
 
 from w3act.client import w3act
 from lib.docharvester.document_mdex import DocumentMDEx
+from lib.docharvester.batch_mdex import BatchMDEx
+from lib.docharvester.document_store import get_document_store
+from lib.docharvester.fetch_cache import get_fetch_cache
 from tasks.crawl.w3act import CrawlFeed, ENV_ACT_PASSWORD, ENV_ACT_URL, ENV_ACT_USER
-from lib.targets import TaskTarget
+from lib.windex.cdx_xml import get_capture_checker
+from tasks.common import state_file
 
 logger = logging.getLogger(__name__)
 
 # Define environment variable names here:
 ENV_WAYBACK_URL_PREFIX = 'WAYBACK_URL_PREFIX'
 ENV_CDXSERVER_ENDPOINT = 'CDXSERVER_ENDPOINT'
+ENV_DOCUMENT_STORE = 'DOCUMENT_STORE'
+
+# Where the state of each harvested document is kept:
+DOCUMENT_STORE_PATH = os.environ.get(ENV_DOCUMENT_STORE, state_file(None, 'documents', 'state.db').path)
 
 # Set up a common W3ACT connection to try to avoid constant re-logging-in
 w3act_client = None
@@ -36,6 +43,89 @@ def get_w3act(wurl):
     return w3act_client
 
 
+# Keep hold of the last targets list loaded, so the list (and the index of watched seeds built from it) can be
+# re-used by all the documents processed in the same worker:
+targets_path = None
+targets_list = None
+
+def load_targets(target):
+    global targets_path, targets_list
+    if targets_list is None or targets_path != target.path:
+        with target.open('r') as f:
+            targets_list = json.load(f)
+        targets_path = target.path
+    return targets_list
+
+
+def legacy_state_path(url):
+    """
+    The path of the old one-file-per-document record for a URL, as kept before the document store was used.
+    """
+    hasher = hashlib.md5()
+    hasher.update(url.encode('utf-8'))
+    return state_file(None, 'documents', '{}/{}'.format(urlparse(url).hostname, hasher.hexdigest())).path
+
+
+def new_document_urls(urls, store_path=DOCUMENT_STORE_PATH):
+    """
+    Returns the URLs of the documents that have not been processed yet, checking them all against the store at once.
+
+    Until the old state files have been imported into the store (see to_trackdb.to_store), they are checked too.
+    """
+    store = get_document_store(store_path)
+    urls = store.new_urls(urls)
+    if not store.state_files_imported():
+        urls = [url for url in urls if not os.path.exists(legacy_state_path(url))]
+    return urls
+
+
+class DocumentStateTarget(luigi.Target):
+    """
+    The record of a single harvested document, held in the document store.
+
+    Until the old state files have been imported into the store, a document that only has one of those also exists.
+    """
+
+    def __init__(self, url, store_path=DOCUMENT_STORE_PATH):
+        self.url = url
+        self.store_path = store_path
+
+    def exists(self):
+        store = get_document_store(self.store_path)
+        if self.url in store:
+            return True
+        return not store.state_files_imported() and os.path.exists(legacy_state_path(self.url))
+
+    def put(self, doc):
+        get_document_store(self.store_path).put(doc)
+
+
+def post_document(w, original, doc, output):
+    """
+    Posts an extracted document to W3ACT (unless it was rejected), and records the outcome in the output target.
+
+    :param original: the document as it was before metadata extraction, which is recorded if it was rejected
+    """
+    # Documents may be rejected at this point:
+    if 'match_failed' in doc:
+        logger.error("The document %s has been REJECTED!" % original['document_url'])
+        doc = original
+        doc['status'] = 'REJECTED'
+    else:
+        # Inform W3ACT it's available:
+        doc['status'] = 'ACCEPTED'
+        logger.debug("Sending doc: %s" % doc)
+        r = w.post_document(doc)
+        if r.status_code == 200:
+            logger.info("Document POSTed to W3ACT: %s" % doc['document_url'])
+        else:
+            logger.error("Failed with %s %s\n%s" % (r.status_code, r.reason, r.text))
+            raise Exception("Failed with %s %s\n%s" % (r.status_code, r.reason, r.text))
+
+    # And record the outcome:
+    output.put(doc)
+
+
 class AvailableInWayback(luigi.ExternalTask):
     """
 
@@ -109,20 +199,9 @@ class AvailableInWayback(luigi.ExternalTask):
         Checks if a resource with a particular timestamp is available in the index:
         :return:
         """
-        wburl = "%s?q=type:urlquery+url:%s" % (self.cdxserver_endpoint, quote(self.url))
-        logger.debug("Checking availability %s" % wburl)
-        r = requests.get(wburl)
-        logger.debug("Availability response: %d" % r.status_code)
-        # Is it known, with a matching timestamp?
-        if r.status_code == 200:
-            dom = xml.dom.minidom.parseString(r.text)
-            for de in dom.getElementsByTagName('capturedate'):
-                if de.firstChild.nodeValue == self.ts:
-                    # Excellent, it's been found:
-                    return True
-
-        # Otherwise, not found:
-        return False
+        logger.debug("Checking availability of %s @ %s via %s" % (self.url, self.ts, self.cdxserver_endpoint))
+        # Is it known, with a matching timestamp? (stops as soon as it's found, and re-uses recent checks)
+        return get_capture_checker(self.cdxserver_endpoint).has_capture_date(self.url, self.ts)
 
     def check_if_available(self):
         """
@@ -142,13 +221,30 @@ class AvailableInWayback(luigi.ExternalTask):
             return False
 
 
+def check_available_in_wayback(docs, cdxserver_endpoint=os.environ[ENV_CDXSERVER_ENDPOINT]):
+    """
+    Checks whether a batch of documents are in the CDX index, all at once.
+
+    The results are cached for a short while, so the AvailableInWayback checks for these documents that follow
+    do not need to query the CDX server again. The cache is only held in memory, in this process, so this only
+    helps checks made in the same process. That is the case for the batch extraction route, and for tasks run by a
+    single luigi worker. With more than one worker, tasks are run in forked processes, so a check made by one task
+    does not help the AvailableInWayback checks made (in the worker's main process) when scheduling the tasks it
+    yields, and it is not worth making.
+
+    :return: the number of documents that are available
+    """
+    results = get_capture_checker(cdxserver_endpoint).check(
+        [(doc['document_url'], doc['wayback_timestamp']) for doc in docs])
+    return sum(1 for available in results.values() if available)
+
+
 class ExtractDocumentAndPost(luigi.Task):
     """
     Hook into w3act, extract MD and resolve the associated target.
 
-    Note that the output file uses only the URL to make a hash-based identifier grouped by host, so this will only
-    process each URL it sees once. This makes sense as the current model does not allow different
-    Documents at the same URL in W3ACT.
+    Note that the output record is keyed only on the URL, so this will only process each URL it sees once. This
+    makes sense as the current model does not allow different Documents at the same URL in W3ACT.
     """
     task_namespace = 'doc'
     job = luigi.Parameter()
@@ -166,38 +262,98 @@ class ExtractDocumentAndPost(luigi.Task):
         }
 
     @staticmethod
-    def document_target(host, hash):
-        return TaskTarget('documents','{}/{}'.format(host, hash))
+    def document_target_for(url):
+        return DocumentStateTarget(url)
 
     def output(self):
-        hasher = hashlib.md5()
-        hasher.update(self.doc['document_url'].encode('utf-8'))
-        return self.document_target(urlparse(self.doc['document_url']).hostname, hasher.hexdigest())
+        return self.document_target_for(self.doc['document_url'])
 
     def run(self):
         # Set up a W3ACT client:
         w = get_w3act(self.w3act)
 
         # Lookup Target and extract any additional metadata:
-        targets = json.load(self.input()['targets'].open('r'))
+        targets = load_targets(self.input()['targets'])
         doc = DocumentMDEx(targets, self.doc.get_wrapped().copy(), self.source).mdex()
 
-        # Documents may be rejected at this point:
-        if 'match_failed' in doc:
-            logger.error("The document %s has been REJECTED!" % self.doc['document_url'])
-            doc = self.doc.get_wrapped().copy()
-            doc['status'] = 'REJECTED'
+        # Post to W3ACT and write out to the status file:
+        post_document(w, self.doc.get_wrapped().copy(), doc, self.output())
+
+        logger.info("Landing page cache: %s" % json.dumps(get_fetch_cache().summary()))
+
+    def get_metrics(self, registry):
+        # type: (CollectorRegistry) -> None
+
+        stats = get_fetch_cache().summary()
+        g = Gauge('ukwa_mdex_fetch_cache_requests',
+                  'Landing page requests made during document metadata extraction, by result.',
+                  labelnames=['result'], registry=registry)
+        for result in ['hits', 'disk_hits', 'revalidated', 'misses']:
+            g.labels(result=result).set(stats[result])
+
+        g = Gauge('ukwa_mdex_fetch_cache_hit_rate',
+                  'Proportion of landing page requests served without downloading the page again.',
+                  registry=registry)
+        g.set(stats['hit_rate'])
+
+
+def extract_and_post_documents(docs, targets, w3act_url):
+    """
+    Extracts the metadata for a batch of documents concurrently (see BatchMDEx), and posts them to W3ACT.
+
+    The outcome for each document is recorded in the document store, as for ExtractDocumentAndPost, so documents are
+    only processed once whichever route they go through. Documents that are not in Wayback yet are left for a later run.
+
+    :return: the throughput report for the batch
+    """
+    w = get_w3act(w3act_url)
+
+    # Only extract documents that are available (checking them all at once first):
+    check_available_in_wayback(docs)
+    ready = []
+    waiting = 0
+    for doc in docs:
+        if AvailableInWayback(doc['document_url'], doc['wayback_timestamp']).complete():
+            ready.append((doc, doc['source']))
         else:
-            # Inform W3ACT it's available:
-            doc['status'] = 'ACCEPTED'
-            logger.debug("Sending doc: %s" % doc)
-            r = w.post_document(doc)
-            if r.status_code == 200:
-                logger.info("Document POSTed to W3ACT: %s" % doc['document_url'])
-            else:
-                logger.error("Failed with %s %s\n%s" % (r.status_code, r.reason, r.text))
-                raise Exception("Failed with %s %s\n%s" % (r.status_code, r.reason, r.text))
+            waiting += 1
+
+    failed = []
+    def post(original, doc):
+        if doc is None:
+            failed.append(original['document_url'])
+            return
+        post_document(w, dict(original), doc, ExtractDocumentAndPost.document_target_for(original['document_url']))
+
+    batch = BatchMDEx(targets)
+    batch.extract(ready, post)
+
+    report = batch.report()
+    report['not_yet_available'] = waiting
+    report['failed'] = len(failed)
+    logger.info("Batch document extraction: %s" % json.dumps(report))
+    return report
+
+
+def batch_report_metrics(report, registry):
+    # type: (dict, CollectorRegistry) -> None
+
+    g = Gauge('ukwa_mdex_batch_documents',
+              'Documents handled by the last batch metadata extraction, by outcome.',
+              labelnames=['outcome'], registry=registry)
+    g.labels(outcome='extracted').set(report['documents'] - report['failed'])
+    g.labels(outcome='failed').set(report['failed'])
+    g.labels(outcome='not_yet_available').set(report['not_yet_available'])
+
+    g = Gauge('ukwa_mdex_batch_docs_per_minute',
+              'Throughput of the last batch metadata extraction, in documents per minute.',
+              registry=registry)
+    g.set(report['docs_per_minute'])
 
-        # And write out to the status file
-        with self.output().open('w') as out_file:
-            out_file.write('{}'.format(json.dumps(doc, indent=4)))
+    g = Gauge('ukwa_mdex_host_latency_seconds',
+              'Time taken to extract the metadata for a document, by host.',
+              labelnames=['host', 'stat'], registry=registry)
+    for host, stats in report['hosts'].items():
+        for stat in ['mean', 'p95', 'max']:
+            if '%s_seconds' % stat in stats:
+                g.labels(host=host, stat=stat).set(stats['%s_seconds' % stat])
@@ -0,0 +1,157 @@
+"""
+Per-host and per-IP fetch latency and throughput, from the fetch-stats crawl log report (see FetchStatsAggregator).
+
+The report is generated locally, or on Hadoop for logs on HDFS, and written out as JSON. The stats for the most
+recent time window are also made available as Prometheus gauges, for the busiest hosts and IPs, so they can be
+pushed to the gateway along with the other task metrics.
+
+The most recent window of a running crawl has usually only just started, so the rates for each window are worked
+out over the part of it that the logs cover, and windows that are not completely covered are flagged as such.
+"""
+import json
+import logging
+import datetime
+import luigi
+from prometheus_client import Gauge
+
+from tasks.analyse.crawl_logs.log_reports import LocalLogReports, SplitLogReports
+
+logger = logging.getLogger(__name__)
+
+# How many of the busiest hosts and IPs to make gauges for:
+METRICS_TOP_N = 50
+
+
+def read_fetch_stats(in_file):
+    """
+    Reads the lines of a fetch-stats report, returning the stats for each host/IP and time window in order.
+    """
+    stats = []
+    for line in in_file:
+        key, value = line.rstrip('\n').split('\t', 1)
+        stats.append(json.loads(value))
+    set_window_coverage(stats)
+    return stats
+
+
+def _parse_time(timestamp):
+    return datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def set_window_coverage(stats):
+    """
+    Works out how much of each time window the logs cover, and corrects the rates to be over just that part.
+
+    The first window only counts from the first line logged in it, and the last window only up to the last line
+    logged in it, as the crawl may have started or stopped (or still be running) part way through them. Windows in
+    between are taken to be covered completely. Each item gets the seconds covered as 'covered_seconds', and
+    'complete_window' is set if that's the whole window.
+    """
+    windows = {}
+    for item in stats:
+        first, last = windows.get(item['window'], (item['first'], item['last']))
+        windows[item['window']] = (min(first, item['first']), max(last, item['last']))
+    if not windows:
+        return
+    earliest = min(windows.keys())
+    latest = max(windows.keys())
+    covered = {}
+    for window, (first, last) in windows.items():
+        start = _parse_time(window)
+        end = start + datetime.timedelta(seconds=stats[0]['window_seconds'])
+        if window == earliest:
+            start = max(start, _parse_time(first))
+        if window == latest:
+            end = min(end, _parse_time(last))
+        # Count at least a second, so a window with just one fetch time in it has a rate:
+        covered[window] = max(1.0, (end - start).total_seconds())
+    for item in stats:
+        seconds = covered[item['window']]
+        item['covered_seconds'] = seconds
+        item['complete_window'] = seconds >= item['window_seconds']
+        item['requests_per_second'] = item['lines'] / seconds
+        item['bytes_per_second'] = item['bytes'] / seconds
+
+
+def latest_window(stats, top_n=METRICS_TOP_N):
+    """
+    Picks out the stats for the most recent time window, for the top_n busiest hosts and top_n busiest IPs.
+
+    For a running crawl this window will usually be incomplete (see set_window_coverage).
+    """
+    if not stats:
+        return []
+    window = max(item['window'] for item in stats)
+    latest = []
+    for kind in ['host', 'ip']:
+        items = [item for item in stats if item['window'] == window and item['kind'] == kind]
+        items.sort(key=lambda item: (-item['lines'], item['name']))
+        latest.extend(items[:top_n])
+    return latest
+
+
+class FetchStatsReport(luigi.Task):
+    """
+    Generates the fetch-stats report for a set of crawl logs, and outputs it as JSON.
+
+    If the logs are on HDFS, the report is generated by the LogReports Hadoop job, otherwise it is done locally.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+
+    # The stats for the latest window, once run:
+    latest = None
+
+    def requires(self):
+        if self.from_hdfs:
+            return SplitLogReports(self.job, self.launch_id, self.log_paths, ['fetch-stats'], None, self.from_hdfs)
+        return LocalLogReports(self.job, self.launch_id, self.log_paths, ['fetch-stats'])
+
+    def output(self):
+        return luigi.LocalTarget(path="task-state/%s/%s/crawl-logs-%i.fetch-stats.json" %
+                                      (self.job, self.launch_id, len(self.log_paths)))
+
+    def run(self):
+        with self.input()['fetch-stats'].open('r') as in_file:
+            stats = read_fetch_stats(in_file)
+        self.latest = latest_window(stats)
+        logger.info("Got fetch stats for %i hosts/IPs over all windows." % len(stats))
+        with self.output().open('w') as f:
+            json.dump({ 'job': self.job, 'launch_id': self.launch_id, 'stats': stats }, f, indent=2)
+
+    def get_metrics(self, registry):
+        # type: (CollectorRegistry) -> None
+
+        if not self.latest:
+            return
+
+        labelnames = ['job', 'kind', 'name']
+        g_rate = Gauge('ukwa_crawl_fetch_requests_per_second',
+                       'Crawl requests per second over the latest window, by host or IP.',
+                       labelnames=labelnames, registry=registry)
+        g_bytes = Gauge('ukwa_crawl_fetch_bytes_per_second',
+                        'Bytes downloaded per second over the latest window, by host or IP.',
+                        labelnames=labelnames, registry=registry)
+        g_fetch = Gauge('ukwa_crawl_fetch_throughput_bytes_per_second',
+                        'Bytes downloaded per second spent fetching, over the latest window, by host or IP.',
+                        labelnames=labelnames, registry=registry)
+        g_duration = Gauge('ukwa_crawl_fetch_duration_ms',
+                           'Fetch duration percentiles over the latest window, in milliseconds, by host or IP.',
+                           labelnames=labelnames + ['stat'], registry=registry)
+        g_retry = Gauge('ukwa_crawl_fetch_retry_rate',
+                        'Proportion of requests that needed more than one try over the latest window, by host or IP.',
+                        labelnames=labelnames, registry=registry)
+
+        for item in self.latest:
+            labels = { 'job': self.job, 'kind': item['kind'], 'name': item['name'] }
+            g_rate.labels(**labels).set(item['requests_per_second'])
+            g_bytes.labels(**labels).set(item['bytes_per_second'])
+            if item['fetch_bytes_per_second'] is not None:
+                g_fetch.labels(**labels).set(item['fetch_bytes_per_second'])
+            for stat, value in item['duration_ms'].items():
+                if value is not None:
+                    g_duration.labels(stat=stat, **labels).set(value)
+            g_retry.labels(**labels).set(item['retry_rate'])
@@ -0,0 +1,330 @@
+"""
+Support for passing the intermediate records of the crawl log Hadoop streaming jobs (i.e. the mapper output, and
+the combiner and reducer input) in a compact binary form, rather than as tab-separated lines of text.
+
+By default, Luigi passes each intermediate key and value as a Python repr() string, which the next stage has to
+eval(), and most of our jobs also wrap their values up as JSON strings. Instead, each key and value can be packed
+in the MessagePack format (https://msgpack.org/), and passed as a length-prefixed Hadoop 'typed bytes' value,
+which Hadoop streaming understands natively. So, the dicts, lists, strings and numbers our jobs emit are passed
+through as they are, without any of that text handling. The packing is done here, so no extra modules have to be
+shipped to the Hadoop nodes.
+
+See https://hadoop.apache.org/docs/stable/api/org/apache/hadoop/typedbytes/package-summary.html
+
+Tasks choose the encoding with the intermediate_format parameter (see CrawlLogJobTask). Note that Hadoop sorts
+typed bytes keys by their encoded form, so keys arrive at each reducer grouped as usual, but not necessarily in
+the order they would have been as text. When a job runs locally (i.e. through Luigi's LocalJobRunner), the text
+encoding is always used, as that runner sorts the intermediate records as lines of text.
+"""
+import sys
+import json
+import struct
+import luigi
+import luigi.contrib.hadoop
+
+# The intermediate formats:
+TEXT = 'text'
+TYPED_BYTES = 'typedbytes'
+
+# The typed bytes type code for raw bytes, as defined by org.apache.hadoop.typedbytes.Type:
+TYPE_BYTES = 0
+
+# How much of the input stream to read at a time:
+READ_CHUNK_SIZE = 1024 * 1024
+
+_INT = struct.Struct('>i')
+_B = struct.Struct('>B')
+_H = struct.Struct('>H')
+_I = struct.Struct('>I')
+_Q = struct.Struct('>Q')
+_b = struct.Struct('>b')
+_h = struct.Struct('>h')
+_q = struct.Struct('>q')
+_D = struct.Struct('>d')
+
+
+class IncompleteRecord(Exception):
+    """
+    Raised when a record runs off the end of the data read so far, with the position the data needs to reach.
+    """
+    pass
+
+
+def _pack_int(value, parts):
+    if 0 <= value < 0x80:
+        parts.append(_B.pack(value))
+    elif -0x20 <= value < 0:
+        parts.append(_b.pack(value))
+    elif 0 <= value <= 0xff:
+        parts.append(b'\xcc' + _B.pack(value))
+    elif 0 <= value <= 0xffff:
+        parts.append(b'\xcd' + _H.pack(value))
+    elif 0 <= value <= 0xffffffff:
+        parts.append(b'\xce' + _I.pack(value))
+    elif 0 <= value:
+        parts.append(b'\xcf' + _Q.pack(value))
+    elif -0x80 <= value:
+        parts.append(b'\xd0' + _b.pack(value))
+    elif -0x8000 <= value:
+        parts.append(b'\xd1' + _h.pack(value))
+    elif -0x80000000 <= value:
+        parts.append(b'\xd2' + _INT.pack(value))
+    else:
+        parts.append(b'\xd3' + _q.pack(value))
+
+
+def _pack_header(length, fix, fix_limit, codes, parts):
+    # Fixed-size types have the length in the type byte, others are followed by a 1, 2 or 4 byte length:
+    if length < fix_limit:
+        parts.append(_B.pack(fix | length))
+    elif codes[0] is not None and length <= 0xff:
+        parts.append(codes[0] + _B.pack(length))
+    elif length <= 0xffff:
+        parts.append(codes[1] + _H.pack(length))
+    else:
+        parts.append(codes[2] + _I.pack(length))
+
+
+def _pack_str(value, parts):
+    data = value.encode('utf-8')
+    _pack_header(len(data), 0xa0, 32, (b'\xd9', b'\xda', b'\xdb'), parts)
+    parts.append(data)
+
+
+def _pack_bytes(value, parts):
+    _pack_header(len(value), 0, 0, (b'\xc4', b'\xc5', b'\xc6'), parts)
+    parts.append(value)
+
+
+def _pack_array(value, parts):
+    _pack_header(len(value), 0x90, 16, (None, b'\xdc', b'\xdd'), parts)
+    for item in value:
+        _pack(item, parts)
+
+
+def _pack_map(value, parts):
+    _pack_header(len(value), 0x80, 16, (None, b'\xde', b'\xdf'), parts)
+    for key, item in value.items():
+        _pack(key, parts)
+        _pack(item, parts)
+
+
+_PACKERS = {
+    str: _pack_str,
+    int: _pack_int,
+    float: lambda value, parts: parts.append(b'\xcb' + _D.pack(value)),
+    bool: lambda value, parts: parts.append(b'\xc3' if value else b'\xc2'),
+    type(None): lambda value, parts: parts.append(b'\xc0'),
+    bytes: _pack_bytes,
+    list: _pack_array,
+    tuple: _pack_array,
+    dict: _pack_map,
+}
+
+
+def _pack(value, parts):
+    packer = _PACKERS.get(type(value), None)
+    if packer is None:
+        raise Exception("Cannot pack a value of type %s: %r" % (type(value).__name__, value))
+    packer(value, parts)
+
+
+def packb(value):
+    """
+    Packs a value in the MessagePack format.
+
+    Strings, ints, floats, booleans, None, bytes, lists, tuples and dicts (of any of these) are supported. Tuples
+    are packed as arrays, so they are unpacked as lists.
+    """
+    parts = []
+    _pack(value, parts)
+    return b''.join(parts)
+
+
+def _unpack_sized(data, pos, length, kind):
+    if kind == 0:
+        end = pos + length
+        return data[pos:end].decode('utf-8'), end
+    elif kind == 1:
+        end = pos + length
+        return bytes(data[pos:end]), end
+    elif kind == 2:
+        value = []
+        for i in range(length):
+            item, pos = _unpack(data, pos)
+            value.append(item)
+        return value, pos
+    else:
+        value = {}
+        for i in range(length):
+            key, pos = _unpack(data, pos)
+            value[key], pos = _unpack(data, pos)
+        return value, pos
+
+
+# The other type codes: (struct to read, kind) where kind is None for a plain value, or the kind of the value
+# whose length has been read:
+_CODES = {
+    0xcc: (_B, None), 0xcd: (_H, None), 0xce: (_I, None), 0xcf: (_Q, None),
+    0xd0: (_b, None), 0xd1: (_h, None), 0xd2: (_INT, None), 0xd3: (_q, None),
+    0xcb: (_D, None),
+    0xd9: (_B, 0), 0xda: (_H, 0), 0xdb: (_I, 0),
+    0xc4: (_B, 1), 0xc5: (_H, 1), 0xc6: (_I, 1),
+    0xdc: (_H, 2), 0xdd: (_I, 2),
+    0xde: (_H, 3), 0xdf: (_I, 3),
+}
+
+
+def _unpack(data, pos):
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    elif code >= 0xe0:
+        return code - 0x100, pos
+    elif code >= 0xa0 and code < 0xc0:
+        end = pos + (code & 0x1f)
+        return data[pos:end].decode('utf-8'), end
+    elif code < 0x90:
+        return _unpack_sized(data, pos, code & 0x0f, 3)
+    elif code < 0xa0:
+        return _unpack_sized(data, pos, code & 0x0f, 2)
+    elif code == 0xc0:
+        return None, pos
+    elif code == 0xc2:
+        return False, pos
+    elif code == 0xc3:
+        return True, pos
+    unpacker, kind = _CODES.get(code, (None, None))
+    if unpacker is None:
+        raise Exception("Unsupported MessagePack type code 0x%x at position %i" % (code, pos - 1))
+    value = unpacker.unpack_from(data, pos)[0]
+    pos += unpacker.size
+    if kind is None:
+        return value, pos
+    return _unpack_sized(data, pos, value, kind)
+
+
+def unpackb(data):
+    value, pos = _unpack(data, 0)
+    return value
+
+
+def write_pairs(outputs, stream):
+    """
+    Writes each (key, value) pair as two typed bytes 'bytes' values, each holding the packed key or value, as
+    expected from a streaming mapper or combiner.
+    """
+    parts = []
+    for output in outputs:
+        for item in output:
+            data = packb(item)
+            parts.append(b'\x00')
+            parts.append(_INT.pack(len(data)))
+            parts.append(data)
+        if len(parts) > 10000:
+            stream.write(b''.join(parts))
+            parts = []
+    stream.write(b''.join(parts))
+    stream.flush()
+
+
+def _read_frame(data, pos):
+    if pos + 5 > len(data):
+        raise IncompleteRecord(pos + 5)
+    if data[pos] != TYPE_BYTES:
+        raise Exception("Expected typed bytes 'bytes' but found type code %i at position %i" % (data[pos], pos))
+    end = pos + 5 + _INT.unpack_from(data, pos + 1)[0]
+    if end > len(data):
+        raise IncompleteRecord(end)
+    return pos + 5, end
+
+
+def read_pairs(stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Reads (key, value) pairs written by write_pairs from a binary stream, as passed to a streaming combiner or
+    reducer.
+    """
+    data = b''
+    pos = 0
+    eof = False
+    while True:
+        try:
+            key_start, key_end = _read_frame(data, pos)
+            value_start, value_end = _read_frame(data, key_end)
+        except IncompleteRecord as e:
+            if eof:
+                if pos < len(data):
+                    raise Exception("Typed bytes input ended part way through a record")
+                return
+            # Read at least enough for the incomplete record, in one go:
+            wanted = e.args[0] - pos
+            chunks = [data[pos:]]
+            size = len(chunks[0])
+            while size < wanted or len(chunks) == 1:
+                chunk = stream.read(max(chunk_size, wanted - size))
+                if not chunk:
+                    eof = True
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            data = b''.join(chunks)
+            pos = 0
+            continue
+        yield _unpack(data, key_start)[0], _unpack(data, value_start)[0]
+        pos = value_end
+
+
+class CrawlLogJobTask(luigi.contrib.hadoop.JobTask):
+    """
+    A Hadoop streaming job over crawl logs, where the intermediate records can be passed as typed bytes.
+
+    Mappers should pass any structured values through encode_value(), and reducers and combiners should pass them
+    through decode_value(), so the same code works with either format: when passed as text, values are wrapped up
+    as JSON strings, as before, and when passed as typed bytes they are passed as they are.
+    """
+    intermediate_format = luigi.ChoiceParameter(choices=[TEXT, TYPED_BYTES], default=TEXT,
+                                                significant=False, positional=False)
+
+    def jobconfs(self):
+        jcs = super(CrawlLogJobTask, self).jobconfs()
+        if self.intermediate_format == TYPED_BYTES:
+            jcs.append('stream.map.output=typedbytes')
+            jcs.append('stream.reduce.input=typedbytes')
+        return jcs
+
+    def encode_value(self, value):
+        if self.intermediate_format == TYPED_BYTES:
+            return value
+        return json.dumps(value)
+
+    def decode_value(self, value):
+        if self.intermediate_format == TYPED_BYTES:
+            return value
+        return json.loads(value)
+
+    def _uses_typed_bytes(self, stream):
+        # Streams without an underlying binary buffer are the in-memory ones used when running locally:
+        return self.intermediate_format == TYPED_BYTES and hasattr(stream, 'buffer')
+
+    def internal_writer(self, outputs, stdout):
+        if not self._uses_typed_bytes(stdout):
+            return super(CrawlLogJobTask, self).internal_writer(outputs, stdout)
+        stdout.flush()
+        write_pairs(outputs, stdout.buffer)
+
+    def run_reducer(self, stdin=sys.stdin, stdout=sys.stdout):
+        if not self._uses_typed_bytes(stdin):
+            return super(CrawlLogJobTask, self).run_reducer(stdin, stdout)
+        self.init_hadoop()
+        self.init_reducer()
+        outputs = self._reduce_input(read_pairs(stdin.buffer), self.reducer, self.final_reducer)
+        self.writer(outputs, stdout)
+
+    def run_combiner(self, stdin=sys.stdin, stdout=sys.stdout):
+        if not self._uses_typed_bytes(stdin):
+            return super(CrawlLogJobTask, self).run_combiner(stdin, stdout)
+        self.init_hadoop()
+        self.init_combiner()
+        outputs = self._reduce_input(read_pairs(stdin.buffer), self.combiner, self.final_combiner)
+        self.internal_writer(outputs, stdout)
@@ -0,0 +1,119 @@
+"""
+Benchmarks the encodings of the intermediate records of the crawl log Hadoop streaming jobs, comparing the cost of
+encoding and decoding them, and their size, when passed as text (as Luigi does by default) or packed as typed bytes.
+
+The records are those the LogReports mappers emit for the given logs. For text, this measures both the way
+LogReports passes values (as Python repr() strings) and the way AnalyseLogFile and SummariseLogFiles have been
+passing them (as JSON strings, which then also get repr()'d).
+
+Run as:
+
+    python -m tasks.analyse.crawl_logs.intermediate_bench [-r REPEATS] [log_file ...]
+
+If no log files are given, the test/*.log fixtures are used.
+"""
+import io
+import sys
+import glob
+import json
+import time
+import argparse
+from tasks.analyse.crawl_logs.log_reports import parse_line, make_aggregators, AGGREGATORS
+from tasks.analyse.crawl_logs.intermediate import read_pairs, write_pairs
+
+
+def map_records(lines, reports):
+    aggregators = make_aggregators(reports, 'bench', 'bench', False, None)
+    records = []
+    for line in lines:
+        log = parse_line(line)
+        if log is None:
+            continue
+        for aggregator in aggregators:
+            for key, value in aggregator.map(log):
+                records.append(((aggregator.name, key), value))
+    return records
+
+
+def encode_repr(records):
+    out = io.StringIO()
+    for output in records:
+        print("\t".join(map(repr, output)), file=out)
+    return out.getvalue()
+
+
+def decode_repr(data):
+    return [tuple(map(eval, line.split("\t"))) for line in data.splitlines()]
+
+
+def encode_json(records):
+    return encode_repr((key, json.dumps(value)) for key, value in records)
+
+
+def decode_json(data):
+    return [(key, json.loads(value)) for key, value in decode_repr(data)]
+
+
+def encode_typed_bytes(records):
+    out = io.BytesIO()
+    write_pairs(records, out)
+    return out.getvalue()
+
+
+def decode_typed_bytes(data):
+    return list(read_pairs(io.BytesIO(data)))
+
+
+ENCODINGS = [
+    ('text (repr values)', encode_repr, decode_repr),
+    ('text (JSON values)', encode_json, decode_json),
+    ('msgpack typed bytes', encode_typed_bytes, decode_typed_bytes),
+]
+
+
+def _normalise(records):
+    # Packed tuples come back as lists, but repr() text keeps them as tuples, so compare keys as lists:
+    return [(list(key), value) for key, value in records]
+
+
+def _timed(fn, arg):
+    start = time.perf_counter()
+    result = fn(arg)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='intermediate_bench')
+    parser.add_argument('-r', '--repeats', type=int, default=50, help='Number of times to repeat the lines.')
+    parser.add_argument('log_files', nargs='*', help='Crawl log files to read, instead of the test/*.log fixtures.')
+    args = parser.parse_args()
+
+    lines = []
+    for log_file in args.log_files or sorted(glob.glob('test/*.log')):
+        with open(log_file, encoding='utf-8', errors='replace') as f:
+            lines.extend(f.readlines())
+
+    # The documents report needs a targets file, so is left out:
+    reports = [name for name in sorted(AGGREGATORS.keys()) if name != 'documents']
+    records = map_records(lines, reports) * args.repeats
+    expected = _normalise(records)
+    print("Encoding %i intermediate records from %i lines..." % (len(records), len(lines) * args.repeats))
+    print("%-20s %12s %12s %14s %10s" % ('', 'encode us/rec', 'decode us/rec', 'bytes', 'bytes/rec'))
+
+    mismatches = 0
+    for label, encode, decode in ENCODINGS:
+        data, encode_time = _timed(encode, records)
+        decoded, decode_time = _timed(decode, data)
+        size = len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+        print("%-20s %12.2f %12.2f %14i %10.1f" % (label, 1e6 * encode_time / len(records),
+                                                    1e6 * decode_time / len(records), size, size / len(records)))
+        if _normalise(decoded) != expected:
+            mismatches += 1
+            print("Decoded %s records do not match the originals!" % label)
+
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import io
+from itertools import groupby
+from tasks.analyse.crawl_logs.intermediate import packb, unpackb, write_pairs, read_pairs, TEXT, TYPED_BYTES
+from tasks.analyse.crawl_logs.log_reports import LogReports
+
+REPORTS = ['status-codes', 'dead-seeds', 'host-summary', 'by-day-host-source']
+
+
+def test_pack_ints():
+    # Each side of every boundary between the integer encodings:
+    limits = [0, 0x7f, 0xff, 0xffff, 0xffffffff, 0xffffffffffffffff,
+              -0x20, -0x80, -0x8000, -0x80000000, -0x8000000000000000]
+    for limit in limits:
+        for value in [limit - 1, limit, limit + 1]:
+            if -0x8000000000000000 <= value <= 0xffffffffffffffff:
+                assert unpackb(packb(value)) == value
+
+
+def test_pack_strings_and_bytes():
+    # Each side of the fixed-size, 1, 2 and 4 byte length headers:
+    for length in [0, 1, 31, 32, 33, 255, 256, 65535, 65536]:
+        text = 'x' * length
+        assert unpackb(packb(text)) == text
+        data = b'\x00' * length
+        assert unpackb(packb(data)) == data
+    assert unpackb(packb('été \U0001F600')) == 'été \U0001F600'
+
+
+def test_pack_containers():
+    value = {
+        'list': [1, -1, 1.5, None, True, False, 'a', b'b', [], {}],
+        'nested': { 'a': [{ 'b': [1, 2, { 'c': 'd' }] }] },
+        'long-list': list(range(70000)),
+        'long-map': dict(('k%i' % i, i) for i in range(20)),
+        'tuple': (1, 2),
+    }
+    expected = dict(value)
+    expected['tuple'] = [1, 2]
+    assert unpackb(packb(value)) == expected
+
+
+def test_read_pairs_in_small_chunks():
+    pairs = [(('report', 'key-%i' % i), { 'count': i, 'name': 'x' * (i % 300) }) for i in range(3000)]
+    stream = io.BytesIO()
+    write_pairs(pairs, stream)
+    stream.seek(0)
+    assert list(read_pairs(stream, chunk_size=7)) == [(list(key), value) for key, value in pairs]
+
+
+def _task(intermediate_format):
+    task = LogReports('dc', '20170220090024', ['../../test/crawl.log'], REPORTS,
+                      intermediate_format=intermediate_format)
+    # These are normally set up when the task is run:
+    task.serialize = repr
+    task.internal_serialize = repr
+    task.deserialize = eval
+    return task
+
+
+def _map(task):
+    task.init_mapper()
+    pairs = []
+    with open('../../test/crawl.log') as f:
+        for line in f:
+            pairs.extend(task.mapper(line))
+    return pairs
+
+
+def _binary_stream(data=b''):
+    # Like sys.stdin and sys.stdout when run by Hadoop streaming, with a binary buffer underneath:
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+
+def _run_typed_bytes(task, stage, pairs):
+    # Hadoop sorts typed bytes keys by their encoded form:
+    pairs = sorted(pairs, key=lambda pair: packb(pair[0]))
+    stdin = io.BytesIO()
+    write_pairs(pairs, stdin)
+    stdout = _binary_stream()
+    stage(_binary_stream(stdin.getvalue()), stdout)
+    stdout.flush()
+    return stdout.buffer.getvalue()
+
+
+def test_run_combiner_and_reducer_with_typed_bytes():
+    # The same reports through the text route, for comparison:
+    task = _task(TEXT)
+    pairs = _map(task)
+    combined = []
+    for key, values in groupby(sorted(pairs, key=lambda pair: repr(pair[0])), key=lambda pair: pair[0]):
+        combined.extend(task.combiner(key, [value for k, value in values]))
+    expected = io.StringIO()
+    task.run_reducer(io.StringIO(''.join('%r\t%r\n' % pair for pair in sorted(combined, key=repr))), expected)
+
+    task = _task(TYPED_BYTES)
+    pairs = _map(task)
+    combined = list(read_pairs(io.BytesIO(_run_typed_bytes(task, task.run_combiner, pairs))))
+    assert len(combined) < len(pairs)
+    reduced = _run_typed_bytes(task, task.run_reducer, combined).decode('utf-8')
+
+    assert len(reduced.splitlines()) > 10
+    assert sorted(reduced.splitlines()) == sorted(expected.getvalue().splitlines())
@@ -2,12 +2,16 @@ import os
 import time
 import json
 import hashlib
+import multiprocessing
 import luigi.contrib.hdfs
 import luigi.contrib.hadoop
 from luigi.contrib.hdfs.format import Plain, PlainDir
 
 from tasks.analyse.crawl_logs.log_analysis_hadoop import AnalyseLogFile, SummariseLogFiles
-from tasks.analyse.crawl_logs.documents import ExtractDocumentAndPost
+from tasks.analyse.crawl_logs.log_increments import IncrementalLogReports, INCREMENTAL_REPORTS
+from tasks.analyse.crawl_logs.documents import ExtractDocumentAndPost, extract_and_post_documents, \
+    batch_report_metrics, check_available_in_wayback, load_targets, new_document_urls, ENV_ACT_URL
+from lib.docharvester.fetch_cache import get_fetch_cache
 from tasks.crawl.w3act import CrawlFeed
 from tasks.common import state_file, logger
 from lib.webhdfs import webhdfs
@@ -106,10 +110,16 @@ class AnalyseAndProcessDocuments(luigi.Task):
     log_paths = luigi.ListParameter()
     targets_path = luigi.Parameter()
     from_hdfs = luigi.BoolParameter(default=False)
+    # Extract documents concurrently in this task, rather than yielding a task for each one:
+    batch_extract = luigi.BoolParameter(default=False)
+    w3act = luigi.Parameter(default=os.environ.get(ENV_ACT_URL, None))
 
     # Size of bunches of jobs to yield
     bunch_size = 10000
 
+    # Report from the batch extraction, if any:
+    batch_report = None
+
     def requires(self):
         # Analyse the log file on HDFS, using only one reducer:
         return AnalyseLogFile(self.job, self.launch_id, self.log_paths, self.targets_path, self.from_hdfs, 1)
@@ -118,29 +128,80 @@ class AnalyseAndProcessDocuments(luigi.Task):
         return TaskTarget('documents', 'posted-{}-{}-{}.jsonl'.format(self.job, self.launch_id, len(self.log_paths)))
 
     def run(self):
+        # When extracting in batches, the targets are needed here:
+        if self.batch_extract:
+            targets = load_targets((yield CrawlFeed('all')))
+
         # Loop over documents discovered, and attempt to post to W3ACT:
         with self.output().open('w') as out_file:
-            with self.input().open() as in_file:
-                counter = 0
-                tasks = []
-                for line in in_file:
-                    #logger.info("Got line: %s" % line)
-                    prefix, docjson = line.decode('utf-8').strip().split("\t", 1)
-                    if prefix.startswith("DOCUMENT"):
-                        doc = json.loads(docjson)
-                        #logger.info("Got doc: %s" % doc['document_url'])
-                        out_file.write("%s\n" % json.dumps(doc))
-                        edp_task = ExtractDocumentAndPost(self.job, self.launch_id, doc, doc["source"])
-                        # Reduce Luigi scheduler overhead by only enqueuing incomplete tasks:
-                        if not edp_task.complete():
-                            tasks.append(edp_task)
-                            counter += 1
-                        # Group tasks into bunches:
-                        if counter%self.bunch_size == 0:
-                            yield tasks
-                            tasks = []
-                if len(tasks) > 0:
-                    yield tasks
+            docs = []
+            for doc in self.documents():
+                #logger.info("Got doc: %s" % doc['document_url'])
+                out_file.write("%s\n" % json.dumps(doc))
+                docs.append(doc)
+
+            # Only process documents that have not been seen before, checking them all against the store at once:
+            new_urls = set(new_document_urls([doc['document_url'] for doc in docs]))
+            docs = [doc for doc in docs if doc['document_url'] in new_urls]
+            logger.info("Found %i new documents." % len(docs))
+
+            if self.batch_extract:
+                self.batch_report = extract_and_post_documents(docs, targets, self.w3act)
+                # As with the individual tasks, try again later if any documents could not be processed yet:
+                pending = self.batch_report['not_yet_available'] + self.batch_report['failed']
+                if pending > 0:
+                    raise Exception("%i of %i documents could not be processed yet!" % (pending, len(docs)))
+            else:
+                # Group tasks into bunches. The tasks check their availability when they are scheduled, which is
+                # done in the worker's main process, so if this is running there too (i.e. with one worker), check
+                # each bunch in one go first to save the tasks doing it one at a time (see check_available_in_wayback):
+                in_main_process = multiprocessing.current_process().name == 'MainProcess'
+                for i in range(0, len(docs), self.bunch_size):
+                    if in_main_process:
+                        check_available_in_wayback(docs[i:i + self.bunch_size])
+                    yield [ExtractDocumentAndPost(self.job, self.launch_id, doc, doc["source"])
+                           for doc in docs[i:i + self.bunch_size]]
+
+        logger.info("Landing page cache for this run: %s" % json.dumps(get_fetch_cache().summary()))
+
+    def documents(self):
+        """
+        Yields the documents found in the crawl logs.
+        """
+        with self.input().open() as in_file:
+            for line in in_file:
+                #logger.info("Got line: %s" % line)
+                prefix, docjson = line.decode('utf-8').strip().split("\t", 1)
+                if prefix.startswith("DOCUMENT"):
+                    yield json.loads(docjson)
+
+    def get_metrics(self, registry):
+        # type: (CollectorRegistry) -> None
+
+        if self.batch_report:
+            batch_report_metrics(self.batch_report, registry)
+
+
+class ProcessNewDocuments(AnalyseAndProcessDocuments):
+    """
+    Processes the documents found by IncrementalLogReports, once per increment.
+
+    All the documents found so far are passed through, but only those not already in the document store are processed.
+    """
+    increment = luigi.IntParameter()
+
+    def requires(self):
+        return IncrementalLogReports(self.job, self.launch_id, self.log_paths, self.from_hdfs, self.targets_path,
+                                     INCREMENTAL_REPORTS)
+
+    def output(self):
+        return TaskTarget('documents', 'posted-{}-{}-increment-{}.jsonl'.format(self.job, self.launch_id, self.increment))
+
+    def documents(self):
+        with self.input()['documents'].open('r') as in_file:
+            for line in in_file:
+                key, docjson = line.rstrip('\n').split("\t", 1)
+                yield json.loads(docjson)
 
 
 class GenerateCrawlLogReports(luigi.Task):
@@ -148,11 +209,15 @@ class GenerateCrawlLogReports(luigi.Task):
     Via required tasks, launched M-R job to process crawl logs.
 
     Then runs through output documents and attempts to post them to W3ACT.
+
+    With --incremental, only the parts of the logs that are new since the last run are analysed (see
+    IncrementalLogReports), and only the documents found since then get posted.
     """
     task_namespace = 'report'
     job = luigi.Parameter()
     launch_id = luigi.Parameter(default=None)
     extract_documents = luigi.BoolParameter(default=False)
+    incremental = luigi.BoolParameter(default=False)
 
     def requires(self):
         # Find latest launch if needed:
@@ -172,6 +237,33 @@ class GenerateCrawlLogReports(luigi.Task):
         # Return the logs to be processed:
         return output_folder
 
+    def complete(self):
+        if not self.incremental:
+            return super(GenerateCrawlLogReports, self).complete()
+        # Complete if there's nothing new in the logs, and all the documents found so far have been processed:
+        if not self.requires().complete():
+            return False
+        reports = self.incremental_reports(None)
+        if not reports.complete():
+            return False
+        if self.extract_documents:
+            return self.process_new_documents(self.log_paths(), None, reports.state().increments).complete()
+        return True
+
+    def log_paths(self):
+        return [log_file.path for log_file in self.input()]
+
+    def incremental_reports(self, targets_path):
+        reports = list(INCREMENTAL_REPORTS)
+        if not self.extract_documents:
+            reports.remove('documents')
+        return IncrementalLogReports(self.job, self.launch_id, self.log_paths(), True, targets_path, reports)
+
+    def process_new_documents(self, log_paths, targets_path, increment):
+        # The parameters of ProcessNewDocuments come after those of AnalyseAndProcessDocuments, so pass them by name:
+        return ProcessNewDocuments(job=self.job, launch_id=self.launch_id, log_paths=log_paths,
+                                   targets_path=targets_path, from_hdfs=True, increment=increment)
+
     def output(self):
         logs_count = len(self.input())
         if self.extract_documents:
@@ -186,6 +278,14 @@ class GenerateCrawlLogReports(luigi.Task):
         feed = yield CrawlFeed('all')
         logs_count = len(self.input())
 
+        # Only analyse what's new in the logs, reading them directly, and only post what's been found since last time:
+        if self.incremental:
+            reports = self.incremental_reports(feed.path)
+            yield reports
+            if self.extract_documents:
+                yield self.process_new_documents(self.log_paths(), feed.path, reports.state().increments)
+            return
+
         # Cache targets in an appropriately unique filename (as unique as this task):
         hdfs_targets = yield SyncToHdfs(feed.path, '/tmp/cache/crawl-feed-%s-%s-%i.json' % (self.job, self.launch_id, logs_count), overwrite=True)
 
@@ -1,5 +1,6 @@
 import re
 import os
+import gzip
 import json
 import logging
 import datetime
@@ -9,6 +10,9 @@ import luigi.contrib.hdfs
 import luigi.contrib.hadoop
 from luigi.contrib.hdfs.format import Plain, PlainDir
 from lib.surt import url_to_surt
+from lib.docharvester.surt_trie import SurtPrefixTrie
+from tasks.analyse.crawl_logs.intermediate import CrawlLogJobTask
+from tasks.analyse.crawl_logs.log_index import load_crawl_log_index, expand_log_paths
 
 import lib, dateutil, six # Imported so extra_modules MR-bundle can access them
 #import surt, tldextract, idna, requests, urllib3, certifi, chardet, requests_file, six # Unfortunately the surt module has a LOT of dependencies.
@@ -17,31 +21,128 @@ import lib, dateutil, six # Imported so extra_modules MR-bundle can access them
 logger = logging.getLogger(__name__)
 
 
+# Patterns used when parsing crawl log lines, compiled once:
+FIELD_SEPARATOR = re.compile(' +')
+RE_IP = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+RE_TRIES = re.compile(r'^\d+t$')
+RE_DOL = re.compile(r'^dol:\d+') # Discarded out-links - make a total?
+
+# How many landing page SURTs to remember when extracting documents:
+LANDING_PAGE_SURT_CACHE_SIZE = 10000
+
+# Whitespace other than spaces, which str.split() would treat as a separator but the log format does not:
+OTHER_WHITESPACE = ('\t', '\r', '\n', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\x1f')
+
+
+def split_log_fields(line):
+    """
+    Splits a log line into its 12 space-separated fields, the last being the annotations and any extra JSON.
+
+    Gives the same results as re.split(" +", line.strip(), maxsplit=11), but uses the much faster str.split()
+    when the line only contains plain ASCII spaces.
+    """
+    line = line.strip()
+    if line.isascii():
+        for ws in OTHER_WHITESPACE:
+            if ws in line:
+                break
+        else:
+            return line.split(None, 11)
+    return FIELD_SEPARATOR.split(line, 11)
+
+
+def add_stats(properties, summaries):
+    """
+    Adds the stats for a log line (see CrawlLogLine.stats) to a dict of summary counts and sums.
+
+    'sum:XXX' properties are summed, and everything else counts occurrences of each key-value pair, so summaries
+    built from different sets of lines can be merged by adding them together.
+    """
+    for pkey in properties:
+        # For 'sum:XXX' properties, sum the values:
+        if pkey.startswith('sum:') and properties[pkey] != '-':
+            summaries[pkey] = summaries.get(pkey, 0) + int(properties[pkey])
+            continue
+        # Otherwise, default behaviour is to count occurrences of key-value pairs.
+        if properties[pkey]:
+            # Build a composite key for keys that have non-empty values:
+            prop = "%s:%s" % (pkey, properties[pkey])
+        else:
+            prop = pkey
+        # Aggregate:
+        summaries[prop] = summaries.get(prop, 0) + 1
+
+
 class CrawlLogLine(object):
     """
     Parsers Heritrix3 format log files, including annotations and any additional extra JSON at the end of the line.
+
+    The annotations and extra JSON are only split out when first used.
     """
+    __slots__ = ['timestamp', 'status_code', 'content_length', 'url', 'hop_path', 'via', 'mime', 'thread',
+                 'start_time_plus_duration', 'hash', 'source', '_tail', '_annotation_string', '_extra_json',
+                 '_annotations']
+
+    # Some regexes:
+    re_ip = RE_IP
+    re_tries = RE_TRIES
+    re_dol = RE_DOL
+
     def __init__(self, line):
         """
         Parse from a standard log-line.
         :param line:
         """
+        self._set_fields(split_log_fields(line))
+
+    @classmethod
+    def from_fields(cls, fields):
+        """
+        Makes a log line from fields that have already been split out (see split_log_fields).
+        """
+        log = cls.__new__(cls)
+        log._set_fields(fields)
+        return log
+
+    def _set_fields(self, fields):
         (self.timestamp, self.status_code, self.content_length, self.url, self.hop_path, self.via,
             self.mime, self.thread, self.start_time_plus_duration, self.hash, self.source,
-            self.annotation_string) = re.split(" +", line.strip(), maxsplit=11)
+            self._tail) = fields
+        self._annotation_string = None
+        self._extra_json = None
+        self._annotations = None
+
+    def _split_tail(self):
         # Account for any JSON 'extra info' ending, strip or split:
-        if self.annotation_string.endswith(' {}'):
-            self.annotation_string = self.annotation_string[:-3]
-        elif ' {"' in self.annotation_string and self.annotation_string.endswith('}'):
-            self.annotation_string, self.extra_json = re.split(re.escape(' {"'), self.annotation_string, maxsplit=1)
-            self.extra_json = '{"%s' % self.extra_json
-        # And split out the annotations:
-        self.annotations = self.annotation_string.split(',')
-
-        # Some regexes:
-        self.re_ip = re.compile('^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
-        self.re_tries = re.compile('^\d+t$')
-        self.re_dol = re.compile('^dol:\d+') # Discarded out-links - make a total?
+        tail = self._tail
+        if tail.endswith(' {}'):
+            self._annotation_string = tail[:-3]
+        elif ' {"' in tail and tail.endswith('}'):
+            self._annotation_string, extra_json = tail.split(' {"', 1)
+            self._extra_json = '{"%s' % extra_json
+        else:
+            self._annotation_string = tail
+
+    @property
+    def annotation_string(self):
+        if self._annotation_string is None:
+            self._split_tail()
+        return self._annotation_string
+
+    @property
+    def extra_json(self):
+        """
+        The extra JSON at the end of the line, as a string, or None if there was none.
+        """
+        if self._annotation_string is None:
+            self._split_tail()
+        return self._extra_json
+
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self._annotations = self.annotation_string.split(',')
+        return self._annotations
 
     def stats(self):
         """
@@ -61,10 +162,12 @@ class CrawlLogLine(object):
         for annot in self.annotations:
             # Set a prefix based on what it is:
             prefix = ''
-            if self.re_tries.match(annot):
-                prefix = 'tries:'
-            elif self.re_ip.match(annot):
-                prefix = "ip:"
+            # (both of these start with a digit, so only check those):
+            if annot[:1].isdigit():
+                if self.re_tries.match(annot):
+                    prefix = 'tries:'
+                elif self.re_ip.match(annot):
+                    prefix = "ip:"
             # Skip high-cardinality annotations:
             if annot.startswith('launchTimestamp:'):
                 continue
@@ -103,6 +206,39 @@ class CrawlLogLine(object):
     def date(self):
         return self.parse_date(self.timestamp)
 
+    def duration(self):
+        """
+        The time taken to fetch the URL, in milliseconds, from the start_time_plus_duration field.
+
+        :return: the duration, or None if there wasn't one
+        """
+        if '+' not in self.start_time_plus_duration:
+            return None
+        duration = self.start_time_plus_duration.split('+', 1)[1]
+        return int(duration) if duration.isdigit() else None
+
+    def tries(self):
+        """
+        The number of attempts made to fetch the URL, from the 'Nt' annotation, if there is one.
+
+        :return: the number of tries, or None if not recorded
+        """
+        for annot in self.annotations:
+            if annot[:1].isdigit() and self.re_tries.match(annot):
+                return int(annot[:-1])
+        return None
+
+    def ip(self):
+        """
+        The IP address the URL was fetched from, from the annotations, if there is one.
+        """
+        for annot in self.annotations:
+            if annot.startswith('ip:'):
+                return annot[3:]
+            if annot[:1].isdigit() and self.re_ip.match(annot):
+                return annot
+        return None
+
     def parse_date(self, timestamp):
         return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
 
@@ -130,23 +266,28 @@ class CrawlLogExtractors(object):
             targets = []
         # Assemble the Watched SURTs:
         target_map = {}
-        watched = set()
+        watched = {}
         for t in targets:
             # Build-up reverse mapping
             for seed in t['seeds']:
                 target_map[seed] = t['id']
                 # And not any watched seeds:
                 if t['watched']:
-                    watched.add(seed)
+                    watched[seed] = t['id']
 
-        # Convert to SURT form:
+        # Convert to SURT form, and index them by the ID of the Target they belong to:
         watched_surts = []
-        for url in watched:
-            watched_surts.append(url_to_surt(url))
-        logger.warning("WATCHED SURTS %s" % watched_surts)
+        self.watched = SurtPrefixTrie()
+        for url, target_id in watched.items():
+            watched_surt = url_to_surt(url)
+            watched_surts.append(watched_surt)
+            self.watched.add(watched_surt, target_id)
+        logger.warning("Indexed %i WATCHED SURTS" % len(watched_surts))
 
         self.watched_surts = watched_surts
         self.target_map = target_map
+        # The SURTs of recent landing pages, as the same ones come up again and again:
+        self._landing_page_surts = {}
 
     def analyse_log_file(self, log_file):
         """
@@ -162,10 +303,33 @@ class CrawlLogExtractors(object):
     def target_id(self, log):
         return self.target_map.get(log.source, None)
 
+    def watched_target_id(self, surt):
+        """
+        Finds the Watched Target a SURT falls under, picking the most specific (longest) matching seed.
+
+        :return: the Target ID, or None if it's not under any watched seed
+        """
+        matches = self.watched.matches(surt)
+        if matches:
+            return matches[-1]
+        return None
+
+    def landing_page_surt(self, url):
+        surt = self._landing_page_surts.get(url, None)
+        if surt is None:
+            if len(self._landing_page_surts) >= LANDING_PAGE_SURT_CACHE_SIZE:
+                self._landing_page_surts.clear()
+            surt = url_to_surt(url)
+            self._landing_page_surts[url] = surt
+        return surt
+
     def extract_documents(self, log):
         """
         Check if this appears to be a potential Document for document harvesting...
 
+        The document URL is checked against the watched SURTs first, and the landing page is only converted and
+        checked if that does not match.
+
         :param log:
         :return:
         """
@@ -173,27 +337,27 @@ class CrawlLogExtractors(object):
         if log.status_code == '-' or log.status_code == '' or int(int(log.status_code) / 100) != 2:
             return
         # Check the URL and Content-Type:
-        if "application/pdf" in log.mime:
-            for prefix in self.watched_surts:
-                document_surt = url_to_surt(log.url)
-                landing_page_surt = url_to_surt(log.via)
-                #logger.warning("Looking for prefix '%s' in '%s' and '%s'" % (prefix,document_surt, landing_page_surt))
-                # Are both URIs under the same watched SURT:
-                if document_surt.startswith(prefix) or landing_page_surt.startswith(prefix):
-                    # Proceed to extract metadata and pass on to W3ACT:
-                    doc = {
-                        'wayback_timestamp': log.start_time_plus_duration[:14],
-                        'landing_page_url': log.via,
-                        'document_url': log.url,
-                        'filename': os.path.basename(urlparse(log.url).path),
-                        'size': int(log.content_length),
-                        # Add some more metadata to the output so we can work out where this came from later:
-                        'job_name': self.job,
-                        'launch_id': self.launch_id,
-                        'source': log.source
-                    }
-                    #logger.info("Found document: %s" % doc)
-                    return json.dumps(doc)
+        if "application/pdf" in log.mime and len(self.watched) > 0:
+            # Is either URI under a watched SURT:
+            target_id = self.watched_target_id(url_to_surt(log.url))
+            if target_id is None:
+                target_id = self.watched_target_id(self.landing_page_surt(log.via))
+            if target_id is not None:
+                # Proceed to extract metadata and pass on to W3ACT:
+                doc = {
+                    'wayback_timestamp': log.start_time_plus_duration[:14],
+                    'landing_page_url': log.via,
+                    'document_url': log.url,
+                    'filename': os.path.basename(urlparse(log.url).path),
+                    'size': int(log.content_length),
+                    # Add some more metadata to the output so we can work out where this came from later:
+                    'job_name': self.job,
+                    'launch_id': self.launch_id,
+                    'source': log.source,
+                    'target_id': target_id
+                }
+                #logger.info("Found document: %s" % doc)
+                return json.dumps(doc)
 
         return None
 
@@ -225,7 +389,7 @@ class InputFile(luigi.ExternalTask):
         """
         return True
 
-class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
+class AnalyseLogFile(CrawlLogJobTask):
     """
     Map-Reduce job that scans a log file for documents associated with 'Watched' targets.
 
@@ -244,7 +408,11 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
     # Using one output file ensures the whole output is sorted but is not suitable for very large crawls.
     n_reduce_tasks = luigi.Parameter(default=25)
 
+    # The maximum number of partial summaries each mapper holds in memory before passing them on:
+    max_partials = 100000
+
     extractor = None
+    partials = None
 
 
     def requires(self):
@@ -267,6 +435,7 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
     def init_mapper(self):
         # Set up...
         self.extractor = CrawlLogExtractors(self.job, self.launch_id, self.from_hdfs, targets_path=self.targets_path )
+        self.partials = {}
 
     def jobconfs(self):
         """
@@ -282,8 +451,16 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
     def mapper(self, line):
         # Parse:
         log = CrawlLogLine(line)
-        # Extract basic data for summaries, keyed for later aggregation:
-        yield "BY_DAY_HOST_SOURCE,%s,%s,%s" % (log.day(), log.host(), log.source), json.dumps(log.stats())
+        # Extract basic data for summaries, keyed for later aggregation, summarising as much as possible here:
+        key = "BY_DAY_HOST_SOURCE,%s,%s,%s" % (log.day(), log.host(), log.source)
+        summaries = self.partials.get(key, None)
+        if summaries is None:
+            # Pass on what we've got so far if there are too many summaries to keep in memory:
+            if len(self.partials) >= self.max_partials:
+                yield from self.flush_partials()
+            summaries = {}
+            self.partials[key] = summaries
+        add_stats(log.stats(), summaries)
         # Scan for documents, yield sorted in crawl order:
         doc = self.extractor.extract_documents(log)
         if doc:
@@ -293,6 +470,18 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
                 and log.hop_path == "-" and log.via == "-"):  # seed
             yield "DEAD_SEED,%s,%s" % (log.url, log.start_time_plus_duration), line
 
+    def flush_partials(self):
+        """
+        Emits the partial summaries held by this mapper, and clears them.
+        """
+        self.incr_counter('AnalyseLogFile', 'Partial summaries emitted', len(self.partials))
+        for key, summaries in self.partials.items():
+            yield key, self.encode_value(summaries)
+        self.partials = {}
+
+    def final_mapper(self):
+        yield from self.flush_partials()
+
     def reducer(self, key, values):
         """
         A pass-through reducer.
@@ -306,23 +495,11 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
             for value in values:
                 yield key, value
         else:
-            # Build up summaries of other statistics:
+            # Merge the partial summaries from the mappers:
             summaries = {}
             for value in values:
-                properties = json.loads(value)
-                for pkey in properties:
-                    # For 'sum:XXX' properties, sum the values:
-                    if pkey.startswith('sum:') and properties[pkey] != '-':
-                        summaries[pkey] = summaries.get(pkey, 0) + int(properties[pkey])
-                        continue
-                    # Otherwise, default behaviour is to count occurrences of key-value pairs.
-                    if properties[pkey]:
-                        # Build a composite key for keys that have non-empty values:
-                        prop = "%s:%s" % (pkey, properties[pkey])
-                    else:
-                        prop = pkey
-                    # Aggregate:
-                    summaries[prop] = summaries.get(prop, 0) + 1
+                for prop, count in self.decode_value(value).items():
+                    summaries[prop] = summaries.get(prop, 0) + count
 
             yield key, json.dumps(summaries)
 
@@ -333,6 +510,9 @@ class ExtractLogsForHost(luigi.contrib.hadoop.JobTask):
 
     Should run locally if run with only local inputs.
 
+    If use_index is set, any log indexes built by log_index.IndexCrawlLogs are used to skip the logs the host does
+    not appear in. When running locally, the matching lines are then read directly from the indexed blocks of each
+    log, rather than running the job over every line.
     """
 
     task_namespace = 'analyse'
@@ -341,17 +521,62 @@ class ExtractLogsForHost(luigi.contrib.hadoop.JobTask):
     log_paths = luigi.ListParameter()
     host = luigi.Parameter()
     from_hdfs = luigi.BoolParameter(default=False)
+    use_index = luigi.BoolParameter(default=False)
 
     # Using one output file ensures the whole output is sorted but is not suitable for very large crawls.
     n_reduce_tasks = luigi.Parameter(default=1)
 
     def requires(self):
         reqs = []
-        for log_path in self.log_paths:
+        if self.use_index:
+            log_paths = expand_log_paths(self.log_paths, self.from_hdfs)
+        else:
+            log_paths = self.log_paths
+        for log_path in log_paths:
+            if self.use_index:
+                index = load_crawl_log_index(self.job, self.launch_id, log_path, self.from_hdfs)
+                if index is not None and not index.contains(self.host):
+                    logger.info("SKIPPING LOG FILE, HOST NOT IN INDEX: %s" % log_path)
+                    continue
             logger.info("LOG FILE TO PROCESS: %s" % log_path)
             reqs.append(InputFile(log_path, self.from_hdfs))
         return reqs
 
+    def run(self):
+        if self.use_index and not self.from_hdfs:
+            self.run_from_index()
+        elif len(self.input()) == 0:
+            # None of the logs include this host:
+            with self.output().open('w') as f:
+                pass
+        else:
+            super(ExtractLogsForHost, self).run()
+
+    def run_from_index(self):
+        """
+        Extracts the lines for the host by seeking to the indexed blocks of each local log, sorted as the job would.
+        """
+        outputs = []
+        for log_input in self.input():
+            index = load_crawl_log_index(self.job, self.launch_id, log_input.path)
+            if index is None:
+                opener = gzip.open if log_input.path.endswith('.gz') else open
+                with opener(log_input.path, 'rt', encoding='utf-8', errors='replace') as f:
+                    outputs.extend(self._extract(line.rstrip('\r\n') for line in f))
+            else:
+                outputs.extend(self._extract(index.lines(self.host)))
+        with self.output().open('w') as f:
+            for key, line in sorted(outputs):
+                f.write("%s\t%s\n" % (key, line))
+
+    def _extract(self, lines):
+        for line in lines:
+            try:
+                yield from self.mapper(line)
+            except ValueError:
+                # Skip lines that can't be parsed:
+                pass
+
     def output(self):
         out_name = "task-state/%s/%s/crawl-logs-%s.analysis.tsjson" % (self.job, self.launch_id, self.host)
         if self.from_hdfs:
@@ -473,7 +698,7 @@ class ExtractLogsByHost(luigi.contrib.hadoop.JobTask):
         return jc
 
 
-class SummariseLogFiles(luigi.contrib.hadoop.JobTask):
+class SummariseLogFiles(CrawlLogJobTask):
     """
     Based on old code developed for TRAC issue 2478.
 
@@ -563,7 +788,7 @@ class SummariseLogFiles(luigi.contrib.hadoop.JobTask):
         parsed_url = urlparse(url)
         host = re.sub("^(www([0-9]+)?)\.", "", parsed_url[1])                        
                                 
-        yield host, json.dumps(data)
+        yield host, self.encode_value(data)
 
     def reducer(self, key, values):
         sec_level_domains = ["ac", "co", "gov", "judiciary", "ltd", "me", "mod", "net", "nhs", "nic", "org",
@@ -578,7 +803,7 @@ class SummariseLogFiles(luigi.contrib.hadoop.JobTask):
 
         host = key
         for value in values:
-            data = json.loads(value)
+            data = self.decode_value(value)
             logger.info(">>> host: %s data: %s " % (host, data))                    
             
             # Some values can only be accumulated for Live hosts    
@@ -620,7 +845,7 @@ class SummariseLogFiles(luigi.contrib.hadoop.JobTask):
         yield host, json.dumps(current_host_data)
 
 
-class ListDeadSeeds(luigi.contrib.hadoop.JobTask):
+class ListDeadSeeds(CrawlLogJobTask):
 
     """
     Essentially does the same as SummariseLogFiles on the same input, but 
@@ -630,7 +855,8 @@ class ListDeadSeeds(luigi.contrib.hadoop.JobTask):
     (i.e. why are we processing the same logs twice?) is that we output 
     JSON there and MR within Luigi doesn't lend itself obviously to 
     either operating on JSON input or outputting multiple files 
-    within the same task. TODO.
+    within the same task. See log_reports.LogReports, which generates
+    this and the other reports in a single pass.
     """
 
     log_paths = luigi.ListParameter()
@@ -711,7 +937,7 @@ class ListDeadSeeds(luigi.contrib.hadoop.JobTask):
             
             
             
-class CountStatusCodes(luigi.contrib.hadoop.JobTask):
+class CountStatusCodes(CrawlLogJobTask):
 
     """
     Count of Each Heritrix/HTTP Status returned  
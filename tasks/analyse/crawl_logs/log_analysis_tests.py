@@ -1,7 +1,8 @@
 import json
 import luigi
-from tasks.analyse.crawl_logs.log_analysis_hadoop import SummariseLogFiles, ListDeadSeeds, \
-    CountStatusCodes, ReportToSlackStatusCodes, ReportToSlackDeadSeeds
+from tasks.analyse.crawl_logs.log_analysis_hadoop import SummariseLogFiles, ListDeadSeeds, CountStatusCodes
+from tasks.analyse.slack_reporting import ReportToSlackStatusCodes, ReportToSlackDeadSeeds
+from tasks.analyse.crawl_logs.log_analysis import GenerateCrawlLogReports
 
 
 def test_run_summariser():
@@ -59,3 +60,14 @@ def test_report_to_slack():
             # count = count + 1
 
     # assert count is 36
+
+
+def test_process_new_documents_parameters():
+    # Set up the task for the next increment the way GenerateCrawlLogReports does:
+    reports = GenerateCrawlLogReports('dc', '20170220090024', extract_documents=True, incremental=True)
+    task = reports.process_new_documents(['crawl.log', 'crawl.log.cp00001'], 'crawl-feed.json', 3)
+    assert task.increment == 3
+    assert task.log_paths == ('crawl.log', 'crawl.log.cp00001')
+    assert task.targets_path == 'crawl-feed.json'
+    assert task.from_hdfs
+    assert not task.batch_extract
@@ -0,0 +1,146 @@
+"""
+Benchmarks the crawl log line parser, comparing it with the original version, and checks that both give exactly
+the same fields for every line of the given logs.
+
+Run as:
+
+    python -m tasks.analyse.crawl_logs.log_bench [-r REPEATS] [log_file ...]
+
+If no log files are given, the test/*.log fixtures are used.
+"""
+import re
+import sys
+import glob
+import time
+import argparse
+from tasks.analyse.crawl_logs.log_analysis_hadoop import CrawlLogLine
+
+# The fields that should match between the parsers:
+FIELDS = ['timestamp', 'status_code', 'content_length', 'url', 'hop_path', 'via', 'mime', 'thread',
+          'start_time_plus_duration', 'hash', 'source', 'annotation_string', 'annotations', 'extra_json']
+
+
+class LegacyCrawlLogLine(object):
+    """
+    The original CrawlLogLine parser, kept here for comparison.
+    """
+    def __init__(self, line):
+        (self.timestamp, self.status_code, self.content_length, self.url, self.hop_path, self.via,
+            self.mime, self.thread, self.start_time_plus_duration, self.hash, self.source,
+            self.annotation_string) = re.split(" +", line.strip(), maxsplit=11)
+        # Account for any JSON 'extra info' ending, strip or split:
+        if self.annotation_string.endswith(' {}'):
+            self.annotation_string = self.annotation_string[:-3]
+        elif ' {"' in self.annotation_string and self.annotation_string.endswith('}'):
+            self.annotation_string, self.extra_json = re.split(re.escape(' {"'), self.annotation_string, maxsplit=1)
+            self.extra_json = '{"%s' % self.extra_json
+        # And split out the annotations:
+        self.annotations = self.annotation_string.split(',')
+
+        # Some regexes:
+        self.re_ip = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+        self.re_tries = re.compile(r'^\d+t$')
+        self.re_dol = re.compile(r'^dol:\d+') # Discarded out-links - make a total?
+
+    def stats(self):
+        stats = {
+            'lines' : '', # This will count the lines under each split
+            'status_code': self.status_code,
+            'content_type': self.mime,
+            'hop': self.hop_path[-1:],
+            'sum:content_length': self.content_length
+        }
+        # Add in annotations:
+        for annot in self.annotations:
+            # Set a prefix based on what it is:
+            prefix = ''
+            if self.re_tries.match(annot):
+                prefix = 'tries:'
+            elif self.re_ip.match(annot):
+                prefix = "ip:"
+            # Skip high-cardinality annotations:
+            if annot.startswith('launchTimestamp:'):
+                continue
+            # Only emit lines with annotations:
+            if annot != "-":
+                stats["%s%s" % (prefix, annot)] = ""
+        return stats
+
+
+def _parse(cls, line):
+    try:
+        return cls(line)
+    except ValueError:
+        return None
+
+
+def check_compatibility(lines):
+    """
+    :return: the number of lines where the parsers disagree
+    """
+    mismatches = 0
+    for line in lines:
+        old = _parse(LegacyCrawlLogLine, line)
+        new = _parse(CrawlLogLine, line)
+        if old is None or new is None:
+            if (old is None) != (new is None):
+                mismatches += 1
+                print("Only one parser rejected: %s" % line.strip())
+            continue
+        for field in FIELDS:
+            if getattr(old, field, None) != getattr(new, field, None):
+                mismatches += 1
+                print("Field %s differs: %r != %r" % (field, getattr(old, field, None), getattr(new, field, None)))
+                break
+        else:
+            if old.stats() != new.stats():
+                mismatches += 1
+                print("Stats differ for: %s" % line.strip())
+    return mismatches
+
+
+def parse_only(cls, lines):
+    for line in lines:
+        cls(line)
+
+
+def parse_and_stats(cls, lines):
+    for line in lines:
+        cls(line).stats()
+
+
+def _run(label, fn, cls, lines):
+    start = time.perf_counter()
+    fn(cls, lines)
+    elapsed = time.perf_counter() - start
+    print("%-40s %8.3f s %12.0f lines/s" % (label, elapsed, len(lines) / elapsed if elapsed > 0 else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='log_bench')
+    parser.add_argument('-r', '--repeats', type=int, default=200, help='Number of times to repeat the lines.')
+    parser.add_argument('log_files', nargs='*', help='Crawl log files to read, instead of the test/*.log fixtures.')
+    args = parser.parse_args()
+
+    lines = []
+    for log_file in args.log_files or sorted(glob.glob('test/*.log')):
+        with open(log_file, encoding='utf-8', errors='replace') as f:
+            lines.extend(f.readlines())
+
+    mismatches = check_compatibility(lines)
+    print("Checked %i lines, %i mismatches." % (len(lines), mismatches))
+
+    # Only benchmark lines that parse:
+    lines = [line for line in lines if _parse(LegacyCrawlLogLine, line)] * args.repeats
+    print("Parsing %i crawl log lines..." % len(lines))
+    _run("LegacyCrawlLogLine", parse_only, LegacyCrawlLogLine, lines)
+    _run("CrawlLogLine", parse_only, CrawlLogLine, lines)
+    _run("LegacyCrawlLogLine + stats()", parse_and_stats, LegacyCrawlLogLine, lines)
+    _run("CrawlLogLine + stats()", parse_and_stats, CrawlLogLine, lines)
+
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
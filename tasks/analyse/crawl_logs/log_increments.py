@@ -0,0 +1,304 @@
+"""
+Incremental analysis of the crawl logs of a running crawl.
+
+Rather than re-analysing every log of a launch each time a new one appears, this keeps a record of how far into
+each log file the analysis has got, along with the partial (combinable) results of the log_reports aggregators so
+far. Each time it runs, only the lines appended to known logs, and any new logs, are read, and their partial
+results are combined with the existing ones before the reports are written out again.
+
+Log files are identified by their first line as well as their path, so when the crawler renames crawl.log to
+crawl.log.cpNNNNN at a checkpoint, the renamed log carries on from where crawl.log had got to, and the new crawl.log
+is read from the start. Gzipped logs are identified by their first line once decompressed, so a log that is gzipped
+after it has been analysed is not analysed again. Only complete lines are analysed, and the offset after the last of them is recorded, so a
+line that is still being written is picked up next time, and doesn't count as something new to analyse until it
+has been finished. Gzipped logs can't be read from part way through, so are only read once, when they first appear.
+
+The state is kept as JSON alongside the reports, and is only saved once the reports have been written, so if a
+run fails part way through, the next one just picks up from the previous increment.
+"""
+import os
+import gzip
+import json
+import hashlib
+import logging
+import datetime
+import luigi
+import luigi.contrib.hdfs
+
+from tasks.common import state_file
+from tasks.analyse.crawl_logs.log_reports import make_aggregators, aggregate_lines, merge_results, write_reports
+from tasks.analyse.crawl_logs.log_index import expand_log_paths
+
+logger = logging.getLogger(__name__)
+
+# The reports generated by default, equivalent to those from AnalyseLogFile:
+INCREMENTAL_REPORTS = ['by-day-host-source', 'dead-seeds', 'documents']
+
+# How much of each log to read at a time:
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_chunks(path, start, end, from_hdfs):
+    if from_hdfs:
+        client = luigi.contrib.hdfs.WebHdfsClient()
+        with client.client.read(path, offset=start, length=end - start, chunk_size=READ_CHUNK_SIZE) as reader:
+            for chunk in reader:
+                yield chunk
+    else:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def log_size(path, from_hdfs):
+    if from_hdfs:
+        client = luigi.contrib.hdfs.WebHdfsClient()
+        return client.client.status(path)['length']
+    return os.path.getsize(path)
+
+
+def complete_lines_end(path, start, end, from_hdfs):
+    """
+    Finds the offset just after the last complete line between start and end, by reading backwards from the end.
+
+    :return: the offset, or start if there are no complete lines
+    """
+    pos = end
+    while pos > start:
+        chunk_start = max(start, pos - READ_CHUNK_SIZE)
+        data = b''.join(_read_chunks(path, chunk_start, pos, from_hdfs))
+        newline = data.rfind(b'\n')
+        if newline >= 0:
+            return chunk_start + newline + 1
+        pos = chunk_start
+    return start
+
+
+def _gzip_first_line(path, from_hdfs):
+    if from_hdfs:
+        client = luigi.contrib.hdfs.WebHdfsClient()
+        with client.client.read(path) as reader:
+            with gzip.GzipFile(fileobj=reader) as f:
+                return f.readline()
+    with gzip.open(path, 'rb') as f:
+        return f.readline()
+
+
+def log_fingerprint(path, size, from_hdfs):
+    """
+    Identifies a log file from its first line (decompressed, if it's gzipped).
+
+    :return: the fingerprint, or None if the first line has not been completely written yet
+    """
+    if path.endswith('.gz'):
+        head = _gzip_first_line(path, from_hdfs)
+    else:
+        head = b''
+        for chunk in _read_chunks(path, 0, size, from_hdfs):
+            head += chunk
+            if b'\n' in head:
+                break
+        if b'\n' not in head:
+            return None
+        head = head[:head.index(b'\n') + 1]
+    return hashlib.md5(head).hexdigest()
+
+
+class LogRange(object):
+    """
+    The complete lines in a range of a log file, recording the offset just after the last line read.
+
+    If final is set, the range runs to the end of the log, and any last line without a newline is included too (and
+    unterminated is set), as a finished log may not end with one.
+    """
+
+    def __init__(self, path, start, end, from_hdfs=False, final=False):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.from_hdfs = from_hdfs
+        self.final = final
+        self.offset = start
+        self.unterminated = False
+
+    def __iter__(self):
+        if self.path.endswith('.gz'):
+            yield from self._gzip_lines()
+            return
+        rest = b''
+        for chunk in _read_chunks(self.path, self.start, self.end, self.from_hdfs):
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                self.offset += len(line) + 1
+                yield line.decode('utf-8', 'replace')
+        if rest and self.final:
+            self.offset += len(rest)
+            self.unterminated = True
+            yield rest.decode('utf-8', 'replace')
+
+    def _gzip_lines(self):
+        if self.from_hdfs:
+            client = luigi.contrib.hdfs.WebHdfsClient()
+            with client.client.read(self.path) as reader:
+                with gzip.GzipFile(fileobj=reader) as f:
+                    for line in f:
+                        yield line.decode('utf-8', 'replace')
+        else:
+            with gzip.open(self.path, 'rt', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    yield line
+        self.offset = self.end
+
+
+class LogAnalysisState(object):
+    """
+    How far the analysis has got through each log file, and the partial results so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        else:
+            state = {}
+        self.increments = state.get('increments', 0)
+        self.files = state.get('files', {})
+        self.partials = state.get('partials', {})
+        self.history = state.get('history', [])
+
+    def plan(self, log_paths, from_hdfs=False):
+        """
+        Works out which ranges of which logs have not been analysed yet. Each range ends after the last complete
+        line, and there is no range for a log if all that has been added to it is part of a line.
+
+        :return: a list of (log path, fingerprint, start offset, end offset) tuples
+        """
+        by_fingerprint = {}
+        for entry in self.files.values():
+            if entry['offset'] > by_fingerprint.get(entry['fingerprint'], { 'offset': -1 })['offset']:
+                by_fingerprint[entry['fingerprint']] = entry
+        ranges = []
+        for log_path in log_paths:
+            size = log_size(log_path, from_hdfs)
+            if size == 0:
+                continue
+            fingerprint = log_fingerprint(log_path, size, from_hdfs)
+            if fingerprint is None:
+                continue
+            entry = self.files.get(log_path, None)
+            if entry is None or entry['fingerprint'] != fingerprint:
+                # Carry on from where we'd got to if we've seen it before under another name (e.g. crawl.log):
+                entry = by_fingerprint.get(fingerprint, { 'fingerprint': fingerprint, 'offset': 0 })
+            if log_path.endswith('.gz'):
+                # Read in one go, so skip it if any of it (perhaps before it was gzipped) has been read already:
+                if entry['offset'] > 0:
+                    continue
+                end = size
+            else:
+                if size < entry['offset']:
+                    raise Exception("Log %s is shorter than when it was last analysed! Remove %s to start again."
+                                    % (log_path, self.path))
+                end = complete_lines_end(log_path, entry['offset'], size, from_hdfs)
+            if end > entry['offset']:
+                ranges.append((log_path, fingerprint, entry['offset'], end))
+        return ranges
+
+    def update(self, aggregators, results, ranges):
+        """
+        Merges in the partial results from a new increment, and records how far each log has now been analysed.
+
+        It only counts as a new increment if some of the logs were analysed.
+
+        :param ranges: a list of (log path, fingerprint, start offset, end offset) tuples
+        """
+        for aggregator in aggregators:
+            self.partials.setdefault(aggregator.name, {})
+        merge_results(aggregators, self.partials, results)
+        for log_path, fingerprint, start, end in ranges:
+            self.files[log_path] = { 'fingerprint': fingerprint, 'offset': end }
+        analysed = sum(end - start for log_path, fingerprint, start, end in ranges)
+        if analysed == 0:
+            return
+        self.increments += 1
+        self.history.append({
+            'increment': self.increments,
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'bytes': analysed,
+            'logs': len([end for log_path, fingerprint, start, end in ranges if end > start]),
+        })
+
+    def save(self):
+        # Write to a temporary file and swap it in, so a failure can't leave the state half-written:
+        temp_path = "%s.temp" % self.path
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'increments': self.increments,
+                'files': self.files,
+                'partials': self.partials,
+                'history': self.history,
+            }, f)
+        os.replace(temp_path, self.path)
+
+
+class IncrementalLogReports(luigi.Task):
+    """
+    Generates the log_reports reports for a launch, only analysing the parts of the logs that are new since the
+    last run, and merging the results into the existing reports.
+
+    The logs can be local or on HDFS, but are read by this task rather than by a Hadoop job. The targets must be
+    local.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+    targets_path = luigi.OptionalParameter(default=None)
+    reports = luigi.ListParameter(default=INCREMENTAL_REPORTS)
+
+    def out_dir(self):
+        return state_file(self.launch_id, self.job, 'crawl-logs-incremental').path
+
+    def state(self):
+        return LogAnalysisState(os.path.join(self.out_dir(), 'state.json'))
+
+    def output(self):
+        return dict((name, luigi.LocalTarget(path=os.path.join(self.out_dir(), '%s.tsv' % name)))
+                    for name in self.reports)
+
+    def complete(self):
+        # Complete only if there's nothing new in the logs:
+        for target in luigi.task.flatten(self.output()):
+            if not target.exists():
+                return False
+        return len(self.state().plan(expand_log_paths(self.log_paths, self.from_hdfs), self.from_hdfs)) == 0
+
+    def run(self):
+        state = self.state()
+        if set(state.partials.keys()) - set(self.reports):
+            logger.warning("Dropping partial results for reports that are no longer wanted.")
+        state.partials = dict((name, state.partials.get(name, {})) for name in self.reports)
+        ranges = state.plan(expand_log_paths(self.log_paths, self.from_hdfs), self.from_hdfs)
+
+        aggregators = make_aggregators(self.reports, self.job, self.launch_id, targets_path=self.targets_path)
+        results = dict((aggregator.name, {}) for aggregator in aggregators)
+        analysed = []
+        for log_path, fingerprint, start, end in ranges:
+            log_range = LogRange(log_path, start, end, self.from_hdfs)
+            lines = aggregate_lines(log_range, aggregators, results)
+            logger.info("Analysed %i lines (%i bytes) from %s" % (lines, log_range.offset - start, log_path))
+            analysed.append((log_path, fingerprint, start, log_range.offset))
+        state.update(aggregators, results, analysed)
+
+        # Write the reports before the state, so if this fails the increment will be done again:
+        counts = write_reports(aggregators, state.partials, self.out_dir())
+        state.save()
+        logger.info("Increment %i log report line counts: %s" % (state.increments, json.dumps(counts)))
@@ -0,0 +1,77 @@
+import os
+import gzip
+import luigi
+import tasks.common
+from tasks.analyse.crawl_logs.log_increments import IncrementalLogReports
+
+CRAWL_LOG = os.path.abspath('../../test/crawl.log')
+REPORTS = ['by-day-host-source', 'dead-seeds']
+
+
+def test_partly_written_line(tmp_path, monkeypatch):
+    with open(CRAWL_LOG, 'rb') as f:
+        lines = f.readlines()
+    log_path = os.path.join(str(tmp_path), 'crawl.log')
+    # The state and reports go under the temporary folder:
+    monkeypatch.setattr(tasks.common, 'LOCAL_STATE_FOLDER', str(tmp_path))
+
+    # A live log, with the last line only partly written:
+    with open(log_path, 'wb') as f:
+        f.write(b''.join(lines[:40]))
+        f.write(lines[40][:50])
+    task = IncrementalLogReports('dc', '20181126', [log_path], reports=REPORTS)
+    luigi.build([task], local_scheduler=True)
+    state = task.state()
+    assert state.increments == 1
+    assert state.files[log_path]['offset'] == len(b''.join(lines[:40]))
+    assert task.complete()
+
+    # Nothing new until the line is finished:
+    luigi.build([task], local_scheduler=True)
+    assert task.state().increments == 1
+
+    with open(log_path, 'ab') as f:
+        f.write(lines[40][50:])
+        f.write(b''.join(lines[41:]))
+    assert not task.complete()
+    luigi.build([task], local_scheduler=True)
+    state = task.state()
+    assert state.increments == 2
+    assert state.files[log_path]['offset'] == os.path.getsize(log_path)
+    assert [entry['bytes'] for entry in state.history] == [len(b''.join(lines[:40])), len(b''.join(lines[40:]))]
+    assert task.complete()
+
+
+def test_gzipped_after_analysis(tmp_path, monkeypatch):
+    with open(CRAWL_LOG, 'rb') as f:
+        data = f.read()
+    log_path = os.path.join(str(tmp_path), 'crawl.log')
+    with open(log_path, 'wb') as f:
+        f.write(data)
+    monkeypatch.setattr(tasks.common, 'LOCAL_STATE_FOLDER', str(tmp_path))
+
+    task = IncrementalLogReports('dc', '20181126', [log_path], reports=REPORTS)
+    luigi.build([task], local_scheduler=True)
+    assert task.out_dir().startswith(str(tmp_path))
+    with open(task.output()['by-day-host-source'].path) as f:
+        expected = f.read()
+
+    # Once rotated and gzipped, the log is recognised and not analysed again:
+    with gzip.open("%s.gz" % log_path, 'wb') as f:
+        f.write(data)
+    os.remove(log_path)
+    task = IncrementalLogReports('dc', '20181126', ["%s.gz" % log_path], reports=REPORTS)
+    assert task.complete()
+    luigi.build([task], local_scheduler=True)
+    assert task.state().increments == 1
+    with open(task.output()['by-day-host-source'].path) as f:
+        assert f.read() == expected
+
+    # But a new gzipped log, with a different first line, is:
+    other_path = os.path.join(str(tmp_path), 'other.log.gz')
+    with gzip.open(other_path, 'wb') as f:
+        f.write(data[data.index(b'\n') + 1:])
+    task = IncrementalLogReports('dc', '20181126', ["%s.gz" % log_path, other_path], reports=REPORTS)
+    assert not task.complete()
+    luigi.build([task], local_scheduler=True)
+    assert task.state().increments == 2
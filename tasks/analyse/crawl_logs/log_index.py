@@ -0,0 +1,370 @@
+"""
+A seekable index of which hosts, and which times, appear in each block of a crawl log.
+
+Each log file is split into blocks of roughly block_size bytes, always ending on a line boundary, and for each
+block the index records its byte range, the hosts that appear in it and the earliest and latest log timestamps.
+The lines for a host (and optionally a time window) can then be read by seeking straight to the blocks that could
+contain them, rather than reading the whole log.
+
+Gzipped logs can only be split where one gzip member ends and the next begins, as a gzip stream can't be read
+from the middle. So for logs compressed as many members (e.g. with bgzip, which writes a member per 64KB), the
+blocks are sets of whole members, but a log compressed as a single stream has a single block. This can
+still be skipped entirely if the host never appears in it.
+
+Run as:
+
+    python -m tasks.analyse.crawl_logs.log_index build -j JOB -l LAUNCH_ID log_file ...
+    python -m tasks.analyse.crawl_logs.log_index extract -j JOB -l LAUNCH_ID --host HOST [--start T] [--end T] log_file ...
+
+The extract command builds (and keeps) any index that is missing or out of date, and prints the matching lines.
+"""
+import os
+import sys
+import gzip
+import glob
+import json
+import zlib
+import logging
+import argparse
+from urllib.parse import urlparse
+import luigi
+import luigi.format
+import luigi.contrib.hdfs
+
+logger = logging.getLogger(__name__)
+
+# Defaults for indexing:
+DEFAULT_INDEX_BLOCK_SIZE = int(os.environ.get('CRAWL_LOG_INDEX_BLOCK_SIZE', 4 * 1024 * 1024))
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def index_path(job, launch_id, log_path):
+    return "task-state/%s/%s/crawl-log-index/%s.index.json" % (job, launch_id, os.path.basename(log_path))
+
+
+def line_host_and_timestamp(line):
+    """
+    Gets the host (as for CrawlLogLine.host) and timestamp of a raw crawl log line, without parsing the rest of it.
+
+    :return: (host, timestamp), or (None, None) if the line can't be parsed
+    """
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        return None, None
+    url = fields[3].decode('utf-8', 'replace')
+    try:
+        if url.startswith("dns:"):
+            host = url[4:]
+        else:
+            host = urlparse(url).hostname
+    except ValueError:
+        host = None
+    return host, fields[0].decode('utf-8', 'replace')
+
+
+def _plain_lines(f, chunk_size):
+    """
+    Yields (line, offset after it) for each line of an uncompressed log. Blocks can be split after any line.
+    """
+    offset = 0
+    rest = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        lines = (rest + data).splitlines(True)
+        rest = lines.pop() if not lines[-1].endswith(b'\n') else b''
+        for line in lines:
+            offset += len(line)
+            yield line, offset
+    if rest:
+        yield rest, offset + len(rest)
+
+
+def _gzip_lines(f, chunk_size):
+    """
+    Yields (line, offset after it) for each line of a gzipped log, where the offset is of the compressed data, and
+    is None if the line does not end at the end of a gzip member, as blocks can only be split there.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    offset = 0
+    rest = b''
+    data = f.read(chunk_size)
+    while data:
+        lines = (rest + decompressor.decompress(data)).splitlines(True)
+        rest = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            offset += len(data) - len(unused)
+            for line in lines[:-1]:
+                yield line, None
+            if lines:
+                yield lines[-1], offset if rest == b'' else None
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            data = unused or f.read(chunk_size)
+        else:
+            offset += len(data)
+            for line in lines:
+                yield line, None
+            data = f.read(chunk_size)
+    if rest:
+        yield rest, offset
+
+
+class CrawlLogIndex(object):
+    """
+    The index of a single crawl log file.
+
+    blocks is a list of dicts with the offset and length of the block (in the file as stored, so compressed if it's
+    gzipped), the number of lines and the earliest and latest timestamps. hosts maps each host to the numbers of the
+    blocks it appears in.
+    """
+
+    def __init__(self, path, size, compressed, blocks, hosts):
+        self.path = path
+        self.size = size
+        self.compressed = compressed
+        self.blocks = blocks
+        self.hosts = hosts
+
+    @classmethod
+    def build(cls, path, stream=None, compressed=None, block_size=DEFAULT_INDEX_BLOCK_SIZE):
+        """
+        Builds the index for a log file, reading it from the given binary stream, or from the path if there isn't one.
+        """
+        if compressed is None:
+            compressed = path.endswith('.gz')
+        f = stream or open(path, 'rb')
+        blocks = []
+        hosts = {}
+        block = { 'offset': 0, 'lines': 0, 'start': None, 'end': None }
+        block_hosts = set()
+        size = 0
+        try:
+            read_lines = _gzip_lines if compressed else _plain_lines
+            for line, end in read_lines(f, READ_CHUNK_SIZE):
+                block['lines'] += 1
+                host, timestamp = line_host_and_timestamp(line)
+                if host is not None:
+                    block_hosts.add(host)
+                    if block['start'] is None or timestamp < block['start']:
+                        block['start'] = timestamp
+                    if block['end'] is None or timestamp > block['end']:
+                        block['end'] = timestamp
+                if end is not None:
+                    size = end
+                    if size - block['offset'] >= block_size:
+                        cls._add_block(blocks, hosts, block, block_hosts, size)
+                        block = { 'offset': size, 'lines': 0, 'start': None, 'end': None }
+                        block_hosts = set()
+        finally:
+            if stream is None:
+                f.close()
+        if block['lines'] > 0:
+            cls._add_block(blocks, hosts, block, block_hosts, size)
+        return cls(path, size, compressed, blocks, hosts)
+
+    @staticmethod
+    def _add_block(blocks, hosts, block, block_hosts, end):
+        block['length'] = end - block['offset']
+        for host in block_hosts:
+            hosts.setdefault(host, []).append(len(blocks))
+        blocks.append(block)
+
+    @classmethod
+    def load(cls, f):
+        data = json.load(f)
+        return cls(data['path'], data['size'], data['compressed'], data['blocks'], data['hosts'])
+
+    def save(self, f):
+        json.dump({
+            'path': self.path,
+            'size': self.size,
+            'compressed': self.compressed,
+            'blocks': self.blocks,
+            'hosts': self.hosts,
+        }, f)
+
+    def is_current(self):
+        """
+        Checks the (local) log file has not changed size since it was indexed, e.g. because it is still being written.
+        """
+        return os.path.exists(self.path) and os.path.getsize(self.path) == self.size
+
+    def contains(self, host):
+        return host in self.hosts
+
+    def blocks_for(self, host=None, start=None, end=None):
+        """
+        Finds the blocks that could contain lines for the given host, between the given start and end times.
+
+        The times are compared with the log timestamps as strings, so any prefix of an ISO timestamp can be used,
+        e.g. end='2019-07-14' includes all of that day.
+        """
+        if host is None:
+            numbers = range(len(self.blocks))
+        else:
+            numbers = self.hosts.get(host, [])
+        blocks = []
+        for number in numbers:
+            block = self.blocks[number]
+            if (start or end) and block['start'] is None:
+                continue
+            if start and block['end'] < start:
+                continue
+            if end and block['start'][:len(end)] > end:
+                continue
+            blocks.append(block)
+        return blocks
+
+    def read_blocks(self, blocks):
+        """
+        Yields the raw lines (as bytes) of the given blocks of the (local) log file, seeking to each one in turn.
+        """
+        with open(self.path, 'rb') as f:
+            for block in blocks:
+                f.seek(block['offset'])
+                data = f.read(block['length'])
+                if self.compressed:
+                    data = gzip.decompress(data)
+                for line in data.splitlines():
+                    yield line
+
+    def lines(self, host, start=None, end=None):
+        """
+        Yields just the lines for the given host, between the given start and end times.
+        """
+        for line in self.read_blocks(self.blocks_for(host, start, end)):
+            line_host, timestamp = line_host_and_timestamp(line)
+            if line_host != host:
+                continue
+            if start and timestamp < start:
+                continue
+            if end and timestamp[:len(end)] > end:
+                continue
+            yield line.decode('utf-8', 'replace')
+
+
+def load_crawl_log_index(job, launch_id, log_path, from_hdfs=False):
+    """
+    Loads the index for a log file, if there is one that is up to date.
+
+    Logs on HDFS are not checked, as only completed logs are copied there.
+    """
+    path = index_path(job, launch_id, log_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        index = CrawlLogIndex.load(f)
+    if not from_hdfs and not index.is_current():
+        logger.warning("Ignoring out-of-date index for %s" % log_path)
+        return None
+    return index
+
+
+def expand_log_paths(log_paths, from_hdfs=False):
+    """
+    Expands any wildcards in local log paths (as InputFile allows them). Paths on HDFS are left as they are.
+    """
+    if from_hdfs:
+        return list(log_paths)
+    expanded = []
+    for log_path in log_paths:
+        expanded.extend(sorted(glob.glob(log_path)) or [log_path])
+    return expanded
+
+
+class IndexCrawlLog(luigi.Task):
+    """
+    Builds the index of the hosts and times in each block of a crawl log.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_path = luigi.Parameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+    block_size = luigi.IntParameter(default=DEFAULT_INDEX_BLOCK_SIZE)
+
+    def output(self):
+        return luigi.LocalTarget(path=index_path(self.job, self.launch_id, self.log_path))
+
+    def complete(self):
+        # Re-index logs that have grown since they were indexed:
+        return load_crawl_log_index(self.job, self.launch_id, self.log_path, self.from_hdfs) is not None
+
+    def run(self):
+        if self.from_hdfs:
+            with luigi.contrib.hdfs.HdfsTarget(path=self.log_path, format=luigi.format.Nop).open('r') as f:
+                index = CrawlLogIndex.build(self.log_path, f, block_size=self.block_size)
+        else:
+            index = CrawlLogIndex.build(self.log_path, block_size=self.block_size)
+        logger.info("Indexed %i blocks and %i hosts in %s" % (len(index.blocks), len(index.hosts), self.log_path))
+        with self.output().open('w') as f:
+            index.save(f)
+
+
+class IndexCrawlLogs(luigi.WrapperTask):
+    """
+    Builds the indexes for a set of crawl logs.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+
+    def requires(self):
+        for log_path in expand_log_paths(self.log_paths, self.from_hdfs):
+            yield IndexCrawlLog(self.job, self.launch_id, log_path, self.from_hdfs)
+
+
+def get_index(job, launch_id, log_path, block_size=DEFAULT_INDEX_BLOCK_SIZE):
+    """
+    Gets the index for a local log file, building and saving it if there isn't an up-to-date one.
+    """
+    index = load_crawl_log_index(job, launch_id, log_path)
+    if index is None:
+        index = CrawlLogIndex.build(log_path, block_size=block_size)
+        path = index_path(job, launch_id, log_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            index.save(f)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='log_index')
+    parser.add_argument('-j', '--job', required=True, help='The crawl job the logs are from.')
+    parser.add_argument('-l', '--launch-id', required=True, help='The launch ID of the crawl job.')
+    parser.add_argument('-b', '--block-size', type=int, default=DEFAULT_INDEX_BLOCK_SIZE,
+                        help='Target size of each indexed block, in bytes.')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='Build the indexes for the given logs.')
+    build_parser.add_argument('log_files', nargs='+')
+    extract_parser = subparsers.add_parser('extract', help='Print the log lines for a host.')
+    extract_parser.add_argument('--host', required=True)
+    extract_parser.add_argument('--start', help='Only include lines logged at or after this (ISO) time.')
+    extract_parser.add_argument('--end', help='Only include lines logged up to this (ISO) time.')
+    extract_parser.add_argument('log_files', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for log_file in expand_log_paths(args.log_files):
+            index = get_index(args.job, args.launch_id, log_file, args.block_size)
+            print("%s: %i blocks, %i hosts" % (log_file, len(index.blocks), len(index.hosts)))
+    elif args.command == 'extract':
+        total = 0
+        read = 0
+        for log_file in expand_log_paths(args.log_files):
+            index = get_index(args.job, args.launch_id, log_file, args.block_size)
+            total += index.size
+            read += sum(block['length'] for block in index.blocks_for(args.host, args.start, args.end))
+            for line in index.lines(args.host, args.start, args.end):
+                print(line)
+        print("Read %i of %i bytes." % (read, total), file=sys.stderr)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import gzip
+import luigi
+from tasks.analyse.crawl_logs.log_index import CrawlLogIndex, get_index, line_host_and_timestamp
+from tasks.analyse.crawl_logs.log_analysis_hadoop import ExtractLogsForHost
+
+CRAWL_LOG = os.path.abspath('../../test/crawl.log')
+
+
+def _make_copies(folder):
+    """
+    Makes a plain copy of the test log, one gzipped as a member per few lines (as bgzip would), and one gzipped as a
+    single stream.
+    """
+    with open(CRAWL_LOG, 'rb') as f:
+        lines = f.readlines()
+    copies = {
+        'plain': (os.path.join(str(folder), 'crawl.log'), b''.join(lines)),
+        'members': (os.path.join(str(folder), 'crawl-members.log.gz'),
+                    b''.join(gzip.compress(b''.join(lines[i:i + 5])) for i in range(0, len(lines), 5))),
+        'single': (os.path.join(str(folder), 'crawl-single.log.gz'), gzip.compress(b''.join(lines))),
+    }
+    for path, data in copies.values():
+        with open(path, 'wb') as f:
+            f.write(data)
+    return dict((kind, path) for kind, (path, data) in copies.items()), lines
+
+
+def _scan(lines):
+    """
+    The lines for each host, by reading every line.
+    """
+    hosts = {}
+    for line in lines:
+        host, timestamp = line_host_and_timestamp(line)
+        if host is not None:
+            hosts.setdefault(host, []).append(line.rstrip(b'\r\n').decode('utf-8'))
+    return hosts
+
+
+def test_index_matches_full_scan(tmp_path):
+    paths, lines = _make_copies(tmp_path)
+    expected = _scan(lines)
+    assert len(expected) > 5
+
+    for kind, path in paths.items():
+        index = CrawlLogIndex.build(path, block_size=2000)
+        if kind == 'single':
+            assert len(index.blocks) == 1
+        else:
+            assert len(index.blocks) > 5
+        assert index.size == os.path.getsize(path)
+        assert sum(block['lines'] for block in index.blocks) == len(lines)
+        assert sorted(index.hosts.keys()) == sorted(expected.keys())
+        for host, host_lines in expected.items():
+            assert list(index.lines(host)) == host_lines, "%s differs for %s" % (kind, host)
+        assert list(index.lines('not-in-the-log.example.com')) == []
+
+
+def test_extract_logs_for_host_from_index(tmp_path, monkeypatch):
+    paths, lines = _make_copies(tmp_path)
+    hosts = _scan(lines)
+    # The task outputs and indexes go under the current folder:
+    monkeypatch.chdir(tmp_path)
+
+    for host in sorted(hosts.keys()):
+        # What the job would output, from every line of the log:
+        scan = ExtractLogsForHost('scan', '20181126', [], host)._extract(
+            line.decode('utf-8').rstrip('\n') for line in lines)
+        expected = ''.join("%s\t%s\n" % (key, line) for key, line in sorted(scan))
+        outputs = {}
+        for kind, path in sorted(paths.items()):
+            get_index(kind, '20181126', path, block_size=2000)
+            task = ExtractLogsForHost(kind, '20181126', [path], host, use_index=True)
+            luigi.build([task], local_scheduler=True)
+            with task.output().open() as f:
+                outputs[kind] = f.read()
+        assert len(expected.splitlines()) == len(hosts[host])
+        for kind, output in outputs.items():
+            assert output == expected, "%s differs for %s" % (kind, host)
@@ -0,0 +1,362 @@
+"""
+Converts crawl logs into Parquet files, partitioned by launch and day, so that questions about a crawl can be
+answered by reading just the columns and days they need, rather than re-parsing the raw logs with a new Hadoop job.
+
+The files are laid out as:
+
+    <root>/<job>/launch_id=<launch_id>/day=<YYYY-MM-DD>/crawl-log-<fingerprint>.parquet
+
+i.e. as a 'Hive-style' partitioned dataset, with one file per log file per day. The files are named after the
+fingerprint of the log (as for incremental analysis, see log_increments.log_fingerprint) rather than its name, so when
+the crawler renames crawl.log to crawl.log.cpNNNNN, converting the renamed log replaces the files made from it
+before, rather than adding a second copy of every row. A log that is still being written is converted again
+whenever it has grown. Along with the CrawlLogLine fields,
+the annotations are split out into a list, and the IP, number of tries and WARC record details are given columns of
+their own. The low-cardinality columns (host, MIME type, status code etc.) are dictionary-encoded, so they take up
+little space and can be counted quickly.
+
+e.g. to count the status codes for one day of a launch:
+
+    status_code_counts(read_crawl_logs(root, 'weekly', '20180507080102', ['status_code'], days=['2018-05-08']))
+
+"""
+import os
+import json
+import hashlib
+import logging
+import datetime
+import luigi
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tasks.analyse.crawl_logs.log_analysis_hadoop import RE_IP, RE_TRIES, InputFile
+from tasks.analyse.crawl_logs.log_reports import parse_line
+from tasks.analyse.crawl_logs.log_increments import LogRange, log_size, log_fingerprint
+from tasks.analyse.crawl_logs.log_index import expand_log_paths
+
+logger = logging.getLogger(__name__)
+
+# Where the Parquet files go:
+PARQUET_ROOT = os.environ.get('CRAWL_LOG_PARQUET_ROOT', 'task-state/crawl-log-parquet')
+
+# How many rows to collect for a day before writing them out as a row group:
+ROW_GROUP_SIZE = 100000
+
+_STRINGS = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('ms', tz='UTC')),
+    ('status_code', pa.dictionary(pa.int32(), pa.int32())),
+    ('content_length', pa.int64()),
+    ('url', pa.string()),
+    ('host', _STRINGS),
+    ('hop_path', pa.string()),
+    ('via', pa.string()),
+    ('mime', _STRINGS),
+    ('thread', _STRINGS),
+    ('fetch_start', pa.timestamp('ms', tz='UTC')),
+    ('duration_ms', pa.int32()),
+    ('hash', pa.string()),
+    ('source', _STRINGS),
+    ('annotations', pa.list_(pa.string())),
+    ('ip', _STRINGS),
+    ('tries', pa.int32()),
+    ('warc_filename', _STRINGS),
+    ('warc_offset', pa.int64()),
+    ('warc_length', pa.int64()),
+    ('extra_json', pa.string()),
+])
+
+# The dictionary-encoded columns:
+DICTIONARY_COLUMNS = [field.name for field in SCHEMA if pa.types.is_dictionary(field.type)]
+
+
+def _int_or_none(value):
+    return int(value) if value.lstrip('-').isdigit() else None
+
+
+def _fetch_start_and_duration(value):
+    # e.g. 20181126142745781+41, or '-' if nothing was fetched:
+    if '+' not in value or len(value) < 18 or not value[:17].isdigit():
+        return None, None
+    start = datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[8:10]),
+                              int(value[10:12]), int(value[12:14]), int(value[14:17]) * 1000)
+    return start, _int_or_none(value[18:])
+
+
+def log_to_row(log):
+    """
+    Turns a CrawlLogLine into a dict of the values of the SCHEMA columns.
+    """
+    fetch_start, duration = _fetch_start_and_duration(log.start_time_plus_duration)
+    annotations = [anno for anno in log.annotations if anno != '-']
+    ip = None
+    tries = None
+    for anno in annotations:
+        if anno.startswith('ip:'):
+            ip = anno[3:]
+        elif anno[:1].isdigit():
+            if RE_TRIES.match(anno):
+                tries = int(anno[:-1])
+            elif RE_IP.match(anno):
+                ip = anno
+    warc_filename = warc_offset = warc_length = None
+    if log.extra_json:
+        try:
+            extra = json.loads(log.extra_json)
+            warc_filename = extra.get('warcFilename', None)
+            warc_offset = extra.get('warcFileOffset', None)
+            warc_length = extra.get('warcFileRecordLength', None)
+        except ValueError:
+            pass
+    return {
+        'timestamp': datetime.datetime.fromisoformat(log.timestamp.rstrip('Z')),
+        'status_code': _int_or_none(log.status_code),
+        'content_length': _int_or_none(log.content_length),
+        'url': log.url,
+        'host': log.host(),
+        'hop_path': log.hop_path,
+        'via': log.via,
+        'mime': log.mime,
+        'thread': log.thread,
+        'fetch_start': fetch_start,
+        'duration_ms': duration,
+        'hash': log.hash,
+        'source': log.source,
+        'annotations': annotations,
+        'ip': ip,
+        'tries': tries,
+        'warc_filename': warc_filename,
+        'warc_offset': warc_offset,
+        'warc_length': warc_length,
+        'extra_json': log.extra_json,
+    }
+
+
+def rows_to_table(columns):
+    """
+    Makes a table from a dict of lists of column values.
+    """
+    arrays = []
+    for field in SCHEMA:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns[field.name], type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+
+def partition_dir(root, job, launch_id, day):
+    return os.path.join(root, job, 'launch_id=%s' % launch_id, 'day=%s' % day)
+
+
+def parquet_file_name(fingerprint):
+    """
+    The name used for the Parquet files made from a log file, from its fingerprint.
+    """
+    return "crawl-log-%s.parquet" % fingerprint
+
+
+def convert_log(log_path, job, launch_id, root=PARQUET_ROOT, from_hdfs=False, size=None, fingerprint=None):
+    """
+    Converts a crawl log (up to the given size) into one Parquet file for each day it covers. Each file is written
+    under a temporary name and only moved into place once the whole log has been read.
+
+    A last line without a newline is included, as the log may have finished without one, but if the log is still
+    being written it may be incomplete, so a warning is logged.
+
+    :return: a dict of the number of rows written for each day
+    """
+    if size is None:
+        size = log_size(log_path, from_hdfs)
+    if fingerprint is None:
+        fingerprint = log_fingerprint(log_path, size, from_hdfs)
+    file_name = parquet_file_name(fingerprint)
+    writers = {}
+    pending = {}
+    counts = {}
+
+    def flush(day):
+        if day not in writers:
+            out_dir = partition_dir(root, job, launch_id, day)
+            os.makedirs(out_dir, exist_ok=True)
+            writers[day] = pq.ParquetWriter(os.path.join(out_dir, '_%s.temp' % file_name), SCHEMA,
+                                            use_dictionary=DICTIONARY_COLUMNS, compression='snappy')
+        writers[day].write_table(rows_to_table(pending[day]))
+        pending[day] = dict((field.name, []) for field in SCHEMA)
+
+    log_range = LogRange(log_path, 0, size, from_hdfs, final=True)
+    try:
+        for line in log_range:
+            log = parse_line(line)
+            if log is None:
+                continue
+            try:
+                row = log_to_row(log)
+            except ValueError as e:
+                logger.warning("Skipping unparseable line in %s: %s" % (log_path, e))
+                continue
+            day = log.timestamp[:10]
+            if day not in pending:
+                pending[day] = dict((field.name, []) for field in SCHEMA)
+                counts[day] = 0
+            for name, value in row.items():
+                pending[day][name].append(value)
+            counts[day] += 1
+            if len(pending[day]['url']) >= ROW_GROUP_SIZE:
+                flush(day)
+        for day in pending:
+            if pending[day]['url'] or day not in writers:
+                flush(day)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if log_range.unterminated:
+        logger.warning("The last line of %s has no newline, so may still be being written." % log_path)
+
+    for day in counts:
+        out_dir = partition_dir(root, job, launch_id, day)
+        os.replace(os.path.join(out_dir, '_%s.temp' % file_name), os.path.join(out_dir, file_name))
+    return counts
+
+
+def read_crawl_logs(root, job, launch_id, columns=None, days=None):
+    """
+    Reads the given columns (or all of them) for a launch, optionally only for the given days (as YYYY-MM-DD).
+
+    Only the files for those days are read, and only the requested columns of them.
+    """
+    path = os.path.join(root, job, 'launch_id=%s' % launch_id)
+    if days is not None:
+        tables = []
+        for day in days:
+            day_path = os.path.join(path, 'day=%s' % day)
+            if os.path.isdir(day_path):
+                tables.append(pq.read_table(day_path, columns=columns))
+        if not tables:
+            return SCHEMA.empty_table() if columns is None else \
+                pa.schema([SCHEMA.field(name) for name in columns]).empty_table()
+        return pa.concat_tables(tables)
+    return pq.read_table(path, columns=columns)
+
+
+def status_code_counts(table):
+    """
+    Counts each status code in a table with a status_code column.
+    """
+    counts = {}
+    for chunk in table.column('status_code').chunks:
+        # Count the dictionary indices rather than looking up every value:
+        if pa.types.is_dictionary(chunk.type):
+            codes = chunk.dictionary.to_pylist()
+            for index in chunk.indices.to_pylist():
+                if index is not None:
+                    counts[codes[index]] = counts.get(codes[index], 0) + 1
+        else:
+            for code in chunk.to_pylist():
+                if code is not None:
+                    counts[code] = counts.get(code, 0) + 1
+    return counts
+
+
+def host_rows(table, host):
+    """
+    The rows in a table (which must have a host column) for the given host, as a list of dicts.
+    """
+    rows = []
+    for batch in table.to_batches():
+        hosts = batch.column(batch.schema.get_field_index('host'))
+        wanted = hosts.dictionary.to_pylist()
+        if host not in wanted:
+            continue
+        index = wanted.index(host)
+        matches = [i for i, value in enumerate(hosts.indices.to_pylist()) if value == index]
+        if matches:
+            data = batch.to_pydict()
+            rows.extend(dict((name, data[name][i]) for name in data) for i in matches)
+    return rows
+
+
+def dead_seeds(table):
+    """
+    Lists seeds that were never successfully downloaded, as for the dead-seeds report, from a table with url,
+    status_code, hop_path and via columns.
+    """
+    live = set()
+    dead = set()
+    columns = [table.column(name).to_pylist() for name in ['url', 'status_code', 'hop_path', 'via']]
+    for url, status, hop_path, via in zip(*columns):
+        if status is None:
+            continue
+        if 200 <= status < 400:
+            live.add(url)
+        elif status == 404 and hop_path == '-' and via == '-':
+            dead.add(url)
+    return sorted(dead - live)
+
+
+class CrawlLogToParquet(luigi.Task):
+    """
+    Converts a crawl log into Parquet files, partitioned by launch and day (see convert_log).
+
+    The log can be local or on HDFS, but the Parquet files are written locally, under the given root. The output is
+    a JSON manifest of the number of rows written for each day, along with the fingerprint and size of the log. If a
+    (local) log grows after it has been converted, e.g. because it is the crawl.log of a running crawl, it is
+    converted again.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_path = luigi.Parameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+    root = luigi.Parameter(default=PARQUET_ROOT)
+
+    def requires(self):
+        return InputFile(self.log_path, self.from_hdfs)
+
+    def output(self):
+        # Log files in different folders can have the same name, so include a hash of the full path:
+        name = "%s-%s" % (os.path.basename(self.log_path), hashlib.md5(self.log_path.encode('utf-8')).hexdigest()[:8])
+        return luigi.LocalTarget(path="task-state/%s/%s/crawl-log-parquet/%s.json" % (self.job, self.launch_id, name))
+
+    def complete(self):
+        if not self.output().exists():
+            return False
+        # Logs on HDFS are not checked, as only completed logs are copied there:
+        if self.from_hdfs:
+            return True
+        with self.output().open('r') as f:
+            manifest = json.load(f)
+        return os.path.exists(self.log_path) and log_size(self.log_path, self.from_hdfs) == manifest.get('size', None)
+
+    def run(self):
+        size = log_size(self.log_path, self.from_hdfs)
+        fingerprint = log_fingerprint(self.log_path, size, self.from_hdfs)
+        if fingerprint is None:
+            raise Exception("The first line of %s has not been written yet!" % self.log_path)
+        counts = convert_log(self.log_path, self.job, self.launch_id, self.root, self.from_hdfs, size, fingerprint)
+        logger.info("Converted %s to Parquet: %s" % (self.log_path, json.dumps(counts)))
+        with self.output().open('w') as f:
+            json.dump({
+                'log_path': self.log_path,
+                'fingerprint': fingerprint,
+                'size': size,
+                'file_name': parquet_file_name(fingerprint),
+                'days': counts
+            }, f)
+
+
+class CrawlLogsToParquet(luigi.WrapperTask):
+    """
+    Converts a set of crawl logs (which may be given as local glob patterns) into Parquet files.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    from_hdfs = luigi.BoolParameter(default=False)
+    root = luigi.Parameter(default=PARQUET_ROOT)
+
+    def requires(self):
+        for log_path in expand_log_paths(self.log_paths, self.from_hdfs):
+            yield CrawlLogToParquet(self.job, self.launch_id, log_path, self.from_hdfs, self.root)
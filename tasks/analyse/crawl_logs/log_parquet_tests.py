@@ -0,0 +1,58 @@
+import os
+import shutil
+import luigi
+from tasks.analyse.crawl_logs.log_parquet import CrawlLogToParquet, read_crawl_logs, status_code_counts, dead_seeds
+from tasks.analyse.crawl_logs.log_analysis_hadoop import CountStatusCodes, ListDeadSeeds
+
+CRAWL_LOGS = [os.path.abspath('../../test/crawl.log'),
+              os.path.abspath('../../test/fragment-of-a-crawl-with-dead-seeds.log')]
+
+
+def _read_tsv(target):
+    with target.open() as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_reports_from_parquet(tmp_path, monkeypatch):
+    # The task outputs and Parquet files go under the current folder:
+    monkeypatch.chdir(tmp_path)
+    for i, log_path in enumerate(CRAWL_LOGS):
+        job = 'job%i' % i
+        convert = CrawlLogToParquet(job, '20181126', log_path, root='parquet')
+        count_status_codes = CountStatusCodes([log_path], job, '20181126', False)
+        list_dead_seeds = ListDeadSeeds([log_path], job, '20181126', False)
+        luigi.build([convert, count_status_codes, list_dead_seeds], local_scheduler=True)
+
+        table = read_crawl_logs('parquet', job, '20181126')
+        counts = dict((str(code), count) for code, count in status_code_counts(table).items())
+        assert counts == dict((code, int(count)) for code, count in _read_tsv(count_status_codes.output()))
+        assert dead_seeds(table) == sorted(url for url, state in _read_tsv(list_dead_seeds.output()))
+
+
+def test_live_and_renamed_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(CRAWL_LOGS[0], 'rb') as f:
+        lines = f.readlines()
+
+    # A live log, with the last line not finished:
+    with open('crawl.log', 'wb') as f:
+        f.write(b''.join(lines[:40]))
+        f.write(lines[40].rstrip(b'\n'))
+    convert = CrawlLogToParquet('dc', '20181126', os.path.abspath('crawl.log'), root='parquet')
+    luigi.build([convert], local_scheduler=True)
+    assert read_crawl_logs('parquet', 'dc', '20181126').num_rows == 41
+    assert convert.complete()
+
+    # Converted again once it has grown:
+    with open('crawl.log', 'ab') as f:
+        f.write(b'\n')
+        f.write(b''.join(lines[41:]))
+    assert not convert.complete()
+    luigi.build([convert], local_scheduler=True)
+    assert read_crawl_logs('parquet', 'dc', '20181126').num_rows == len(lines)
+
+    # Replaced rather than duplicated when renamed at a checkpoint:
+    shutil.move('crawl.log', 'crawl.log.cp00001')
+    luigi.build([CrawlLogToParquet('dc', '20181126', os.path.abspath('crawl.log.cp00001'), root='parquet')],
+                local_scheduler=True)
+    assert read_crawl_logs('parquet', 'dc', '20181126').num_rows == len(lines)
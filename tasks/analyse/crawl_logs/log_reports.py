@@ -0,0 +1,623 @@
+import os
+import re
+import gzip
+import json
+import logging
+from urllib.parse import urlparse
+from multiprocessing import Pool
+import luigi
+import luigi.contrib.hdfs
+import luigi.contrib.hadoop
+from luigi.contrib.hdfs.format import Plain, PlainDir
+
+from tasks.analyse.crawl_logs.log_analysis_hadoop import CrawlLogLine, CrawlLogExtractors, InputFile, split_log_fields, \
+    add_stats
+from tasks.analyse.crawl_logs.intermediate import CrawlLogJobTask
+from tasks.analyse.crawl_logs.sketches import hash_value, hll_position, hll_from_position, hll_merge, hll_count, \
+    topk_merge, topk_items, tdigest_from, tdigest_merge, tdigest_count, tdigest_quantile
+
+import lib, dateutil, six # Imported so extra_modules MR-bundle can access them
+
+logger = logging.getLogger(__name__)
+
+# Defaults for local runs:
+DEFAULT_LOCAL_PROCESSES = 4
+
+
+class LogAggregator(object):
+    """
+    Base class for the reports that can be generated from a single pass over the crawl logs.
+
+    Each aggregator maps log lines to (key, value) pairs, and must be able to combine any number of values for the
+    same key into a single value of the same form, in any order. This means the values can be partially combined
+    (in the mapper, in a Hadoop combiner, or in a local worker process) before the final combination and output.
+    """
+    # The name of the report, used to label the keys and name the outputs:
+    name = None
+
+    def setup(self, job, launch_id, from_hdfs, targets_path):
+        """
+        Called once before any lines are mapped, e.g. to load reference data.
+        """
+        pass
+
+    def map(self, log):
+        """
+        :param log: a CrawlLogLine
+        :return: yields (key, value) pairs
+        """
+        raise NotImplementedError()
+
+    def combine(self, key, values):
+        """
+        :return: the value that results from combining all the given values for this key
+        """
+        raise NotImplementedError()
+
+    def output(self, key, value):
+        """
+        :return: yields the (key, value) output lines for the final combined value of a key
+        """
+        yield key, value
+
+
+class StatusCodesAggregator(LogAggregator):
+    """
+    Counts of each Heritrix/HTTP status code, as for CountStatusCodes.
+    """
+    name = 'status-codes'
+
+    def map(self, log):
+        if log.status_code.lstrip('-').isdigit():
+            yield log.status_code, 1
+
+    def combine(self, key, values):
+        return sum(values)
+
+    def output(self, key, value):
+        yield key, str(value)
+
+
+class DeadSeedsAggregator(LogAggregator):
+    """
+    Lists seeds that were never successfully downloaded, as for ListDeadSeeds.
+    """
+    name = 'dead-seeds'
+
+    def map(self, log):
+        if not log.status_code.isdigit():
+            return
+        status = int(log.status_code)
+        if 200 <= status < 400:
+            yield log.url, 'Live'
+        elif status == 404 and log.hop_path == '-' and log.via == '-':
+            yield log.url, 'Dead'
+
+    def combine(self, key, values):
+        # If a seed was live at any point in the crawl, it's not dead:
+        return 'Live' if 'Live' in values else 'Dead'
+
+    def output(self, key, value):
+        if value == 'Dead':
+            yield key, ''
+
+
+class HostSummaryAggregator(LogAggregator):
+    """
+    Summarises the IPs, MIME types, viruses and state of each host, as for SummariseLogFiles.
+    """
+    name = 'host-summary'
+
+    SECOND_LEVEL_DOMAINS = ["ac", "co", "gov", "judiciary", "ltd", "me", "mod", "net", "nhs", "nic", "org",
+                            "parliament", "plc", "sch"]
+
+    def map(self, log):
+        if not log.status_code.isdigit():
+            return
+        status = int(log.status_code)
+        data = { 'ip': {}, 'mime': {}, 'virus': {} }
+        if 200 <= status < 400:
+            data['url_state'] = 'Live'
+            data['mime'][''.join([i if ord(i) < 128 else '' for i in log.mime])] = 1
+            for anno in log.annotations:
+                if ':' not in anno:
+                    continue
+                key, value = anno.split(':', 1)
+                if key == 'ip':
+                    data['ip'][value] = 1
+                if key == '1':
+                    data['virus'][value.split()[-2]] = 1
+        elif status == 404 and log.hop_path == '-' and log.via == '-':
+            data['url_state'] = 'Has Dead Seeds'
+        else:
+            return
+        yield re.sub(r"^(www([0-9]+)?)\.", "", urlparse(log.url)[1]), data
+
+    def combine(self, key, values):
+        combined = { 'ip': {}, 'mime': {}, 'virus': {}, 'url_state': 'Live' }
+        for value in values:
+            for field in ['ip', 'mime', 'virus']:
+                counts = combined[field]
+                for item, count in value[field].items():
+                    counts[item] = counts.get(item, 0) + count
+            # We assume that even if a host appeared live at some point in the crawl,
+            # it can be considered to have dead seeds if at any other point we encountered one.
+            if value['url_state'] == 'Has Dead Seeds':
+                combined['url_state'] = 'Has Dead Seeds'
+        return combined
+
+    def output(self, key, value):
+        value = dict(value)
+        value['host'] = key
+        value['tld'] = key.split('.')[-1]
+        auth = key.split('.')
+        if len(auth) > 2 and auth[-2] in self.SECOND_LEVEL_DOMAINS:
+            value['2ld'] = auth[-2]
+        yield key, json.dumps(value)
+
+
+class DayHostSourceAggregator(LogAggregator):
+    """
+    Counts of the low-cardinality properties of each line (see CrawlLogLine.stats), by day, host and source, as for
+    the BY_DAY_HOST_SOURCE records of AnalyseLogFile.
+    """
+    name = 'by-day-host-source'
+
+    def map(self, log):
+        summaries = {}
+        add_stats(log.stats(), summaries)
+        yield "%s,%s,%s" % (log.day(), log.host(), log.source), summaries
+
+    def combine(self, key, values):
+        combined = {}
+        for value in values:
+            for prop, count in value.items():
+                combined[prop] = combined.get(prop, 0) + count
+        return combined
+
+    def output(self, key, value):
+        yield key, json.dumps(value)
+
+
+class DocumentsAggregator(LogAggregator):
+    """
+    Finds documents associated with Watched Targets, as for the DOCUMENT records of AnalyseLogFile, in crawl order.
+    """
+    name = 'documents'
+
+    def setup(self, job, launch_id, from_hdfs, targets_path):
+        self.extractor = CrawlLogExtractors(job, launch_id, from_hdfs, targets_path=targets_path)
+
+    def map(self, log):
+        doc = self.extractor.extract_documents(log)
+        if doc:
+            yield log.start_time_plus_duration, [doc]
+
+    def combine(self, key, values):
+        return [doc for value in values for doc in value]
+
+    def output(self, key, value):
+        for doc in value:
+            yield key, doc
+
+
+class SketchesAggregator(LogAggregator):
+    """
+    Estimates of the number of distinct URLs and hosts, the busiest hosts, and the distribution of fetch durations
+    and content lengths, using mergeable sketches (see sketches.py) rather than passing every value on.
+
+    These are generated by day and host (keyed 'day,host'), by day over all hosts ('day,-') and over the whole
+    launch ('-,-'). Each output value is JSON, with the estimates and the sketches themselves, so that they can be
+    merged further (e.g. over several launches).
+    """
+    name = 'sketches'
+
+    # The quantiles to report:
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    # How many of the busiest hosts to report:
+    TOP_HOSTS = 20
+
+    def map(self, log):
+        host = log.host() or ''
+        day = log.day()
+        url_position = hll_position(hash_value(log.url))
+        host_position = hll_position(hash_value(host))
+        duration = log.duration()
+        content_length = int(log.content_length) if log.content_length.isdigit() else None
+        # Each key needs its own copy of the value, as they get combined in place:
+        for key, all_hosts in [("%s,%s" % (day, host), False), ("%s,-" % day, True), ("-,-", True)]:
+            value = { 'lines': 1, 'urls': hll_from_position(url_position),
+                      'duration': tdigest_from(duration), 'content_length': tdigest_from(content_length) }
+            if all_hosts:
+                value['hosts'] = hll_from_position(host_position)
+                value['top_hosts'] = { host: 1 }
+            yield key, value
+
+    def combine(self, key, values):
+        combined = None
+        for value in values:
+            if combined is None:
+                combined = value
+                continue
+            combined['lines'] += value['lines']
+            hll_merge(combined['urls'], value['urls'])
+            tdigest_merge(combined['duration'], value['duration'])
+            tdigest_merge(combined['content_length'], value['content_length'])
+            if 'hosts' in value:
+                hll_merge(combined['hosts'], value['hosts'])
+                topk_merge(combined['top_hosts'], value['top_hosts'])
+        return combined
+
+    def _distribution(self, td):
+        summary = { 'count': tdigest_count(td), 'min': td['min'], 'max': td['max'] }
+        for q in self.QUANTILES:
+            summary['p%i' % int(q * 100)] = tdigest_quantile(td, q)
+        return summary
+
+    def output(self, key, value):
+        summary = {
+            'lines': value['lines'],
+            'distinct_urls': hll_count(value['urls']),
+            'duration_ms': self._distribution(value['duration']),
+            'content_length': self._distribution(value['content_length']),
+            'sketches': value,
+        }
+        if 'hosts' in value:
+            summary['distinct_hosts'] = hll_count(value['hosts'])
+            summary['top_hosts'] = topk_items(value['top_hosts'], self.TOP_HOSTS)
+        yield key, json.dumps(summary)
+
+
+class FetchStatsAggregator(LogAggregator):
+    """
+    Request rates, throughput, fetch durations and retries for each host and each IP address, by hour, to help spot
+    hosts that are slowing the crawl down or throttling it.
+
+    Keyed 'hour,host,<host>' or 'hour,ip,<ip>'. See FetchStatsReport for turning these into JSON and metrics.
+
+    The rates are per second over the whole window, but the first and last log timestamps are included, so that
+    windows the logs only partly cover (e.g. the current hour of a running crawl) can be corrected for, once the
+    stats for all the hosts and IPs are together (see fetch_stats.set_window_coverage).
+    """
+    name = 'fetch-stats'
+
+    # The length of each time window, matching CrawlLogLine.hour():
+    WINDOW_SECONDS = 3600
+
+    # The quantiles of the fetch duration to report:
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    def map(self, log):
+        duration = log.duration()
+        tries = log.tries() or 1
+        content_length = int(log.content_length) if log.content_length.isdigit() else 0
+        hour = log.hour()
+        keys = ["%s,host,%s" % (hour, log.host() or '')]
+        ip = log.ip()
+        if ip:
+            keys.append("%s,ip,%s" % (hour, ip))
+        # Each key needs its own copy of the value, as they get combined in place:
+        for key in keys:
+            yield key, {
+                'lines': 1,
+                'bytes': content_length,
+                'fetched': 0 if duration is None else 1,
+                'fetched_bytes': 0 if duration is None else content_length,
+                'fetch_ms': duration or 0,
+                'durations': tdigest_from(duration),
+                'retried': 1 if tries > 1 else 0,
+                'tries': tries,
+                'first': log.timestamp,
+                'last': log.timestamp,
+            }
+
+    def combine(self, key, values):
+        combined = None
+        for value in values:
+            if combined is None:
+                combined = value
+                continue
+            for field in ['lines', 'bytes', 'fetched', 'fetched_bytes', 'fetch_ms', 'retried', 'tries']:
+                combined[field] += value[field]
+            tdigest_merge(combined['durations'], value['durations'])
+            combined['first'] = min(combined['first'], value['first'])
+            combined['last'] = max(combined['last'], value['last'])
+        return combined
+
+    def output(self, key, value):
+        window, kind, name = key.split(',', 2)
+        stats = {
+            'window': window,
+            'window_seconds': self.WINDOW_SECONDS,
+            'kind': kind,
+            'name': name,
+            'first': value['first'],
+            'last': value['last'],
+            'lines': value['lines'],
+            'bytes': value['bytes'],
+            'requests_per_second': value['lines'] / float(self.WINDOW_SECONDS),
+            'bytes_per_second': value['bytes'] / float(self.WINDOW_SECONDS),
+            # The throughput while actually fetching, which drops if a host is slow or throttling us:
+            'fetch_bytes_per_second': None,
+            'duration_ms': { 'mean': None, 'max': value['durations']['max'] },
+            'retry_rate': value['retried'] / float(value['lines']),
+            'mean_tries': value['tries'] / float(value['lines']),
+        }
+        if value['fetch_ms'] > 0:
+            stats['fetch_bytes_per_second'] = 1000.0 * value['fetched_bytes'] / value['fetch_ms']
+        if value['fetched'] > 0:
+            stats['duration_ms']['mean'] = value['fetch_ms'] / float(value['fetched'])
+        for q in self.QUANTILES:
+            stats['duration_ms']['p%i' % int(q * 100)] = tdigest_quantile(value['durations'], q)
+        yield key, json.dumps(stats)
+
+
+# The aggregators that are available, by name:
+AGGREGATORS = dict((cls.name, cls) for cls in [
+    StatusCodesAggregator, DeadSeedsAggregator, HostSummaryAggregator, DayHostSourceAggregator, DocumentsAggregator,
+    SketchesAggregator, FetchStatsAggregator])
+
+
+def make_aggregators(names, job, launch_id, from_hdfs=False, targets_path=None):
+    aggregators = []
+    for name in names:
+        if name not in AGGREGATORS:
+            raise Exception("Unknown log report '%s'! Should be one of %s" % (name, sorted(AGGREGATORS.keys())))
+        aggregator = AGGREGATORS[name]()
+        aggregator.setup(job, launch_id, from_hdfs, targets_path)
+        aggregators.append(aggregator)
+    return aggregators
+
+
+def parse_line(line):
+    """
+    Parses a log line, or returns None if it can't be parsed.
+
+    Lines for seeds that are missing the hop path and via fields are padded out with '-' values.
+    """
+    fields = split_log_fields(line)
+    if len(fields) == 10:
+        fields[4:4] = ['-', '-']
+    if len(fields) != 12:
+        return None
+    return CrawlLogLine.from_fields(fields)
+
+
+def open_log(log_path):
+    if log_path.endswith('.gz'):
+        return gzip.open(log_path, 'rt', encoding='utf-8', errors='replace')
+    return open(log_path, 'r', encoding='utf-8', errors='replace')
+
+
+def aggregate_lines(lines, aggregators, results):
+    """
+    Runs the aggregators over some log lines, combining all the values for each key into the results as it goes.
+
+    :param results: a dict of the partial values for each key, for each aggregator
+    :return: the number of lines read
+    """
+    count = 0
+    for line in lines:
+        count += 1
+        log = parse_line(line)
+        if log is None:
+            continue
+        for aggregator in aggregators:
+            partials = results[aggregator.name]
+            for key, value in aggregator.map(log):
+                if key in partials:
+                    partials[key] = aggregator.combine(key, [partials[key], value])
+                else:
+                    partials[key] = value
+    return count
+
+
+def merge_results(aggregators, combined, results):
+    """
+    Combines one set of partial results into another.
+    """
+    for aggregator in aggregators:
+        partials = combined[aggregator.name]
+        for key, value in results[aggregator.name].items():
+            if key in partials:
+                partials[key] = aggregator.combine(key, [partials[key], value])
+            else:
+                partials[key] = value
+
+
+def write_reports(aggregators, combined, out_dir):
+    """
+    Writes out one <report>.tsv file per report in out_dir, sorted by key.
+
+    :return: a dict of the number of lines output for each report
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for aggregator in aggregators:
+        counts[aggregator.name] = 0
+        with open(os.path.join(out_dir, '%s.tsv' % aggregator.name), 'w') as f:
+            partials = combined[aggregator.name]
+            for key in sorted(partials):
+                for out_key, out_value in aggregator.output(key, partials[key]):
+                    f.write("%s\t%s\n" % (out_key, out_value))
+                    counts[aggregator.name] += 1
+    return counts
+
+
+def _analyse_local_log(args):
+    """
+    Runs all the aggregators over a single local log file.
+    """
+    log_path, names, job, launch_id, targets_path = args
+    aggregators = make_aggregators(names, job, launch_id, targets_path=targets_path)
+    results = dict((aggregator.name, {}) for aggregator in aggregators)
+    with open_log(log_path) as f:
+        lines = aggregate_lines(f, aggregators, results)
+    logger.info("Analysed %i lines from %s" % (lines, log_path))
+    return results
+
+
+def run_local_log_reports(log_paths, names, out_dir, job, launch_id, targets_path=None,
+                          processes=DEFAULT_LOCAL_PROCESSES):
+    """
+    Generates the named reports from a set of local (optionally gzipped) crawl logs, reading each line only once.
+
+    Each log file is analysed by a separate worker process, and the partial results are combined and written out to
+    one <report>.tsv file per report in out_dir, sorted by key.
+
+    :return: a dict of the number of lines output for each report
+    """
+    argsv = [(log_path, names, job, launch_id, targets_path) for log_path in log_paths]
+    aggregators = make_aggregators(names, job, launch_id, targets_path=targets_path)
+    combined = dict((aggregator.name, {}) for aggregator in aggregators)
+    with Pool(processes) as pool:
+        for results in pool.imap_unordered(_analyse_local_log, argsv):
+            merge_results(aggregators, combined, results)
+    return write_reports(aggregators, combined, out_dir)
+
+
+class LogReports(CrawlLogJobTask):
+    """
+    Map-Reduce job that generates a set of reports from the crawl logs in a single pass, rather than running a
+    separate job for each one.
+
+    Each output line is the report name, the key and the value, tab-separated. See SplitLogReports for splitting
+    them out into separate files.
+
+    The intermediate keys and values are passed as they are, so this job benefits most from running with
+    --intermediate-format typedbytes.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    reports = luigi.ListParameter(default=sorted(AGGREGATORS.keys()))
+    targets_path = luigi.Parameter(default=None)
+    from_hdfs = luigi.BoolParameter(default=False)
+
+    n_reduce_tasks = luigi.Parameter(default=25)
+
+    aggregators = None
+
+    def requires(self):
+        reqs = []
+        for log_path in self.log_paths:
+            logger.info("LOG FILE TO PROCESS: %s" % log_path)
+            reqs.append(InputFile(log_path, self.from_hdfs))
+        return reqs
+
+    def output(self):
+        out_name = "task-state/%s/%s/crawl-logs-%i.reports.tsv" % (self.job, self.launch_id, len(self.log_paths))
+        if self.from_hdfs:
+            return luigi.contrib.hdfs.HdfsTarget(path=out_name, format=PlainDir)
+        else:
+            return luigi.LocalTarget(path=out_name)
+
+    def extra_modules(self):
+        return [lib, dateutil, six]
+
+    def _setup(self):
+        if self.aggregators is None:
+            self.aggregators = dict((aggregator.name, aggregator) for aggregator in
+                make_aggregators(self.reports, self.job, self.launch_id, self.from_hdfs, self.targets_path))
+
+    def init_mapper(self):
+        self._setup()
+
+    def init_combiner(self):
+        self._setup()
+
+    def init_reducer(self):
+        self._setup()
+
+    def mapper(self, line):
+        log = parse_line(line)
+        if log is None:
+            return
+        for name, aggregator in self.aggregators.items():
+            for key, value in aggregator.map(log):
+                yield (name, key), value
+
+    def combiner(self, key, values):
+        name, report_key = key
+        yield key, self.aggregators[name].combine(report_key, list(values))
+
+    def reducer(self, key, values):
+        name, report_key = key
+        aggregator = self.aggregators[name]
+        for out_key, out_value in aggregator.output(report_key, aggregator.combine(report_key, list(values))):
+            yield name, out_key, out_value
+
+
+class SplitLogReports(luigi.Task):
+    """
+    Splits the output of LogReports into one file per report.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    reports = luigi.ListParameter(default=sorted(AGGREGATORS.keys()))
+    targets_path = luigi.Parameter(default=None)
+    from_hdfs = luigi.BoolParameter(default=False)
+
+    def requires(self):
+        return LogReports(self.job, self.launch_id, self.log_paths, self.reports, self.targets_path, self.from_hdfs)
+
+    def output(self):
+        outputs = {}
+        for name in self.reports:
+            out_name = "task-state/%s/%s/crawl-logs-%i.%s.tsv" % (self.job, self.launch_id, len(self.log_paths), name)
+            if self.from_hdfs:
+                outputs[name] = luigi.contrib.hdfs.HdfsTarget(path=out_name, format=Plain)
+            else:
+                outputs[name] = luigi.LocalTarget(path=out_name)
+        return outputs
+
+    def run(self):
+        outputs = self.output()
+        out_files = dict((name, outputs[name].open('w')) for name in outputs)
+        try:
+            with self.input().open('r') as in_file:
+                for line in in_file:
+                    name, rest = line.split('\t', 1)
+                    out_files[name].write(rest)
+        finally:
+            for out_file in out_files.values():
+                out_file.close()
+
+
+class LocalLogReports(luigi.Task):
+    """
+    Generates the same reports as SplitLogReports from local (optionally gzipped) crawl logs, without Hadoop, using
+    a pool of worker processes.
+    """
+    task_namespace = 'analyse'
+    job = luigi.Parameter()
+    launch_id = luigi.Parameter()
+    log_paths = luigi.ListParameter()
+    reports = luigi.ListParameter(default=sorted(AGGREGATORS.keys()))
+    targets_path = luigi.Parameter(default=None)
+    processes = luigi.IntParameter(default=DEFAULT_LOCAL_PROCESSES)
+
+    def requires(self):
+        return [InputFile(log_path) for log_path in self.log_paths]
+
+    def out_dir(self):
+        return "task-state/%s/%s/crawl-logs-%i.reports" % (self.job, self.launch_id, len(self.log_paths))
+
+    def output(self):
+        return dict((name, luigi.LocalTarget(path=os.path.join(self.out_dir(), '%s.tsv' % name)))
+                    for name in self.reports)
+
+    def run(self):
+        counts = run_local_log_reports(self.log_paths, self.reports, self.out_dir(), self.job, self.launch_id,
+                                       self.targets_path, self.processes)
+        logger.info("Log report line counts: %s" % json.dumps(counts))
+
+
+if __name__ == '__main__':
+    luigi.run(['analyse.LocalLogReports', '--job', 'frequent', '--launch-id', '20181126142741',
+               '--log-paths', '[ "test/crawl.log" ]',
+               '--local-scheduler'])
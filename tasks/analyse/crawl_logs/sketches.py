@@ -0,0 +1,271 @@
+"""
+Small, mergeable summaries ('sketches') of crawl log values, for estimating distinct counts, the heaviest hitters
+and the distribution of a value without having to pass every value on to a reducer.
+
+- HyperLogLog, for counting distinct values (e.g. URLs or hosts). See Flajolet et al., "HyperLogLog: the analysis
+  of a near-optimal cardinality estimation algorithm" (2007).
+- Misra-Gries frequent items, for the top-k (e.g. the hosts with the most URLs). See Misra & Gries, "Finding
+  repeated elements" (1982), and Agarwal et al., "Mergeable summaries" (2012).
+- t-digest, for quantiles (e.g. of fetch duration or content length). See Dunning & Ertl, "Computing extremely
+  accurate quantiles using t-digests" (2019).
+
+Each sketch is held as plain dicts, lists, strings and numbers, so they can be passed between Hadoop tasks in
+either intermediate format (see intermediate.py), and stored as JSON. To keep adding one value at a time cheap, the
+add and merge functions update the first sketch in place, and return it.
+"""
+import math
+import hashlib
+
+# The number of bits of the hash used to pick a HyperLogLog register, giving 2^12 = 4096 registers and a standard
+# error of about 1.6%:
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+# Registers are held sparsely until there are this many, then as a string with one character per register:
+HLL_SPARSE_LIMIT = HLL_REGISTERS // 16
+
+# How many items to keep counts for in a top-k sketch:
+TOP_K = 100
+
+# How many centroids a t-digest can keep (roughly), and how many values to buffer before merging them in:
+TDIGEST_COMPRESSION = 100
+TDIGEST_BUFFER = 500
+
+
+def hash_value(value):
+    """
+    A 64-bit hash of a string, which is the same in every process (unlike the built-in hash()).
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+#
+# HyperLogLog
+#
+
+def hll_new():
+    # 'd' is the dense registers (or '' if there aren't any yet), and 's' the sparse ones, which override them:
+    return { 'd': '', 's': {} }
+
+
+def _hll_fold(hll):
+    registers = [ord(c) - 65 for c in hll['d']] if hll['d'] else [0] * HLL_REGISTERS
+    for index, rank in hll['s'].items():
+        index = int(index)
+        if rank > registers[index]:
+            registers[index] = rank
+    hll['d'] = ''.join(chr(65 + rank) for rank in registers)
+    hll['s'] = {}
+
+
+def _hll_set(hll, key, rank):
+    if hll['d'] and ord(hll['d'][int(key)]) - 65 >= rank:
+        return
+    if rank > hll['s'].get(key, 0):
+        hll['s'][key] = rank
+        if len(hll['s']) > HLL_SPARSE_LIMIT:
+            _hll_fold(hll)
+
+
+def hll_position(h):
+    """
+    The register (as a string, as held in the sketch) and rank for a value that has been hashed with hash_value().
+    """
+    bits = 64 - HLL_PRECISION
+    rest = h & ((1 << bits) - 1)
+    return str(h >> bits), bits - rest.bit_length() + 1
+
+
+def hll_from_position(position):
+    """
+    Makes a sketch holding one value, from its hll_position().
+    """
+    key, rank = position
+    return { 'd': '', 's': { key: rank } }
+
+
+def hll_add(hll, value):
+    key, rank = hll_position(hash_value(value))
+    _hll_set(hll, key, rank)
+    return hll
+
+
+def hll_merge(hll, other):
+    if other['d']:
+        if hll['d']:
+            hll['d'] = ''.join(max(a, b) for a, b in zip(hll['d'], other['d']))
+        else:
+            hll['d'] = other['d']
+    for key, rank in other['s'].items():
+        _hll_set(hll, key, rank)
+    return hll
+
+
+def hll_count(hll):
+    """
+    Estimates the number of distinct values added.
+    """
+    registers = [0] * HLL_REGISTERS
+    if hll['d']:
+        registers = [ord(c) - 65 for c in hll['d']]
+    for index, rank in hll['s'].items():
+        index = int(index)
+        registers[index] = max(registers[index], rank)
+    m = float(HLL_REGISTERS)
+    estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    # Use linear counting for small cardinalities, where it's more accurate:
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+#
+# Top-k
+#
+
+def topk_new():
+    return {}
+
+
+def _topk_trim(topk, k):
+    # Misra-Gries: subtract the (k+1)th largest count from all of them, dropping any that are left with none:
+    cut = sorted(topk.values(), reverse=True)[k]
+    for item in list(topk.keys()):
+        topk[item] -= cut
+        if topk[item] <= 0:
+            del topk[item]
+
+
+def topk_add(topk, item, count=1, k=TOP_K):
+    topk[item] = topk.get(item, 0) + count
+    # Let the counts grow a bit before trimming them, so it doesn't happen for every new item:
+    if len(topk) > 2 * k:
+        _topk_trim(topk, k)
+    return topk
+
+
+def topk_merge(topk, other, k=TOP_K):
+    for item, count in other.items():
+        topk[item] = topk.get(item, 0) + count
+    if len(topk) > 2 * k:
+        _topk_trim(topk, k)
+    return topk
+
+
+def topk_items(topk, k=TOP_K):
+    """
+    The (up to) k most frequent items, as a list of [item, count] pairs, most frequent first.
+
+    The counts are lower bounds, each short by at most the total count divided by k+1.
+    """
+    top = sorted(topk.items(), key=lambda item: (-item[1], item[0]))[:k]
+    return [[item, count] for item, count in top]
+
+
+#
+# t-digest
+#
+
+def tdigest_new():
+    # 'c' is the merged centroids, as [mean, weight] pairs in order of mean, and 'b' the values not merged in yet:
+    return { 'c': [], 'b': [], 'min': None, 'max': None }
+
+
+def _k_scale(q):
+    return TDIGEST_COMPRESSION / (2 * math.pi) * math.asin(2 * q - 1)
+
+
+def _k_inverse(k):
+    return (math.sin(k * 2 * math.pi / TDIGEST_COMPRESSION) + 1) / 2
+
+
+def _tdigest_compress(td):
+    points = [(mean, weight) for mean, weight in td['c']] + [(value, 1) for value in td['b']]
+    if not points:
+        return
+    points.sort()
+    total = float(sum(weight for mean, weight in points))
+    centroids = []
+    mean, weight = points[0]
+    done = 0.0
+    limit = _k_inverse(_k_scale(0.0) + 1)
+    for next_mean, next_weight in points[1:]:
+        if (done + weight + next_weight) / total <= limit:
+            # Merge into the current centroid:
+            weight += next_weight
+            mean += (next_mean - mean) * next_weight / weight
+        else:
+            centroids.append([mean, weight])
+            done += weight
+            limit = _k_inverse(_k_scale(done / total) + 1)
+            mean, weight = next_mean, next_weight
+    centroids.append([mean, weight])
+    td['c'] = centroids
+    td['b'] = []
+
+
+def tdigest_from(value):
+    """
+    Makes a t-digest holding one value, or none if the value is None.
+    """
+    if value is None:
+        return tdigest_new()
+    return { 'c': [], 'b': [value], 'min': value, 'max': value }
+
+
+def tdigest_add(td, value):
+    td['b'].append(value)
+    if td['min'] is None or value < td['min']:
+        td['min'] = value
+    if td['max'] is None or value > td['max']:
+        td['max'] = value
+    if len(td['b']) > TDIGEST_BUFFER:
+        _tdigest_compress(td)
+    return td
+
+
+def tdigest_merge(td, other):
+    if other['min'] is None:
+        return td
+    if other['c']:
+        td['c'] = td['c'] + other['c']
+    td['b'].extend(other['b'])
+    if td['min'] is None or other['min'] < td['min']:
+        td['min'] = other['min']
+    if td['max'] is None or other['max'] > td['max']:
+        td['max'] = other['max']
+    if other['c'] or len(td['b']) > TDIGEST_BUFFER:
+        _tdigest_compress(td)
+    return td
+
+
+def tdigest_count(td):
+    return sum(weight for mean, weight in td['c']) + len(td['b'])
+
+
+def tdigest_quantile(td, q):
+    """
+    Estimates the value below which the given fraction (0 to 1) of the values fall, or None if there are none.
+    """
+    if td['b']:
+        _tdigest_compress(td)
+    centroids = td['c']
+    if not centroids:
+        return None
+    total = float(sum(weight for mean, weight in centroids))
+    target = q * total
+    # Interpolate between the centres of the centroids, using the min and max at the ends:
+    prev_mean, prev_position = td['min'], 0.0
+    position = 0.0
+    for mean, weight in centroids:
+        centre = position + weight / 2.0
+        if target < centre:
+            if centre == prev_position:
+                return mean
+            return prev_mean + (mean - prev_mean) * (target - prev_position) / (centre - prev_position)
+        prev_mean, prev_position = mean, centre
+        position += weight
+    if total == prev_position:
+        return td['max']
+    return prev_mean + (td['max'] - prev_mean) * (target - prev_position) / (total - prev_position)
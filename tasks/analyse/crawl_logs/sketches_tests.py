@@ -0,0 +1,122 @@
+import random
+from tasks.analyse.crawl_logs.sketches import HLL_SPARSE_LIMIT, TOP_K, hll_new, hll_add, hll_merge, hll_count, \
+    topk_new, topk_add, topk_merge, topk_items, tdigest_new, tdigest_add, tdigest_merge, tdigest_count, \
+    tdigest_quantile
+
+
+def _hll(values):
+    hll = hll_new()
+    for value in values:
+        hll_add(hll, value)
+    return hll
+
+
+def _topk(items):
+    topk = topk_new()
+    for item in items:
+        topk_add(topk, item)
+    return topk
+
+
+def _tdigest(values):
+    td = tdigest_new()
+    for value in values:
+        tdigest_add(td, value)
+    return td
+
+
+def _orders(sketches):
+    # Merges the sketches in order, in reverse, and as a tree:
+    yield lambda merge, new: _merge_all(merge, new, sketches)
+    yield lambda merge, new: _merge_all(merge, new, sketches[::-1])
+    yield lambda merge, new: merge(_merge_all(merge, new, sketches[::2]), _merge_all(merge, new, sketches[1::2]))
+
+
+def _merge_all(merge, new, sketches):
+    result = new()
+    for sketch in sketches:
+        result = merge(result, _copy(sketch))
+    return result
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return dict((key, _copy(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def test_hll_count():
+    # Either side of where the registers switch from sparse to dense, and well beyond:
+    for n in [10, HLL_SPARSE_LIMIT // 2, HLL_SPARSE_LIMIT, HLL_SPARSE_LIMIT + 1, 2 * HLL_SPARSE_LIMIT, 5000, 100000]:
+        hll = _hll("http://example.com/%i" % i for i in range(n))
+        # Some values share registers, so it takes more than HLL_SPARSE_LIMIT values to switch:
+        if n >= 2 * HLL_SPARSE_LIMIT:
+            assert hll['d'] != ''
+        elif n < HLL_SPARSE_LIMIT // 2:
+            assert hll['d'] == ''
+        assert abs(hll_count(hll) - n) <= max(1, 0.05 * n), "Estimated %i for %i" % (hll_count(hll), n)
+    assert hll_count(hll_new()) == 0
+
+
+def test_hll_merge_order():
+    # Sketches both sparse and dense, with overlapping values:
+    ranges = [(0, 50), (25, 3000), (1000, 200), (2900, 10), (5000, 400)]
+    sketches = [_hll("http://example.com/%i" % i for i in range(start, start + size)) for start, size in ranges]
+    expected = hll_count(_hll("http://example.com/%i" % i for i in list(range(0, 3025)) + list(range(5000, 5400))))
+    assert abs(expected - 3425) <= 0.05 * 3425
+    for merge_in_order in _orders(sketches):
+        assert hll_count(merge_in_order(hll_merge, hll_new)) == expected
+
+
+def test_topk_merge_order():
+    rng = random.Random(1)
+    # Without trimming, the counts are exact, however they are merged:
+    sketches = [_topk(rng.choice('abcdefghij') for i in range(1000)) for j in range(5)]
+    expected = topk_items(_merge_all(topk_merge, topk_new, sketches))
+    assert sum(count for item, count in expected) == 5000
+    for merge_in_order in _orders(sketches):
+        assert topk_items(merge_in_order(topk_merge, topk_new)) == expected
+
+    # With trimming, the heavy hitters (each seen 1250 times) are found however they are merged, each within the
+    # error bound:
+    streams = [['heavy-%i' % (i % 5) if i % 4 == 0 else 'light-%i-%i' % (j, i) for i in range(5000)]
+               for j in range(5)]
+    sketches = [_topk(stream) for stream in streams]
+    total = sum(len(stream) for stream in streams)
+    for merge_in_order in _orders(sketches):
+        top = dict(topk_items(merge_in_order(topk_merge, topk_new))[:5])
+        assert sorted(top.keys()) == ['heavy-%i' % i for i in range(5)]
+        for count in top.values():
+            assert 1250 - total / (TOP_K + 1) <= count <= 1250
+
+
+def test_tdigest_merge_order():
+    rng = random.Random(1)
+    values = [[rng.expovariate(1 / 200.0) for i in range(size)] for size in [5, 3000, 200, 10000, 1]]
+    sketches = [_tdigest(part) for part in values]
+    everything = sorted(value for part in values for value in part)
+    for merge_in_order in _orders(sketches):
+        td = merge_in_order(tdigest_merge, tdigest_new)
+        assert tdigest_count(td) == len(everything)
+        assert td['min'] == everything[0]
+        assert td['max'] == everything[-1]
+        for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+            exact = everything[int(q * len(everything))]
+            # Compare the rank of the estimate, as that is what the t-digest bounds:
+            estimate = tdigest_quantile(td, q)
+            rank = sum(1 for value in everything if value <= estimate) / len(everything)
+            assert abs(rank - q) < 0.01, "Quantile %s was %s, should be about %s" % (q, estimate, exact)
+
+
+def test_tdigest_quantile_ends():
+    td = _tdigest([5.0, 1.0, 3.0, 2.0, 4.0] * 300)
+    assert tdigest_quantile(td, 0) == 1.0
+    assert tdigest_quantile(td, 1) == 5.0
+
+    single = _tdigest([42.0])
+    for q in [0, 0.25, 0.5, 1]:
+        assert tdigest_quantile(single, q) == 42.0
+
+    assert tdigest_quantile(tdigest_new(), 0.5) is None
@@ -0,0 +1,176 @@
+"""
+Benchmarks the matching of crawl log lines against the seeds of Watched Targets in
+CrawlLogExtractors.extract_documents, on a large synthetic list of Targets, comparing it with the original version
+(which converted the URL and landing page to SURTs and checked them against every watched SURT in turn).
+
+Both versions must find the same documents, and the Target ID returned with each one must belong to the most
+specific watched seed that matches.
+
+Run as:
+
+    python -m tasks.analyse.crawl_logs.watched_bench [-t TARGETS] [-n LINES] [-l LEGACY_LINES]
+
+The original version is very slow for large lists, so only the first LEGACY_LINES lines are used to compare them.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from urllib.parse import urlparse
+from lib.surt import url_to_surt
+from tasks.analyse.crawl_logs.log_analysis_hadoop import CrawlLogLine, CrawlLogExtractors
+
+
+class LegacyCrawlLogExtractors(CrawlLogExtractors):
+    """
+    The original document extraction, kept here for comparison.
+    """
+
+    def extract_documents(self, log):
+        # Skip non-downloads:
+        if log.status_code == '-' or log.status_code == '' or int(int(log.status_code) / 100) != 2:
+            return
+        # Check the URL and Content-Type:
+        if "application/pdf" in log.mime:
+            for prefix in self.watched_surts:
+                document_surt = url_to_surt(log.url)
+                landing_page_surt = url_to_surt(log.via)
+                # Are both URIs under the same watched SURT:
+                if document_surt.startswith(prefix) or landing_page_surt.startswith(prefix):
+                    # Proceed to extract metadata and pass on to W3ACT:
+                    doc = {
+                        'wayback_timestamp': log.start_time_plus_duration[:14],
+                        'landing_page_url': log.via,
+                        'document_url': log.url,
+                        'filename': os.path.basename(urlparse(log.url).path),
+                        'size': int(log.content_length),
+                        # Add some more metadata to the output so we can work out where this came from later:
+                        'job_name': self.job,
+                        'launch_id': self.launch_id,
+                        'source': log.source
+                    }
+                    return json.dumps(doc)
+
+        return None
+
+
+def make_targets(count, rng):
+    """
+    Makes a list of Targets, each with one to three seeds, and most of them watched. Some seeds are under the
+    seeds of other Targets, so there are nested matches.
+    """
+    targets = []
+    for i in range(count):
+        seeds = ["http://www.host%06d.gov.uk/" % i]
+        for j in range(rng.randint(0, 2)):
+            seeds.append("http://www.host%06d.gov.uk/publications/section%i/" % (rng.randrange(count), j))
+        targets.append({ 'id': 100000 + i, 'watched': rng.random() < 0.9, 'seeds': seeds })
+    return targets
+
+
+def make_lines(targets, count, rng):
+    """
+    Makes crawl log lines for PDFs, some under the seeds of Watched Targets, some only linked from pages under
+    them, and some not under any of them.
+    """
+    lines = []
+    for i in range(count):
+        target = rng.choice(targets)
+        seed = rng.choice(target['seeds'])
+        kind = rng.random()
+        if kind < 0.4:
+            url = "%sdocuments/report-%i.pdf" % (seed, i)
+            via = seed
+        elif kind < 0.7:
+            url = "http://assets.example.com/files/report-%i.pdf" % i
+            via = "%spage-%i.html" % (seed, i % 50)
+        else:
+            url = "http://www.elsewhere%06d.com/report-%i.pdf" % (rng.randrange(count), i)
+            via = "http://www.elsewhere%06d.com/" % rng.randrange(count)
+        lines.append("2018-11-26T14:27:48.282Z   200      12345 %s L %s application/pdf #002 "
+                     "20181126142747555+280 sha1:YQG6T7YOWGUK3NUNZVZGNUXFZDZWCDUM %s ip:172.19.0.6\n"
+                     % (url, via, seed))
+    return lines
+
+
+def expected_target_ids(targets, document_surt, landing_page_surt):
+    """
+    The IDs of the Targets with the longest watched seeds that match, checking the document and then the landing
+    page, by brute force.
+    """
+    for surt in [document_surt, landing_page_surt]:
+        best = []
+        best_length = -1
+        for t in targets:
+            if not t['watched']:
+                continue
+            for seed in t['seeds']:
+                seed_surt = url_to_surt(seed)
+                if surt.startswith(seed_surt):
+                    if len(seed_surt) > best_length:
+                        best, best_length = [], len(seed_surt)
+                    if len(seed_surt) == best_length:
+                        best.append(t['id'])
+        if best:
+            return best
+    return []
+
+
+def _run(label, extractor, logs):
+    start = time.perf_counter()
+    docs = [extractor.extract_documents(log) for log in logs]
+    elapsed = time.perf_counter() - start
+    print("%-30s %8i lines %10.3f s %12.1f us/line" % (label, len(logs), elapsed, 1e6 * elapsed / len(logs)))
+    return docs
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='watched_bench')
+    parser.add_argument('-t', '--targets', type=int, default=20000, help='Number of synthetic Targets.')
+    parser.add_argument('-n', '--lines', type=int, default=20000, help='Number of synthetic PDF log lines.')
+    parser.add_argument('-l', '--legacy-lines', type=int, default=20,
+                        help='Number of lines to run through the original version.')
+    parser.add_argument('-s', '--seed', type=int, default=1, help='Random seed.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    targets = make_targets(args.targets, rng)
+    logs = [CrawlLogLine(line) for line in make_lines(targets, args.lines, rng)]
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(targets, f)
+        targets_path = f.name
+    try:
+        start = time.perf_counter()
+        extractor = CrawlLogExtractors('bench', 'bench', False, targets_path=targets_path)
+        print("Indexed %i watched seeds of %i Targets in %.3f s." %
+              (len(extractor.watched_surts), len(targets), time.perf_counter() - start))
+        legacy = LegacyCrawlLogExtractors('bench', 'bench', False, targets_path=targets_path)
+    finally:
+        os.remove(targets_path)
+
+    docs = _run("CrawlLogExtractors", extractor, logs)
+    legacy_docs = _run("LegacyCrawlLogExtractors", legacy, logs[:args.legacy_lines])
+    print("Found %i documents in %i lines." % (len([doc for doc in docs if doc]), len(logs)))
+
+    mismatches = 0
+    for log, doc, legacy_doc in zip(logs, docs, legacy_docs):
+        doc = json.loads(doc) if doc else None
+        legacy_doc = json.loads(legacy_doc) if legacy_doc else None
+        target_id = doc.pop('target_id') if doc else None
+        if doc != legacy_doc:
+            mismatches += 1
+            print("Documents differ for %s: %s != %s" % (log.url, doc, legacy_doc))
+        elif doc and target_id not in expected_target_ids(targets, url_to_surt(log.url), url_to_surt(log.via)):
+            mismatches += 1
+            print("Wrong Target ID %s for %s" % (target_id, log.url))
+    print("Compared %i lines, %i mismatches." % (len(legacy_docs), mismatches))
+
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()